@@ -1,10 +1,15 @@
-import cv2
 import numpy as np
 import os
-import glob
+import csv
+import time
 import tkinter as tk
 from tkinter import messagebox
-from PIL import Image, ImageTk
+from label_store import LabelStore, to_pixels
+from dataset_manifest import DatasetManifest
+from display_prefetch import DisplayPrefetcher
+from tiled_viewport import TiledViewport
+from proposals import ProposalWorker
+from metrics import iou_matrix
 
 # --- 設定 ---
 IMAGE_DIR = 'output'
@@ -12,6 +17,14 @@ CLASSES_FILE = 'classes.txt'
 LABEL_DIR = 'merged_output'  # YOLOテキストの保存・読み込み先
 IMAGE_EXTENSIONS = ['*.jpg', '*.jpeg', '*.png']
 MAX_DISPLAY_SIZE = (1100, 750) # 画面に収まるサイズ
+PREFETCH_RADIUS = 3    # 前後何枚を先読みするか
+PREFETCH_CACHE_MB = 512 # 表示用画像のキャッシュ上限
+LOADING_POLL_MS = 15   # 先読みが間に合わなかったときの再確認間隔
+PROPOSAL_MODEL = "RetinaFace" # 候補ボックスを出す検出器 (None で無効)
+PROPOSAL_LOOKAHEAD = 5 # 何枚先まで候補を推論しておくか
+PROPOSAL_PARAMS = {'threshold': 0.5} # 検出器に渡すパラメータ (RetinaFace の既定 0.9 より低くして候補を多めに出す)
+PROPOSAL_POLL_MS = 100 # 候補が間に合わなかったときの再確認間隔
+SESSION_LOG = 'annotation_sessions.csv' # 作業時間とラベル付け枚数の記録
 
 class AnnotationApp:
     def __init__(self, root):
@@ -22,6 +35,7 @@ class AnnotationApp:
         self.class_list = self.load_classes()
         self.class_to_id = {name: i for i, name in enumerate(self.class_list)}
         self.image_paths = self.get_image_paths()
+        self.labels = LabelStore(LABEL_DIR)
         self.current_idx = 0
         
         if not self.image_paths:
@@ -34,8 +48,33 @@ class AnnotationApp:
         self.drawing = False
         self.start_x = -1
         self.start_y = -1
-        self.scale_factor = 1.0
-        self.cv_img_rgb = None
+        self.pending_load = None
+        self.pending_proposals = None
+        self.proposals = [] # 表示中の候補ボックス (まだ確定していないもの)
+        self.dismissed = {} # {ファイル名: 消した候補の bbox_xyxy の集合} (戻ってきても出さない)
+        
+        # 作業量の計測 (ラベル付け枚数/時間)
+        self.session_start = time.time()
+        self.labeled_count = 0
+        self.labeled_names = set() # このセッションでラベルなし → ラベルありにした画像
+        self.started_labeled = False # 表示中の画像に最初からラベルがあったか
+        self.cursor = None # キャンバス上のマウス位置 (候補を1つずつ採用・削除するため)
+        self.hover = None
+        self.accepted_count = 0
+        
+        # 候補ボックスは別スレッドで数枚先まで推論しておく (UI はモデルを待たない)
+        self.proposer = None
+        if PROPOSAL_MODEL:
+            self.proposer = ProposalWorker(
+                self.image_paths, PROPOSAL_MODEL, PROPOSAL_LOOKAHEAD, PROPOSAL_PARAMS
+            )
+        
+        # 表示用画像は別スレッドで前後数枚ぶん用意しておく (キー操作でデコードを待たない)
+        self.prefetcher = DisplayPrefetcher(
+            self.image_paths, MAX_DISPLAY_SIZE,
+            size_of=lambda p: self.manifest.image_size(os.path.basename(p)),
+            cache_mb=PREFETCH_CACHE_MB, radius=PREFETCH_RADIUS
+        )
         
         # 3. UIの構築
         self.setup_ui()
@@ -51,10 +90,11 @@ class AnnotationApp:
             return [line.strip() for line in f if line.strip()]
 
     def get_image_paths(self):
-        paths = []
-        for ext in IMAGE_EXTENSIONS:
-            paths.extend(glob.glob(os.path.join(IMAGE_DIR, ext)))
-        return sorted(paths)
+        # アノテーション中に画像を書き換えることはないので、内容ハッシュは計算しない
+        # (縮小画像のキャッシュはサイズ・mtime、候補の予測キャッシュは image_hash() をキーにする)
+        self.manifest = DatasetManifest(IMAGE_DIR, with_hash=False)
+        exts = [os.path.splitext(ext)[1] for ext in IMAGE_EXTENSIONS]
+        return self.manifest.image_paths(exts)
 
     def setup_ui(self):
         self.main_frame = tk.Frame(self.root)
@@ -70,6 +110,16 @@ class AnnotationApp:
         self.canvas.bind("<ButtonPress-1>", self.on_button_press)
         self.canvas.bind("<B1-Motion>", self.on_move_press)
         self.canvas.bind("<ButtonRelease-1>", self.on_button_release)
+        self.canvas.bind("<Motion>", self.on_motion)
+        self.canvas.bind("<Leave>", self.on_leave)
+
+        # 拡大・移動 (ホイールで拡大縮小、右ドラッグで移動)
+        self.viewport = TiledViewport(self.canvas, self.root)
+        self.canvas.bind("<ButtonPress-3>", self.viewport.pan_start)
+        self.canvas.bind("<B3-Motion>", self.viewport.pan_drag)
+        self.canvas.bind("<MouseWheel>", lambda e: self.viewport.zoom_at(e.x, e.y, 1 if e.delta > 0 else -1))
+        self.canvas.bind("<Button-4>", lambda e: self.viewport.zoom_at(e.x, e.y, 1))
+        self.canvas.bind("<Button-5>", lambda e: self.viewport.zoom_at(e.x, e.y, -1))
 
         # 右側: 操作パネル
         self.ctrl_panel = tk.Frame(self.main_frame, width=250, bg="#f0f0f0", padx=10, pady=10)
@@ -85,68 +135,170 @@ class AnnotationApp:
         tk.Button(self.ctrl_panel, text="Undo (Z)", command=self.undo, bg="#fff").pack(fill=tk.X, pady=2)
         tk.Button(self.ctrl_panel, text="保存して次へ (S)", command=self.save_and_next, bg="#c8e6c9").pack(fill=tk.X, pady=2)
         tk.Button(self.ctrl_panel, text="前の画像へ (A)", command=self.prev_image).pack(fill=tk.X, pady=2)
+        tk.Button(self.ctrl_panel, text="全体表示 (F)", command=self.viewport.fit).pack(fill=tk.X, pady=2)
+        # キーはマウスの下の候補1つに効く (候補の外ならすべて)。ボタンは常にすべて
+        tk.Button(self.ctrl_panel, text="候補をすべて採用 (E / Enter)", command=self.accept_proposals, bg="#ffe0b2").pack(fill=tk.X, pady=2)
+        tk.Button(self.ctrl_panel, text="候補をすべて消す (X)", command=self.dismiss_proposals).pack(fill=tk.X, pady=2)
+        tk.Label(self.ctrl_panel, text="ホイール: 拡大縮小 / 右ドラッグ: 移動", fg="#555").pack(anchor=tk.W, pady=(5, 0))
 
         self.info_label = tk.Label(self.ctrl_panel, text="", justify=tk.LEFT)
         self.info_label.pack(side=tk.BOTTOM, fill=tk.X)
 
     def load_image(self):
-        path = self.image_paths[self.current_idx]
+        if self.pending_load is not None:
+            self.root.after_cancel(self.pending_load)
+            self.pending_load = None
+        idx = self.current_idx
+        path = self.image_paths[idx]
         file_name = os.path.basename(path)
-        img_bgr = cv2.imread(path)
-        if img_bgr is None:
+        self.prefetcher.request(idx)
+        entry = self.prefetcher.get(idx)
+        if entry is None:
+            # 先読みが間に合っていない: UI は止めずに少し後で再確認する
+            self.info_label.config(text=f"読み込み中...\nファイル: {file_name}")
+            self.pending_load = self.root.after(LOADING_POLL_MS, self.load_image)
+            return
+        if entry.image is None:
             self.next_image()
             return
         
-        self.cv_img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-        h, w, _ = self.cv_img_rgb.shape
-        
-        # リサイズ倍率の計算
-        self.scale_factor = min(MAX_DISPLAY_SIZE[0] / w, MAX_DISPLAY_SIZE[1] / h, 1.0)
-        self.display_w = int(w * self.scale_factor)
-        self.display_h = int(h * self.scale_factor)
+        # 元の解像度 (ラベルの座標系)
+        self.img_w, self.img_h = entry.orig_w, entry.orig_h
+        # 全体表示から始め、拡大したときは見えている部分のタイルだけ作る
+        self.viewport.set_image(entry.image, self.img_w, self.img_h, entry.scale_factor, path)
         
         # 既存アノテーションの読み込み
-        self.current_anns = self.fetch_existing_annotations(file_name, w, h)
-        self.render_image()
+        self.current_anns = self.fetch_existing_annotations(file_name, self.img_w, self.img_h)
+        self.started_labeled = bool(self.current_anns)
+        self.redraw_boxes()
+        self.show_proposals(idx)
         self.update_info()
 
-    def render_image(self):
-        resized = cv2.resize(self.cv_img_rgb, (self.display_w, self.display_h))
-        self.tk_img = ImageTk.PhotoImage(Image.fromarray(resized))
-        self.canvas.config(width=self.display_w, height=self.display_h)
-        self.redraw()
-
-    def redraw(self):
-        self.canvas.delete("all")
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_img)
+    def redraw_boxes(self):
+        self.canvas.delete("box")
+        self.proposals = []
+        self.hover = None
         for ann in self.current_anns:
-            x1, y1, x2, y2 = [int(c * self.scale_factor) for c in ann['bbox_xyxy']]
-            color = "cyan" if ann.get('is_existing') else "green"
-            
-            # ボックス描画
-            self.canvas.create_rectangle(x1, y1, x2, y2, outline=color, width=2)
-            
-            # ラベル描画（画面外対策）
-            # ボックスの上端が近い場合は、ボックスの内側に表示
-            text_y = y1 - 2 if y1 > 20 else y1 + 15
-            self.canvas.create_text(x1, text_y, text=ann['class_name'], fill=color, anchor=tk.SW, font=("", 10, "bold"))
+            self.draw_box(ann)
+
+    def show_proposals(self, idx):
+        """検出器の候補を点線で表示する。まだ推論が終わっていなければ少し後で再確認する"""
+        if self.pending_proposals is not None:
+            self.root.after_cancel(self.pending_proposals)
+            self.pending_proposals = None
+        if self.proposer is None or idx != self.current_idx: return
+        self.proposer.request(idx)
+        result = self.proposer.get(idx)
+        if result is None:
+            if self.proposer.error is None:
+                self.pending_proposals = self.root.after(PROPOSAL_POLL_MS, lambda: self.show_proposals(idx))
+            return
+        boxes, scores = result
+        boxes = boxes * np.float32([self.img_w, self.img_h, self.img_w, self.img_h])
+        # 既にあるボックスと重なる候補は出さない
+        if self.current_anns and len(boxes):
+            overlap = iou_matrix(boxes, [a['bbox_xyxy'] for a in self.current_anns]).max(axis=1)
+            boxes, scores = boxes[overlap < 0.5], scores[overlap < 0.5]
+        dismissed = self.dismissed.get(os.path.basename(self.image_paths[idx]), set())
+        zoom = self.viewport.zoom
+        for box, score in zip(boxes.tolist(), scores.tolist()):
+            if tuple(int(c) for c in box) in dismissed: continue
+            x1, y1, x2, y2 = [c * zoom for c in box]
+            rect = self.canvas.create_rectangle(x1, y1, x2, y2, outline="orange", width=2, dash=(6, 4), tags=("box", "proposal"))
+            text = self.canvas.create_text(x1, y2 + 2, text=f"{PROPOSAL_MODEL} {score:.2f}", fill="orange", anchor=tk.NW, font=("", 9), tags=("box", "proposal"))
+            self.proposals.append({'bbox_xyxy': [int(c) for c in box], 'score': score, 'items': (rect, text)})
+
+    def proposal_at(self, cx, cy):
+        """キャンバス座標の位置にある候補 (重なっていれば小さい方)"""
+        hits = []
+        for prop in self.proposals:
+            x1, y1, x2, y2 = self.canvas.coords(prop['items'][0]) # ズーム後の座標
+            if x1 <= cx <= x2 and y1 <= cy <= y2:
+                hits.append(((x2 - x1) * (y2 - y1), prop))
+        return min(hits, key=lambda h: h[0])[1] if hits else None
+
+    def on_motion(self, event):
+        self.cursor = (self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+        prop = self.proposal_at(*self.cursor)
+        if prop is self.hover: return
+        # どの候補に効くか分かるよう、マウスの下の候補を太くする
+        if self.hover is not None and self.hover in self.proposals:
+            self.canvas.itemconfig(self.hover['items'][0], width=2)
+        if prop is not None:
+            self.canvas.itemconfig(prop['items'][0], width=4)
+        self.hover = prop
+
+    def on_leave(self, event):
+        self.cursor = None
+
+    def target_proposals(self, use_cursor):
+        """キー操作ならマウスの下の候補1つ、候補の外やボタンからならすべて"""
+        if use_cursor and self.cursor is not None:
+            prop = self.proposal_at(*self.cursor)
+            if prop is not None: return [prop]
+        return list(self.proposals)
+
+    def accept_proposals(self, use_cursor=False):
+        """候補を選択中のクラスで確定する (Undo で1つずつ取り消せる)。クラスを変えながら1つずつ採用できる"""
+        targets = self.target_proposals(use_cursor)
+        if not targets: return
+        selected_idx = self.class_box.curselection()
+        class_name = self.class_list[selected_idx[0]] if selected_idx else self.class_list[0]
+        for prop in targets:
+            self.canvas.delete(*prop['items'])
+            self.proposals.remove(prop)
+            self.current_anns.append({
+                'class_name': class_name,
+                'bbox_xyxy': prop['bbox_xyxy'],
+                'img_w': self.img_w,
+                'img_h': self.img_h,
+                'is_existing': False
+            })
+            self.draw_box(self.current_anns[-1])
+        self.accepted_count += len(targets)
+        self.hover = None
+
+    def dismiss_proposals(self, use_cursor=False):
+        file_name = os.path.basename(self.image_paths[self.current_idx])
+        for prop in self.target_proposals(use_cursor):
+            self.canvas.delete(*prop['items'])
+            self.proposals.remove(prop)
+            self.dismissed.setdefault(file_name, set()).add(tuple(prop['bbox_xyxy']))
+        self.hover = None
+
+    def draw_box(self, ann):
+        """ボックス1つ分の canvas 項目を追加する (他のボックスや画像は描き直さない)"""
+        x1, y1, x2, y2 = [c * self.viewport.zoom for c in ann['bbox_xyxy']]
+        color = "cyan" if ann.get('is_existing') else "green"
+        
+        # ボックス描画
+        rect = self.canvas.create_rectangle(x1, y1, x2, y2, outline=color, width=2, tags=("box",))
+        
+        # ラベル描画（画面外対策）
+        # ボックスの上端が近い場合は、ボックスの内側に表示
+        text_y = y1 - 2 if y1 > 20 else y1 + 15
+        text = self.canvas.create_text(x1, text_y, text=ann['class_name'], fill=color, anchor=tk.SW, font=("", 10, "bold"), tags=("box",))
+        ann['items'] = (rect, text)
 
     def on_button_press(self, event):
         self.drawing = True
-        self.start_x, self.start_y = event.x, event.y
-        self.temp_rect = self.canvas.create_rectangle(self.start_x, self.start_y, event.x, event.y, outline="yellow", width=2)
+        # キャンバス座標 (スクロール分を含む) で扱う
+        self.start_x, self.start_y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        self.temp_rect = self.canvas.create_rectangle(self.start_x, self.start_y, self.start_x, self.start_y, outline="yellow", width=2)
 
     def on_move_press(self, event):
         if self.drawing:
-            self.canvas.coords(self.temp_rect, self.start_x, self.start_y, event.x, event.y)
+            self.canvas.coords(self.temp_rect, self.start_x, self.start_y, self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
 
     def on_button_release(self, event):
         self.drawing = False
         self.canvas.delete(self.temp_rect)
-        x1_orig = int(min(self.start_x, event.x) / self.scale_factor)
-        y1_orig = int(min(self.start_y, event.y) / self.scale_factor)
-        x2_orig = int(max(self.start_x, event.x) / self.scale_factor)
-        y2_orig = int(max(self.start_y, event.y) / self.scale_factor)
+        end_x, end_y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        zoom = self.viewport.zoom
+        x1_orig = int(min(self.start_x, end_x) / zoom)
+        y1_orig = int(min(self.start_y, end_y) / zoom)
+        x2_orig = int(max(self.start_x, end_x) / zoom)
+        y2_orig = int(max(self.start_y, end_y) / zoom)
         
         if (x2_orig - x1_orig) > 5 and (y2_orig - y1_orig) > 5:
             selected_idx = self.class_box.curselection()
@@ -154,22 +306,51 @@ class AnnotationApp:
             self.current_anns.append({
                 'class_name': class_name,
                 'bbox_xyxy': [x1_orig, y1_orig, x2_orig, y2_orig],
-                'img_w': self.cv_img_rgb.shape[1],
-                'img_h': self.cv_img_rgb.shape[0],
+                'img_w': self.img_w,
+                'img_h': self.img_h,
                 'is_existing': False
             })
-            self.redraw()
+            self.draw_box(self.current_anns[-1])
 
     def undo(self):
         if self.current_anns:
-            self.current_anns.pop()
-            self.redraw()
+            ann = self.current_anns.pop()
+            self.canvas.delete(*ann.get('items', ()))
 
     def save_and_next(self):
         file_name = os.path.basename(self.image_paths[self.current_idx])
         self.export_yolo(file_name, self.current_anns)
+        # 作業量として数えるのは、ラベルのなかった画像にこのセッションで初めてラベルを付けたときだけ
+        # (ラベル済み画像の保存し直しや、A で戻って再保存した分は数えない)
+        if self.current_anns and not self.started_labeled:
+            self.labeled_names.add(file_name)
+            self.labeled_count = len(self.labeled_names)
         self.next_image()
 
+    def images_per_hour(self):
+        hours = (time.time() - self.session_start) / 3600
+        return self.labeled_count / hours if hours > 0 else 0.0
+
+    def log_session(self):
+        """作業時間・ラベル付け枚数・採用した候補数を記録する (候補の有無で作業速度を比べる用)"""
+        is_new = not os.path.exists(SESSION_LOG)
+        with open(SESSION_LOG, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(["Start", "Minutes", "Labeled Images", "Images/Hour", "Accepted Proposals", "Proposal Model"])
+            writer.writerow([
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.session_start)),
+                f"{(time.time() - self.session_start) / 60:.1f}", self.labeled_count,
+                f"{self.images_per_hour():.1f}", self.accepted_count, PROPOSAL_MODEL or "-"
+            ])
+        print(f"ラベル付け: {self.labeled_count} 枚 ({self.images_per_hour():.1f} 枚/時) / 採用した候補: {self.accepted_count} 個")
+
+    def on_close(self):
+        self.log_session()
+        if self.proposer is not None: self.proposer.close()
+        self.prefetcher.close()
+        self.root.destroy()
+
     def next_image(self):
         if self.current_idx < len(self.image_paths) - 1:
             self.current_idx += 1
@@ -184,24 +365,18 @@ class AnnotationApp:
 
     def update_info(self):
         path = self.image_paths[self.current_idx]
-        self.info_label.config(text=f"進捗: {self.current_idx + 1} / {len(self.image_paths)}\nファイル: {os.path.basename(path)}")
+        self.info_label.config(text=(
+            f"進捗: {self.current_idx + 1} / {len(self.image_paths)}\nファイル: {os.path.basename(path)}\n"
+            f"ラベル付け: {self.labeled_count} 枚 ({self.images_per_hour():.1f} 枚/時)"
+        ))
 
     def fetch_existing_annotations(self, file_name, img_w, img_h):
         base_name = os.path.splitext(file_name)[0]
         anns = []
-        yolo_p = os.path.join(LABEL_DIR, base_name + ".txt")
-        if os.path.exists(yolo_p):
-            with open(yolo_p, "r") as f:
-                for line in f:
-                    vals = line.strip().split()
-                    if len(vals) != 5: continue
-                    cid, cx, cy, w, h = map(float, vals)
-                    x1 = int((cx - w/2) * img_w)
-                    y1 = int((cy - h/2) * img_h)
-                    x2 = int((cx + w/2) * img_w)
-                    y2 = int((cy + h/2) * img_h)
-                    cname = self.class_list[int(cid)] if int(cid) < len(self.class_list) else f"id_{int(cid)}"
-                    anns.append({'class_name': cname, 'bbox_xyxy': [x1, y1, x2, y2], 'img_w': img_w, 'img_h': img_h, 'is_existing': True})
+        class_ids, boxes = self.labels.get(base_name)
+        for cid, bbox in zip(class_ids.tolist(), to_pixels(boxes, img_w, img_h)):
+            cname = self.class_list[cid] if cid < len(self.class_list) else f"id_{cid}"
+            anns.append({'class_name': cname, 'bbox_xyxy': bbox.tolist(), 'img_w': img_w, 'img_h': img_h, 'is_existing': True})
         return anns
 
     def export_yolo(self, file_name, data):
@@ -220,6 +395,7 @@ class AnnotationApp:
         
         with open(os.path.join(LABEL_DIR, base_name + ".txt"), 'w') as f:
             f.write('\n'.join(yolo_lines))
+        self.labels.update(base_name)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -228,4 +404,9 @@ if __name__ == "__main__":
     root.bind("<s>", lambda e: app.save_and_next())
     root.bind("<z>", lambda e: app.undo())
     root.bind("<a>", lambda e: app.prev_image())
+    root.bind("<f>", lambda e: app.viewport.fit())
+    root.bind("<e>", lambda e: app.accept_proposals(use_cursor=True))
+    root.bind("<Return>", lambda e: app.accept_proposals(use_cursor=True))
+    root.bind("<x>", lambda e: app.dismiss_proposals(use_cursor=True))
+    root.protocol("WM_DELETE_WINDOW", app.on_close)
     root.mainloop()
\ No newline at end of file
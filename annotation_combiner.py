@@ -1,7 +1,11 @@
 import cv2
 import os
 import glob
+import argparse
 import random
+from label_store import LabelStore, to_pixels
+from image_loader import load_reduced
+from contact_sheet import render_contact_sheets, browse_contact_sheets, load_flagged
 
 # --- 設定 ---
 IMAGE_DIR = 'output'
@@ -13,6 +17,8 @@ WINDOW_NAME = "YOLO Annotation Verification"
 MAX_WIDTH = 1280
 MAX_HEIGHT = 720
 
+SHEET_DIR = 'contact_sheets_merged' # --sheet のページの保存先
+
 CLASS_COLORS = {}
 
 def get_unique_color(class_name):
@@ -29,28 +35,24 @@ def load_classes(file_path):
         print(f"❌ エラー: '{file_path}' が見つかりません。")
         return {}
 
-def get_yolo_annotations(label_path, img_w, img_h, class_map):
-    annotations = []
-    if not os.path.exists(label_path):
-        return []
-    with open(label_path, 'r') as f:
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) != 5: continue
-            class_id = int(parts[0])
-            x_c, y_c, w_norm, h_norm = [float(p) for p in parts[1:]]
-            x_min = int((x_c - w_norm / 2) * img_w)
-            y_min = int((y_c - h_norm / 2) * img_h)
-            x_max = int((x_c + w_norm / 2) * img_w)
-            y_max = int((y_c + h_norm / 2) * img_h)
-            annotations.append({'bbox': [x_min, y_min, x_max, y_max], 'label': class_map.get(class_id, f"ID:{class_id}")})
-    return annotations
-
-def visualize_yolo():
-    class_map = load_classes(CLASSES_FILE)
+def get_yolo_annotations(labels, img_id, img_w, img_h, class_map):
+    class_ids, boxes = labels.get(img_id)
+    return [
+        {'bbox': bbox.tolist(), 'label': class_map.get(int(class_id), f"ID:{class_id}")}
+        for class_id, bbox in zip(class_ids, to_pixels(boxes, img_w, img_h))
+    ]
+
+def list_images():
     image_paths = []
     for ext in ['*.jpg', '*.jpeg', '*.png']:
         image_paths.extend(glob.glob(os.path.join(IMAGE_DIR, ext)))
+    return sorted(image_paths)
+
+def visualize_yolo(image_paths=None):
+    class_map = load_classes(CLASSES_FILE)
+    labels = LabelStore(LABEL_DIR)
+    if image_paths is None:
+        image_paths = list_images()
     
     if not image_paths:
         print(f"❌ エラー: 画像が {IMAGE_DIR} に見つかりません。")
@@ -61,13 +63,13 @@ def visualize_yolo():
     for img_path in sorted(image_paths):
         img_filename = os.path.basename(img_path)
         img_id = os.path.splitext(img_filename)[0]
-        label_path = os.path.join(LABEL_DIR, f"{img_id}.txt")
 
-        img = cv2.imread(img_path)
+        # 表示サイズ以上で最も小さい縮小率でデコードする (ラベルは正規化座標なのでそのまま描ける)
+        img, _ = load_reduced(img_path, max_size=(MAX_WIDTH, MAX_HEIGHT))
         if img is None: continue
         h, w, _ = img.shape
 
-        annos = get_yolo_annotations(label_path, w, h, class_map)
+        annos = get_yolo_annotations(labels, img_id, w, h, class_map)
         temp_img = img.copy()
 
         # 描画
@@ -98,5 +100,24 @@ def visualize_yolo():
 
     cv2.destroyAllWindows()
 
+def contact_sheet_mode(workers):
+    image_paths = list_images()
+    if not image_paths:
+        print(f"❌ エラー: 画像が {IMAGE_DIR} に見つかりません。")
+        return
+    pages = render_contact_sheets(image_paths, LABEL_DIR, load_classes(CLASSES_FILE), SHEET_DIR, workers=workers)
+    browse_contact_sheets(pages, image_paths, SHEET_DIR, WINDOW_NAME, (MAX_WIDTH, MAX_HEIGHT))
+
 if __name__ == "__main__":
-    visualize_yolo()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sheet', action='store_true', help='6×4 のサムネイル一覧ページを作ってまとめて確認する (クリックで印を付ける)')
+    parser.add_argument('--flagged', action='store_true', help='一覧で印を付けた画像だけを1枚ずつ確認する')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='サムネイル作成のプロセス数')
+    args = parser.parse_args()
+
+    if args.sheet:
+        contact_sheet_mode(args.workers)
+    elif args.flagged:
+        visualize_yolo([os.path.join(IMAGE_DIR, name) for name in load_flagged(SHEET_DIR)])
+    else:
+        visualize_yolo()
@@ -0,0 +1,173 @@
+import cv2
+import os
+import glob
+import csv
+import sys
+import time
+import queue
+import argparse
+import multiprocessing
+import numpy as np
+
+from detectors import DETECTORS, get_detector
+from model_test import IMAGE_DIR, LABEL_DIR, OUTPUT_CSV, limit_threads, child_thread_env
+
+# --- 設定 ---
+# movie_capture.py / movir_capture2.py の保存解像度と同じ (144p 〜 2160p)
+RESOLUTIONS = [
+    (256, 144), (426, 240), (640, 360), (854, 480), (1280, 720), (1920, 1080), (3840, 2160)
+]
+MODELS = ["MTCNN", "RetinaFace", "BlazeFace", "YuNet", "OpenCV_DNN", "YOLOv11", "Haar"]
+NUM_LABELED = 30    # 解像度ごとに使うラベル付き画像の枚数
+NUM_SYNTHETIC = 10  # 解像度ごとに使う合成フレームの枚数
+WARMUP = 3          # 計測前に捨てる推論回数
+MAX_BENCH_BATCH = 8 # バッチ推論のスループット計測に使う最大枚数 (4K だと 1枚 25MB)
+# 結果は model_comparison_results.csv と同じ場所に出す
+OUTPUT_BENCH_CSV = os.path.join(os.path.dirname(OUTPUT_CSV), "model_benchmark_results.csv")
+
+def peak_rss_mb():
+    """このプロセスのピーク常駐メモリ (MB)"""
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / 1024 / 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux は KB
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def labeled_image_paths(limit):
+    paths = []
+    for img_path in sorted(glob.glob(os.path.join(IMAGE_DIR, "*.[pj][pn][g]"))):
+        base_name = os.path.splitext(os.path.basename(img_path))[0]
+        if os.path.exists(os.path.join(LABEL_DIR, f"{base_name}.txt")):
+            paths.append(img_path)
+            if len(paths) >= limit: break
+    return paths
+
+def synthetic_frame(rng, size):
+    """顔を含まないノイズ+グラデーションのフレーム (検出器が最後まで走査するときのコスト)"""
+    w, h = size
+    small = rng.integers(0, 256, (max(1, h // 8), max(1, w // 8), 3), dtype=np.uint8)
+    frame = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    frame[:, :, 0] = cv2.add(frame[:, :, 0], np.linspace(0, 64, w, dtype=np.uint8)[None, :].repeat(h, axis=0))
+    return frame
+
+def iter_frames(source, size, originals, num_synthetic):
+    if source == "labeled":
+        for img in originals:
+            yield cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    else:
+        rng = np.random.default_rng(0)
+        for _ in range(num_synthetic):
+            yield synthetic_frame(rng, size)
+
+def measure(detector, frames):
+    """1枚ずつの推論レイテンシ (ms) と、バッチ推論での 枚/秒 を返す"""
+    for frame in frames[:WARMUP]:
+        detector.detect(frame)
+    latencies = []
+    for frame in frames:
+        t0 = time.perf_counter()
+        detector.detect(frame)
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    batch_size = min(detector.batch_size, MAX_BENCH_BATCH)
+    t0 = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        detector.detect_batch(frames[i:i + batch_size])
+    batched_ips = len(frames) / (time.perf_counter() - t0)
+    return np.asarray(latencies), batched_ips, batch_size
+
+def bench_model(model_name, image_paths, resolutions, num_synthetic):
+    """新しいプロセスの中で1モデルを計測する (コールドロードとピークメモリを正しく測るため)"""
+    originals = [img for img in (cv2.imread(p) for p in image_paths) if img is not None]
+
+    t0 = time.perf_counter()
+    detector = get_detector(model_name)
+    cold_load = time.perf_counter() - t0
+
+    rows = []
+    for size in resolutions:
+        for source in ["labeled", "synthetic"]:
+            # 4K だと枚数分のメモリを使うので、解像度ごとに作って捨てる
+            frames = list(iter_frames(source, size, originals, num_synthetic))
+            if not frames: continue
+            latencies, batched_ips, batch_size = measure(detector, frames)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            rows.append([model_name, source, f"{size[1]}p", f"{size[0]}x{size[1]}", len(frames),
+                         f"{cold_load:.2f}", f"{p50:.1f}", f"{p95:.1f}", f"{p99:.1f}",
+                         f"{len(frames) / (latencies.sum() / 1000):.1f}", batch_size, f"{batched_ips:.1f}",
+                         f"{peak_rss_mb():.0f}"])
+            print(f"[{model_name}] {size[1]:>4}p {source:<9} p50 {p50:7.1f} ms | p95 {p95:7.1f} ms | p99 {p99:7.1f} ms | {rows[-1][9]} 枚/秒")
+            del frames
+    return rows
+
+def bench_worker(model_name, image_paths, resolutions, num_synthetic, threads, result_queue):
+    limit_threads(threads)
+    try:
+        result_queue.put((model_name, bench_model(model_name, image_paths, resolutions, num_synthetic), None))
+    except Exception as e:
+        result_queue.put((model_name, [], str(e)))
+
+def main():
+    parser = argparse.ArgumentParser(description="検出器ごとのロード時間・レイテンシ・スループット・ピークメモリを解像度別に計測する")
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=sorted(DETECTORS), help='計測する検出器')
+    parser.add_argument('--max-height', type=int, default=2160, help='この高さまでの解像度を計測する')
+    parser.add_argument('--num-labeled', type=int, default=NUM_LABELED)
+    parser.add_argument('--num-synthetic', type=int, default=NUM_SYNTHETIC)
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='各検出器に使わせるスレッド数')
+    args = parser.parse_args()
+
+    resolutions = [res for res in RESOLUTIONS if res[1] <= args.max_height]
+    image_paths = labeled_image_paths(args.num_labeled)
+    print(f"ラベル付き画像 {len(image_paths)} 枚 + 合成フレーム {args.num_synthetic} 枚 × {len(resolutions)} 解像度で計測します。")
+
+    # 検出器ごとに新しいプロセスを起動する (前の検出器のメモリやスレッドの影響を受けないように)
+    ctx = multiprocessing.get_context("spawn")
+    all_rows = []
+    for model_name in args.models:
+        print(f"\n[{model_name}] の計測を開始します...")
+        # プロセスごとにキューを分ける (前のモデルの結果が遅れて届いても取り違えないように)
+        result_queue = ctx.Queue()
+        p = ctx.Process(target=bench_worker, args=(model_name, image_paths, resolutions, args.num_synthetic, args.threads, result_queue))
+        # BLAS のスレッド数は子が numpy を import する前に効かせる必要がある
+        with child_thread_env(args.threads):
+            p.start()
+        while True:
+            try:
+                _, rows, error = result_queue.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if p.exitcode is not None:
+                    # 終了直後に届く結果を読み切ってから異常終了と判断する
+                    try:
+                        _, rows, error = result_queue.get(timeout=1.0)
+                    except queue.Empty:
+                        rows, error = [], f"プロセスが異常終了しました (exit code {p.exitcode})"
+                    break
+        p.join()
+        if error: print(f"[{model_name}] の計測中にエラーが発生しました: {error}")
+        all_rows.extend(rows)
+
+    print(f"\n計測完了。結果を {OUTPUT_BENCH_CSV} に書き出します。")
+    with open(OUTPUT_BENCH_CSV, mode='w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Model", "Source", "Resolution", "Size", "Images", "Cold Load (s)",
+                         "p50 (ms)", "p95 (ms)", "p99 (ms)", "Images/s", "Batch Size", "Batched Images/s", "Peak RSS (MB)"])
+        writer.writerows(all_rows)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,10 @@ import cv2
 import os
 import glob
 import random
+from label_store import LabelStore, to_pixels
+from image_loader import load_reduced
+from dataset_manifest import DatasetManifest
+from contact_sheet import render_contact_sheets, browse_contact_sheets
 
 # --- 設定 ---
 IMAGE_DIR = 'reindexed_images'
@@ -12,6 +16,9 @@ WINDOW_NAME = "YOLO Annotation Verification"
 MAX_WIDTH = 1280
 MAX_HEIGHT = 720
 
+SHEET_DIR = 'contact_sheets'   # 一覧モードのページ (6×4 枚ずつ) の保存先
+SHEET_WORKERS = os.cpu_count() # サムネイル作成のプロセス数
+
 CLASS_COLORS = {}
 
 def get_unique_color(class_name):
@@ -28,47 +35,26 @@ def load_classes(file_path):
         print(f"❌ エラー: '{file_path}' が見つかりません。")
         return {}
 
-def get_yolo_annotations(label_path, img_w, img_h, class_map):
-    annotations = []
-    if not os.path.exists(label_path):
-        return []
-    with open(label_path, 'r') as f:
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) != 5: continue
-            class_id = int(parts[0])
-            x_c, y_c, w_norm, h_norm = [float(p) for p in parts[1:]]
-            x_min = int((x_c - w_norm / 2) * img_w)
-            y_min = int((y_c - h_norm / 2) * img_h)
-            x_max = int((x_c + w_norm / 2) * img_w)
-            y_max = int((y_c + h_norm / 2) * img_h)
-            annotations.append({'bbox': [x_min, y_min, x_max, y_max], 'label': class_map.get(class_id, f"ID:{class_id}")})
-    return annotations
+def get_yolo_annotations(labels, img_id, img_w, img_h, class_map):
+    class_ids, boxes = labels.get(img_id)
+    return [
+        {'bbox': bbox.tolist(), 'label': class_map.get(int(class_id), f"ID:{class_id}")}
+        for class_id, bbox in zip(class_ids, to_pixels(boxes, img_w, img_h))
+    ]
 
 def check_mismatch():
     """画像とラベルのペアをチェックして不足を羅列する"""
     print(f"\n{'='*20} 整合性チェック開始 {'='*20}")
     
-    # 全画像ファイルのベース名を取得
-    img_files = {}
-    for ext in ['*.jpg', '*.jpeg', '*.png']:
-        for p in glob.glob(os.path.join(IMAGE_DIR, ext)):
-            base = os.path.splitext(os.path.basename(p))[0]
-            img_files[base] = os.path.basename(p)
-            
-    # 全ラベルファイルのベース名を取得
-    label_files = {}
-    for p in glob.glob(os.path.join(LABEL_DIR, "*.txt")):
-        base = os.path.splitext(os.path.basename(p))[0]
-        label_files[base] = os.path.basename(p)
-        
-    img_bases = set(img_files.keys())
-    label_bases = set(label_files.keys())
+    # マニフェストから画像とラベルの対応を取得 (変更されたファイルだけ読み直す)
+    manifest = DatasetManifest(IMAGE_DIR, LABEL_DIR)
+    images = manifest.images(['.jpg', '.jpeg', '.png'])
+    img_files = {e["base"]: name for name, e in images}
     
     # 1. 画像はあるがラベルがない
-    missing_labels = sorted(list(img_bases - label_bases))
+    missing_labels = sorted({e["base"] for _, e in images if e["labels"] is None})
     # 2. ラベルはあるが画像がない
-    missing_images = sorted(list(label_bases - img_bases))
+    missing_images = manifest.orphan_labels(['.jpg', '.jpeg', '.png'])
     
     if not missing_labels and not missing_images:
         print("✅ すべてのファイルが正しくペアになっています！")
@@ -81,13 +67,18 @@ def check_mismatch():
         if missing_images:
             print(f"\n⚠️ 【画像不足】txtはあるが画像がない ({len(missing_images)}件):")
             for b in missing_images:
-                print(f"  - {label_files[b]}")
+                print(f"  - {b}.txt")
                 
     print(f"\n{'='*55}")
 
-def visualize_yolo():
+def list_images():
+    return sorted([p for ext in ['*.jpg', '*.jpeg', '*.png'] for p in glob.glob(os.path.join(IMAGE_DIR, ext))])
+
+def visualize_yolo(image_paths=None):
     class_map = load_classes(CLASSES_FILE)
-    image_paths = sorted([p for ext in ['*.jpg', '*.jpeg', '*.png'] for p in glob.glob(os.path.join(IMAGE_DIR, ext))])
+    labels = LabelStore(LABEL_DIR)
+    if image_paths is None:
+        image_paths = list_images()
     
     if not image_paths:
         print(f"❌ エラー: 画像が {IMAGE_DIR} に見つかりません。")
@@ -103,15 +94,15 @@ def visualize_yolo():
         img_path = image_paths[idx]
         img_filename = os.path.basename(img_path)
         img_id = os.path.splitext(img_filename)[0]
-        label_path = os.path.join(LABEL_DIR, f"{img_id}.txt")
 
-        img = cv2.imread(img_path)
+        # 表示サイズ以上で最も小さい縮小率でデコードする (ラベルは正規化座標なのでそのまま描ける)
+        img, _ = load_reduced(img_path, max_size=(MAX_WIDTH, MAX_HEIGHT))
         if img is None:
             idx += 1
             continue
         
         h, w, _ = img.shape
-        annos = get_yolo_annotations(label_path, w, h, class_map)
+        annos = get_yolo_annotations(labels, img_id, w, h, class_map)
         temp_img = img.copy()
 
         info_text = f"[{idx + 1} / {num_images}] {img_filename}"
@@ -148,16 +139,31 @@ def visualize_yolo():
 
     cv2.destroyAllWindows()
 
+def contact_sheet_mode():
+    """全画像をサムネイルの一覧ページにして確認し、印を付けた画像だけを1枚ずつ見直す"""
+    image_paths = list_images()
+    if not image_paths:
+        print(f"❌ エラー: 画像が {IMAGE_DIR} に見つかりません。")
+        return
+    print(f"\n--- 一覧モード開始 ({len(image_paths)} 枚) ---")
+    pages = render_contact_sheets(image_paths, LABEL_DIR, load_classes(CLASSES_FILE), SHEET_DIR, workers=SHEET_WORKERS)
+    flagged = browse_contact_sheets(pages, image_paths, SHEET_DIR, WINDOW_NAME, (MAX_WIDTH, MAX_HEIGHT))
+    if flagged and input("印を付けた画像を1枚ずつ確認しますか？ (y/n): ").strip().lower() == 'y':
+        visualize_yolo(flagged)
+
 if __name__ == "__main__":
     print("実行モードを選択してください:")
     print("1: 可視化モード (画像を一枚ずつ確認)")
     print("2: 整合性チェックモード (不足ファイルをリストアップ)")
+    print("3: 一覧モード (6×4 のサムネイルでまとめて確認)")
     
-    choice = input("選択 (1 or 2): ")
+    choice = input("選択 (1, 2 or 3): ")
     
     if choice == '1':
         visualize_yolo()
     elif choice == choice == '2':
         check_mismatch()
+    elif choice == '3':
+        contact_sheet_mode()
     else:
         print("無効な選択です。終了します。")
\ No newline at end of file
@@ -0,0 +1,194 @@
+import cv2
+import csv
+import math
+import os
+import zlib
+import multiprocessing
+import numpy as np
+from label_store import LabelStore, to_pixels
+from image_loader import load_reduced
+
+# --- 設定 ---
+GRID_COLS = 6
+GRID_ROWS = 4
+CELL_W = 300       # サムネイル1枚の大きさ (px)
+CELL_H = 200
+CAPTION_H = 20     # サムネイルの下に番号とファイル名を書く帯
+HEADER_H = 30      # ページ上部の見出し
+PAGE_QUALITY = 90
+INDEX_FILE = 'index.csv'    # ページ・マス → ファイル名 の対応
+FLAGGED_FILE = 'flagged.txt' # 一覧で印を付けた画像 (1行1ファイル名)
+FLAG_COLOR = (0, 0, 255)
+
+_worker_labels = None
+_worker_class_map = None
+
+def class_color(class_name):
+    """クラス名から決まる色 (プロセスが違っても同じ色になるようにハッシュで決める)"""
+    h = zlib.crc32(class_name.encode('utf-8'))
+    return (h & 0xFF, (h >> 8) & 0xFF, (h >> 16) & 0xFF)
+
+def init_worker(label_dir, class_map):
+    global _worker_labels, _worker_class_map
+    _worker_labels = LabelStore(label_dir, sync=False)
+    _worker_class_map = class_map
+
+def render_thumbnail(img_path, labels=None, class_map=None, cell_size=(CELL_W, CELL_H)):
+    """1枚をサムネイルに縮小してボックスを描く。読み込めない画像は灰色のマス"""
+    labels = labels if labels is not None else _worker_labels
+    class_map = class_map if class_map is not None else _worker_class_map
+    cell_w, cell_h = cell_size
+    thumb = np.full((cell_h, cell_w, 3), 64, dtype=np.uint8)
+    # マスに収まる最も小さい縮小率でデコードする
+    img, _ = load_reduced(img_path, max_size=cell_size)
+    if img is None: return thumb, 0
+
+    h, w = img.shape[:2]
+    scale = min(cell_w / w, cell_h / h)
+    tw, th = max(1, int(w * scale)), max(1, int(h * scale))
+    ox, oy = (cell_w - tw) // 2, (cell_h - th) // 2
+    thumb[oy:oy + th, ox:ox + tw] = cv2.resize(img, (tw, th), interpolation=cv2.INTER_AREA)
+
+    img_id = os.path.splitext(os.path.basename(img_path))[0]
+    class_ids, boxes = labels.get(img_id)
+    for class_id, (x1, y1, x2, y2) in zip(class_ids, to_pixels(boxes, tw, th).tolist()):
+        name = class_map.get(int(class_id), f"ID:{class_id}")
+        color = class_color(name)
+        cv2.rectangle(thumb, (ox + x1, oy + y1), (ox + x2, oy + y2), color, 1)
+        cv2.putText(thumb, name, (ox + x1, max(10, oy + y1 - 2)), cv2.FONT_HERSHEY_SIMPLEX, 0.35, color, 1, cv2.LINE_AA)
+    return thumb, len(class_ids)
+
+def _render_task(args):
+    idx, img_path = args
+    try:
+        thumb, count = render_thumbnail(img_path)
+    except Exception as e:
+        print(f"⚠️ サムネイル作成失敗: {img_path} ({e})")
+        thumb, count = np.full((CELL_H, CELL_W, 3), 64, dtype=np.uint8), 0
+    return idx, thumb, count
+
+def page_size(cols=GRID_COLS, rows=GRID_ROWS):
+    return cols * CELL_W, HEADER_H + rows * (CELL_H + CAPTION_H)
+
+def cell_origin(cell, cols=GRID_COLS):
+    return (cell % cols) * CELL_W, HEADER_H + (cell // cols) * (CELL_H + CAPTION_H)
+
+def cell_at(x, y, cols=GRID_COLS, rows=GRID_ROWS):
+    """ページ上の座標 → マス番号 (マスの外なら None)"""
+    if y < HEADER_H: return None
+    col, row = int(x // CELL_W), int((y - HEADER_H) // (CELL_H + CAPTION_H))
+    if not (0 <= col < cols and 0 <= row < rows): return None
+    return row * cols + col
+
+def new_page(page_no, num_pages, first, last, total, cols=GRID_COLS, rows=GRID_ROWS):
+    page_w, page_h = page_size(cols, rows)
+    page = np.zeros((page_h, page_w, 3), dtype=np.uint8)
+    cv2.putText(page, f"Page {page_no}/{num_pages}  #{first}-{last} / {total}", (10, 21),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 1, cv2.LINE_AA)
+    return page
+
+def render_contact_sheets(image_paths, label_dir, class_map, out_dir, cols=GRID_COLS, rows=GRID_ROWS, workers=None):
+    """画像を cols × rows のマスに並べたページを out_dir に保存する。
+    サムネイルの作成 (縮小デコード + 描画) はプロセスプールで行い、ページの組み立てと保存はメインプロセスで行う。
+    保存したページのパスのリストを返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    LabelStore(label_dir) # 索引を最新にしておく (ワーカーは同期せずに読むだけ)
+    per_page = cols * rows
+    total = len(image_paths)
+    num_pages = math.ceil(total / per_page)
+    workers = workers or os.cpu_count() or 1
+    page_paths = []
+    rows_out = []
+    page = None
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(label_dir, class_map)) as pool:
+        tasks = list(enumerate(image_paths))
+        for idx, thumb, count in pool.imap(_render_task, tasks, chunksize=max(1, per_page // workers)):
+            page_no, cell = idx // per_page + 1, idx % per_page
+            if cell == 0:
+                page = new_page(page_no, num_pages, idx + 1, min(total, idx + per_page), total, cols, rows)
+            x, y = cell_origin(cell, cols)
+            page[y:y + CELL_H, x:x + CELL_W] = thumb
+            file_name = os.path.basename(image_paths[idx])
+            caption = f"{idx + 1} {file_name}" if count else f"{idx + 1} {file_name} (no label)"
+            cv2.putText(page, caption, (x + 4, y + CELL_H + 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4,
+                        (255, 255, 255) if count else (0, 200, 255), 1, cv2.LINE_AA)
+            rows_out.append([page_no, cell, idx + 1, file_name, count])
+
+            if cell == per_page - 1 or idx == total - 1:
+                page_path = os.path.join(out_dir, f"page_{page_no:04d}.jpg")
+                cv2.imwrite(page_path, page, [cv2.IMWRITE_JPEG_QUALITY, PAGE_QUALITY])
+                page_paths.append(page_path)
+                print(f"\r📄 {page_no}/{num_pages} ページ", end="")
+    print()
+
+    with open(os.path.join(out_dir, INDEX_FILE), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Page", "Cell", "No", "File", "Labels"])
+        writer.writerows(rows_out)
+    return page_paths
+
+def load_flagged(out_dir):
+    path = os.path.join(out_dir, FLAGGED_FILE)
+    if not os.path.exists(path): return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def browse_contact_sheets(page_paths, image_paths, out_dir, window_name, max_size, cols=GRID_COLS, rows=GRID_ROWS):
+    """ページを1枚ずつ表示する。クリックで印を付け (もう一度クリックで外す)、印を付けた画像を flagged.txt に保存する。
+    印を付けた画像のパスのリストを返す"""
+    per_page = cols * rows
+    flagged = set(load_flagged(out_dir))
+    state = {'page': 0, 'scale': 1.0, 'dirty': True}
+
+    def on_mouse(event, x, y, flags, param):
+        if event != cv2.EVENT_LBUTTONDOWN: return
+        cell = cell_at(x / state['scale'], y / state['scale'], cols, rows)
+        idx = state['page'] * per_page + cell if cell is not None else None
+        if idx is None or idx >= len(image_paths): return
+        file_name = os.path.basename(image_paths[idx])
+        flagged.symmetric_difference_update({file_name})
+        state['dirty'] = True
+
+    cv2.namedWindow(window_name)
+    cv2.setMouseCallback(window_name, on_mouse)
+    print("D or Space: 次のページ / A: 前のページ / クリック: 印を付ける・外す / Q: 終了")
+    page_img = None
+    loaded_page = None
+    while 0 <= state['page'] < len(page_paths):
+        if loaded_page != state['page']:
+            page_img = cv2.imread(page_paths[state['page']])
+            loaded_page = state['page']
+            state['dirty'] = True
+        if state['dirty']:
+            disp = page_img.copy()
+            first = state['page'] * per_page
+            for cell in range(per_page):
+                idx = first + cell
+                if idx < len(image_paths) and os.path.basename(image_paths[idx]) in flagged:
+                    x, y = cell_origin(cell, cols)
+                    cv2.rectangle(disp, (x + 1, y + 1), (x + CELL_W - 2, y + CELL_H + CAPTION_H - 2), FLAG_COLOR, 3)
+            h, w = disp.shape[:2]
+            state['scale'] = min(max_size[0] / w, max_size[1] / h, 1.0)
+            if state['scale'] < 1.0:
+                disp = cv2.resize(disp, (int(w * state['scale']), int(h * state['scale'])), interpolation=cv2.INTER_AREA)
+            cv2.imshow(window_name, disp)
+            state['dirty'] = False
+
+        key = cv2.waitKey(30) & 0xFF
+        if key == ord('q'):
+            break
+        elif key == ord('a'):
+            state['page'] = max(0, state['page'] - 1)
+        elif key in (ord('d'), ord(' ')):
+            if state['page'] + 1 >= len(page_paths):
+                print("すべてのページの確認が終了しました。")
+                break
+            state['page'] += 1
+    cv2.destroyAllWindows()
+
+    flagged_paths = [p for p in image_paths if os.path.basename(p) in flagged]
+    with open(os.path.join(out_dir, FLAGGED_FILE), 'w', encoding='utf-8') as f:
+        f.writelines(os.path.basename(p) + "\n" for p in flagged_paths)
+    print(f"🚩 印を付けた画像: {len(flagged_paths)} 件 ({os.path.join(out_dir, FLAGGED_FILE)})")
+    return flagged_paths
@@ -0,0 +1,105 @@
+import cv2
+import queue
+import threading
+from collections import OrderedDict
+from image_loader import load_reduced
+
+# --- 設定 ---
+DEFAULT_CACHE_MB = 1024 # デコード済み画像を保持する上限
+DEFAULT_READAHEAD = 8 # バックグラウンドで先読みする枚数
+
+_END = object()
+
+class LazyImageDataset:
+    """画像を必要になった時点でデコードするデータセット。
+    反復すると (base_name, img_bgr, h, w) を返すので、全画像を読み込んだリストの代わりに使える。
+    デコード済み画像はメモリ上限つきの LRU キャッシュに置き、次の数枚は別スレッドで先読みする。
+    min_size を指定すると、その大きさを下回らない範囲で縮小デコードする (h, w は縮小後の値)。"""
+
+    def __init__(self, items, cache_mb=DEFAULT_CACHE_MB, readahead=DEFAULT_READAHEAD, min_size=None):
+        self.items = list(items) # [(base_name, img_path), ...]
+        self.paths = dict(self.items)
+        self.min_size = min_size
+        self.cache_bytes = cache_mb * 1024 * 1024
+        self.readahead = max(1, readahead)
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def decode(self, path):
+        if self.min_size:
+            return load_reduced(path, min_size=self.min_size)[0]
+        return cv2.imread(path)
+
+    def reduced(self, min_size):
+        """同じ画像一覧で、縮小デコードするデータセットを作る"""
+        return LazyImageDataset(self.items, self.cache_bytes // (1024 * 1024), self.readahead, min_size)
+
+    def load(self, index):
+        """1枚読み込む。デコードに失敗した場合は None"""
+        base_name, path = self.items[index]
+        with self.lock:
+            if base_name in self.cache:
+                self.cache.move_to_end(base_name)
+                return self.cache[base_name]
+
+        img_bgr = self.decode(path)
+        if img_bgr is None: return None
+        h, w = img_bgr.shape[:2]
+        entry = (base_name, img_bgr, h, w)
+
+        with self.lock:
+            if base_name not in self.cache and img_bgr.nbytes <= self.cache_bytes:
+                self.cache[base_name] = entry
+                self.cached_bytes += img_bgr.nbytes
+                # 上限を超えたら古いものから捨てる
+                while self.cached_bytes > self.cache_bytes:
+                    _, (_, old_img, _, _) = self.cache.popitem(last=False)
+                    self.cached_bytes -= old_img.nbytes
+        return entry
+
+    def __iter__(self):
+        q = queue.Queue(self.readahead)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def producer():
+            for i in range(len(self.items)):
+                if stop.is_set(): return
+                try:
+                    entry = self.load(i)
+                except Exception as e:
+                    print(f"読み込み失敗: {self.items[i][1]} ({e})")
+                    entry = None
+                if entry is not None: put(entry)
+            put(_END)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                entry = q.get()
+                if entry is _END: break
+                yield entry
+        finally:
+            # 途中で反復をやめた場合も先読みスレッドを止める
+            stop.set()
+
+    def batches(self, batch_size):
+        batch = []
+        for entry in self:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch: yield batch
@@ -0,0 +1,122 @@
+import json
+import os
+import sys
+import time
+from PIL import Image
+from label_store import LabelStore
+from prediction_cache import image_hash
+
+# --- 設定 ---
+MANIFEST_FILE = ".dataset_manifest.json" # 画像フォルダ内に置く
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+def read_image_size(path):
+    """ヘッダだけ読んで (幅, 高さ) を返す (画素はデコードしない)"""
+    with Image.open(path) as img:
+        return img.size
+
+class DatasetManifest:
+    """画像フォルダの一覧 (パス・サイズ・縦横・内容ハッシュ・mtime・ラベル数) を保存しておく。
+    sync() では mtime / サイズが変わった画像だけ読み直すので、2回目以降はフォルダの走査だけで済む。
+    persist=False ならマニフェストもラベル索引も保存しない (ドライラン用)。"""
+
+    def __init__(self, image_dir, label_dir=None, with_hash=True, sync=True, persist=True):
+        self.image_dir = image_dir
+        self.label_dir = label_dir
+        self.with_hash = with_hash
+        self.persist = persist
+        self.path = os.path.join(image_dir, MANIFEST_FILE)
+        self.entries = {} # {ファイル名: {...}}
+        self.labels = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f).get("images", {})
+            except (OSError, ValueError) as e:
+                print(f"⚠️ マニフェストを読み込めませんでした。作り直します: {self.path} ({e})")
+        if sync: self.sync()
+
+    def sync(self):
+        """追加・変更・削除された画像を反映する。読み直した枚数を返す"""
+        found = {}
+        if os.path.isdir(self.image_dir):
+            with os.scandir(self.image_dir) as it:
+                for entry in it:
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        found[entry.name] = entry
+
+        rescanned = 0
+        entries = {}
+        for name, entry in found.items():
+            st = entry.stat()
+            old = self.entries.get(name)
+            if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns and (old["hash"] or not self.with_hash):
+                entries[name] = old
+                continue
+            try:
+                width, height = read_image_size(entry.path)
+            except Exception as e:
+                print(f"⚠️ 画像を読み込めません: {entry.path} ({e})")
+                width, height = None, None
+            entries[name] = {
+                "base": os.path.splitext(name)[0],
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "width": width,
+                "height": height,
+                "hash": image_hash(entry.path) if self.with_hash else None,
+                "labels": None,
+            }
+            rescanned += 1
+
+        # ラベル数はラベル索引 (mtime で同期済み) から埋める
+        if self.label_dir is not None:
+            self.labels = LabelStore(self.label_dir, persist=self.persist)
+            counts = self.labels.counts()
+            for e in entries.values():
+                i = self.labels.lookup.get(e["base"])
+                e["labels"] = int(counts[i]) if i is not None else None
+
+        changed = rescanned > 0 or set(entries) != set(self.entries) or any(
+            entries[n]["labels"] != self.entries[n].get("labels") for n in entries if n in self.entries
+        )
+        self.entries = entries
+        if changed and self.persist: self.save()
+        return rescanned
+
+    def save(self):
+        if not os.path.isdir(self.image_dir): return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"image_dir": os.path.abspath(self.image_dir), "label_dir": self.label_dir, "images": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def images(self, exts=None):
+        """[(ファイル名, エントリ), ...] をファイル名順に返す。exts で拡張子を絞り込める"""
+        exts = {e.lower() for e in exts} if exts else None
+        return [(name, e) for name, e in sorted(self.entries.items())
+                if exts is None or os.path.splitext(name)[1].lower() in exts]
+
+    def image_paths(self, exts=None):
+        return [os.path.join(self.image_dir, name) for name, _ in self.images(exts)]
+
+    def pairs(self, exts=None):
+        """ラベルがある画像だけ [(base_name, 画像パス), ...]"""
+        return [(e["base"], os.path.join(self.image_dir, name)) for name, e in self.images(exts) if e["labels"] is not None]
+
+    def orphan_labels(self, exts=None):
+        """画像がないラベルの base_name"""
+        if self.labels is None: return []
+        bases = {e["base"] for _, e in self.images(exts)}
+        return sorted(n for n in self.labels.names if n not in bases)
+
+    def image_size(self, file_name):
+        e = self.entries[file_name]
+        return e["width"], e["height"]
+
+if __name__ == "__main__":
+    image_dir = sys.argv[1] if len(sys.argv) > 1 else 'reindexed_images'
+    label_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    t0 = time.perf_counter()
+    manifest = DatasetManifest(image_dir, label_dir)
+    print(f"{image_dir}: 画像 {len(manifest.entries)} 件 / ラベル付き {len(manifest.pairs())} 件 ({(time.perf_counter() - t0) * 1000:.1f} ms)")
@@ -0,0 +1,291 @@
+import cv2
+import numpy as np
+import os
+import urllib.request
+
+os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
+
+# --- モデルファイル ---
+YUNET_MODEL = "face_detection_yunet_2023mar.onnx"
+YUNET_URL = "https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/face_detection_yunet_2023mar.onnx"
+BLAZEFACE_MODEL = "blaze_face_short_range.tflite"
+BLAZEFACE_URL = "https://storage.googleapis.com/mediapipe-models/face_detector/blaze_face_short_range/float16/1/blaze_face_short_range.tflite"
+DNN_PROTOTXT = "deploy.prototxt"
+DNN_PROTOTXT_URL = "https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt"
+DNN_CAFFEMODEL = "res10_300x300_ssd_iter_140000.caffemodel"
+DNN_CAFFEMODEL_URL = "https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20170830/res10_300x300_ssd_iter_140000.caffemodel"
+YOLO_MODEL = "yolov11n-face.pt"
+
+def download_model_file(url, filename):
+    if not os.path.exists(filename):
+        print(f"[{filename}] をダウンロード中...")
+        try:
+            urllib.request.urlretrieve(url, filename)
+            print(f"ダウンロード完了: {filename}")
+        except Exception as e:
+            print(f"ダウンロード失敗: {filename} ({e})")
+
+def to_arrays(boxes, scores):
+    """検出結果を (N, 4) の正規化 xyxy と (N,) のスコアにそろえる"""
+    return np.asarray(boxes, dtype=np.float32).reshape(-1, 4), np.asarray(scores, dtype=np.float32).reshape(-1)
+
+# =========================================================
+# 検出器の共通インターフェース
+# =========================================================
+
+class Detector:
+    """各検出器は load() で一度だけモデルを読み込み、detect_batch() で何度でも使い回す。
+    detect_batch(frames) は BGR 画像のリストを受け取り、画像ごとに (boxes, scores) を返す。"""
+    name = None
+    version = "1"
+    batch_size = 1 # 1回の detect_batch() にまとめる枚数の既定値
+    input_size = None # モデルが内部で縮小する入力サイズ (これより大きくデコードしても結果はほぼ変わらない)
+    defaults = {} # パラメータの既定値 (予測キャッシュのキーにも含める)
+    score_param = None # 推論後にスコアで絞り込むパラメータ名 (キャッシュには絞り込む前の結果を置く)
+
+    def __init__(self, **params):
+        self.params = self.resolve_params(**params)
+        self.model = None
+
+    @classmethod
+    def resolve_params(cls, **params):
+        return {**cls.defaults, **params}
+
+    @classmethod
+    def cache_params(cls, **params):
+        """予測キャッシュのキーにするパラメータ (推論後の絞り込みは含めない)"""
+        resolved = cls.resolve_params(**params)
+        resolved.pop(cls.score_param, None)
+        return resolved
+
+    @classmethod
+    def filter_raw(cls, boxes, scores, **params):
+        """detect_batch_raw() の結果 (キャッシュしたもの) に推論後の絞り込みをかける"""
+        if cls.score_param is None: return boxes, scores
+        keep = scores > cls.resolve_params(**params)[cls.score_param]
+        return boxes[keep], scores[keep]
+
+    def load(self):
+        raise NotImplementedError
+
+    def detect(self, frame):
+        raise NotImplementedError
+
+    def detect_batch(self, frames):
+        return [self.detect(frame) for frame in frames]
+
+    def detect_batch_raw(self, frames):
+        """score_param で絞り込む前の結果 (score_param がない検出器は detect_batch と同じ)"""
+        return self.detect_batch(frames)
+
+    def close(self):
+        self.model = None
+
+class MTCNNDetector(Detector):
+    name = "MTCNN"
+
+    def load(self):
+        from mtcnn import MTCNN
+        self.model = MTCNN()
+
+    def detect(self, frame):
+        h, w = frame.shape[:2]
+        try:
+            detections = self.model.detect_faces(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        except Exception:
+            detections = []
+        boxes = [[x/w, y/h, (x+bw)/w, (y+bh)/h] for det in detections for x, y, bw, bh in [det['box']]]
+        return to_arrays(boxes, [det['confidence'] for det in detections])
+
+class RetinaFaceDetector(Detector):
+    name = "RetinaFace"
+    defaults = {'threshold': 0.9}
+
+    def load(self):
+        from retinaface import RetinaFace
+        self.api = RetinaFace
+        self.model = RetinaFace.build_model()
+
+    def detect(self, frame):
+        h, w = frame.shape[:2]
+        detections = self.api.detect_faces(frame, model=self.model, threshold=self.params['threshold'])
+        boxes, scores = [], []
+        if type(detections) == dict:
+            for det in detections.values():
+                x1, y1, x2, y2 = det["facial_area"]
+                boxes.append([x1/w, y1/h, x2/w, y2/h])
+                scores.append(det.get("score", 1.0))
+        return to_arrays(boxes, scores)
+
+class BlazeFaceDetector(Detector):
+    name = "BlazeFace"
+    input_size = (128, 128) # short range モデル
+    defaults = {'min_detection_confidence': 0.5}
+
+    def load(self):
+        import mediapipe as mp
+        from mediapipe.tasks import python as mp_python
+        from mediapipe.tasks.python import vision as mp_vision
+        download_model_file(BLAZEFACE_URL, BLAZEFACE_MODEL)
+        if not os.path.exists(BLAZEFACE_MODEL):
+            raise FileNotFoundError(f"{BLAZEFACE_MODEL} がありません。")
+        self.mp = mp
+        options = mp_vision.FaceDetectorOptions(
+            base_options=mp_python.BaseOptions(model_asset_path=BLAZEFACE_MODEL),
+            min_detection_confidence=self.params['min_detection_confidence']
+        )
+        self.model = mp_vision.FaceDetector.create_from_options(options)
+
+    def detect(self, frame):
+        h, w = frame.shape[:2]
+        mp_image = self.mp.Image(image_format=self.mp.ImageFormat.SRGB, data=cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        boxes, scores = [], []
+        for det in self.model.detect(mp_image).detections:
+            bb = det.bounding_box
+            boxes.append([bb.origin_x / w, bb.origin_y / h, (bb.origin_x + bb.width) / w, (bb.origin_y + bb.height) / h])
+            scores.append(det.categories[0].score if det.categories else 1.0)
+        return to_arrays(boxes, scores)
+
+    def close(self):
+        if self.model is not None: self.model.close()
+        self.model = None
+
+class YuNetDetector(Detector):
+    name = "YuNet"
+    defaults = {'score_threshold': 0.9}
+
+    def load(self):
+        download_model_file(YUNET_URL, YUNET_MODEL)
+        if not os.path.exists(YUNET_MODEL):
+            raise FileNotFoundError(f"{YUNET_MODEL} が見つかりません。")
+        self.model = cv2.FaceDetectorYN.create(YUNET_MODEL, "", (320, 320), self.params['score_threshold'])
+        self._input_wh = None # setInputSize() 済みの (幅, 高さ)。クラスの input_size (縮小デコード用) とは別
+
+    def detect(self, frame):
+        h, w = frame.shape[:2]
+        if self._input_wh != (w, h):
+            self.model.setInputSize((w, h))
+            self._input_wh = (w, h)
+        _, results = self.model.detect(frame)
+        boxes, scores = [], []
+        if results is not None:
+            for face in results:
+                x, y, bw, bh = face[:4]
+                boxes.append([x/w, y/h, (x+bw)/w, (y+bh)/h])
+                scores.append(face[14])
+        return to_arrays(boxes, scores)
+
+class OpenCVDNNDetector(Detector):
+    name = "OpenCV_DNN"
+    version = "2" # キャッシュに絞り込む前のスコアを置くようにした
+    batch_size = 32
+    input_size = (300, 300)
+    defaults = {'conf_threshold': 0.5}
+    score_param = 'conf_threshold'
+
+    def load(self):
+        download_model_file(DNN_PROTOTXT_URL, DNN_PROTOTXT)
+        download_model_file(DNN_CAFFEMODEL_URL, DNN_CAFFEMODEL)
+        if not os.path.exists(DNN_PROTOTXT) or not os.path.exists(DNN_CAFFEMODEL):
+            raise FileNotFoundError("OpenCV DNNのモデルファイルが見つかりません。")
+        self.model = cv2.dnn.readNetFromCaffe(DNN_PROTOTXT, DNN_CAFFEMODEL)
+
+    def detect(self, frame):
+        return self.detect_batch([frame])[0]
+
+    def detect_batch(self, frames):
+        return [self.filter_raw(boxes, scores, **self.params) for boxes, scores in self.detect_batch_raw(frames)]
+
+    def detect_batch_raw(self, frames):
+        if not frames: return []
+        # 300x300 に縮小した画像を1つの4次元 blob にまとめ、forward() は1回だけ呼ぶ
+        blob = cv2.dnn.blobFromImages([cv2.resize(f, (300, 300)) for f in frames], 1.0, (300, 300), (104.0, 177.0, 123.0))
+        self.model.setInput(blob)
+        return self._split_detections(self.model.forward(), len(frames))
+
+    def _split_detections(self, detections, num_images):
+        # DetectionOutput の各行は [画像番号, クラス, スコア, x1, y1, x2, y2] (スコアでの絞り込みは filter_raw で行う)
+        rows = detections.reshape(-1, 7)
+        outputs = []
+        for i in range(num_images):
+            r = rows[rows[:, 0] == i]
+            boxes = np.stack([
+                np.maximum(0.0, r[:, 3]), np.maximum(0.0, r[:, 4]),
+                np.minimum(1.0, r[:, 5]), np.minimum(1.0, r[:, 6])
+            ], axis=1)
+            outputs.append(to_arrays(boxes, r[:, 2]))
+        return outputs
+
+class YOLODetector(Detector):
+    name = "YOLOv11"
+    batch_size = 16
+    defaults = {'model_path': YOLO_MODEL}
+
+    def load(self):
+        from ultralytics import YOLO
+        model_path = self.params['model_path']
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"{model_path} が見つかりません。")
+        self.model = YOLO(model_path)
+
+    def detect(self, frame):
+        return self.detect_batch([frame])[0]
+
+    def detect_batch(self, frames):
+        if not frames: return []
+        # リストで渡すと ultralytics 側で1つのバッチとして推論される
+        results = self.model(list(frames), verbose=False, batch=len(frames))
+        return [to_arrays(r.boxes.xyxyn.tolist(), r.boxes.conf.tolist()) for r in results]
+
+class HaarDetector(Detector):
+    name = "Haar"
+    defaults = {'scale_factor': 1.1, 'min_neighbors': 20, 'min_size': (50, 50)}
+
+    def load(self):
+        self.frontal = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        self.profile = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+        self.model = (self.frontal, self.profile)
+
+    def detect(self, frame):
+        h, w = frame.shape[:2]
+        scale_factor = self.params['scale_factor']
+        min_neighbors = self.params['min_neighbors']
+        min_size = self.params['min_size']
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        rects = list(self.frontal.detectMultiScale(gray, scale_factor, min_neighbors, minSize=min_size))
+        rects += list(self.profile.detectMultiScale(gray, scale_factor, min_neighbors, minSize=min_size))
+        # 左右反転画像で見つかった横顔は座標を元に戻す
+        for x, y, bw, bh in self.profile.detectMultiScale(cv2.flip(gray, 1), scale_factor, min_neighbors, minSize=min_size):
+            rects.append((w - x - bw, y, bw, bh))
+        boxes = [[x/w, y/h, (x+bw)/w, (y+bh)/h] for x, y, bw, bh in rects]
+        return to_arrays(boxes, [1.0] * len(boxes))
+
+    def close(self):
+        self.frontal = self.profile = self.model = None
+
+# =========================================================
+# レジストリ
+# =========================================================
+
+DETECTORS = {cls.name: cls for cls in [
+    MTCNNDetector, RetinaFaceDetector, BlazeFaceDetector, YuNetDetector, OpenCVDNNDetector, YOLODetector, HaarDetector
+]}
+
+_loaded = {}
+
+def get_detector(name, **params):
+    """読み込み済みの検出器を返す (同じ名前・パラメータなら使い回す)"""
+    key = (name, tuple(sorted(params.items())))
+    if key not in _loaded:
+        detector = DETECTORS[name](**params)
+        detector.load()
+        _loaded[key] = detector
+    return _loaded[key]
+
+def release_detector(name):
+    for key in [k for k in _loaded if k[0] == name]:
+        _loaded.pop(key).close()
+
+def release_all():
+    for detector in _loaded.values(): detector.close()
+    _loaded.clear()
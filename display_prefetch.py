@@ -0,0 +1,107 @@
+import cv2
+import threading
+from collections import OrderedDict
+from PIL import Image
+from image_loader import load_reduced
+from dataset_manifest import read_image_size
+
+# --- 設定 ---
+DEFAULT_CACHE_MB = 512 # 表示用画像を保持する上限
+DEFAULT_RADIUS = 3     # 現在の画像の前後何枚を先読みするか
+
+class DisplayEntry:
+    """表示サイズに縮小済みの画像 (PIL Image) と元画像のサイズ"""
+
+    def __init__(self, image, orig_w, orig_h, scale_factor):
+        self.image = image # 読み込めなかった場合は None
+        self.orig_w = orig_w
+        self.orig_h = orig_h
+        self.scale_factor = scale_factor
+        self.nbytes = image.width * image.height * 3 if image is not None else 0
+
+def prepare_display(path, max_size, size=None, img_hash=None):
+    """縮小デコード → RGB 変換 → 表示サイズへの縮小 までを行う (PhotoImage の作成だけはメインスレッド)"""
+    if size is None or not all(size):
+        size = read_image_size(path)
+    img_bgr, _ = load_reduced(path, max_size=max_size, size=size, img_hash=img_hash)
+    if img_bgr is None: return DisplayEntry(None, 0, 0, 1.0)
+    w, h = size
+    scale_factor = min(max_size[0] / w, max_size[1] / h, 1.0)
+    display_w, display_h = int(w * scale_factor), int(h * scale_factor)
+    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+    if (img_rgb.shape[1], img_rgb.shape[0]) != (display_w, display_h):
+        img_rgb = cv2.resize(img_rgb, (display_w, display_h), interpolation=cv2.INTER_AREA)
+    return DisplayEntry(Image.fromarray(img_rgb), w, h, scale_factor)
+
+class DisplayPrefetcher:
+    """現在の画像の前後を別スレッドで用意し、メモリ上限つきの LRU に置いておく。
+    get() はブロックしない。まだ用意できていなければ None を返すので、呼び出し側は少し待って再試行する。"""
+
+    def __init__(self, image_paths, max_size, size_of=None, cache_mb=DEFAULT_CACHE_MB, radius=DEFAULT_RADIUS):
+        self.image_paths = image_paths
+        self.max_size = max_size
+        self.size_of = size_of # path -> (幅, 高さ) (マニフェストから)
+        self.cache_bytes = cache_mb * 1024 * 1024
+        self.radius = radius
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.center = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def request(self, idx):
+        """idx を中心に先読みし直す"""
+        with self.lock:
+            if idx == self.center: return
+            self.center = idx
+        self.wake.set()
+
+    def get(self, idx):
+        with self.lock:
+            entry = self.cache.get(idx)
+            if entry is not None: self.cache.move_to_end(idx)
+            return entry
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+
+    def _order(self, center):
+        # 現在 → 次 → 前 → 2つ先 → 2つ前 ... の順に用意する (次へ進むことが多いので先を優先)
+        order = [center]
+        for d in range(1, self.radius + 1):
+            order += [center + d, center - d]
+        return [i for i in order if 0 <= i < len(self.image_paths)]
+
+    def _run(self):
+        while not self.stopped:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock: center = self.center
+            for idx in self._order(center):
+                if self.stopped or self.wake.is_set(): break # 移動したら新しい位置から用意し直す
+                with self.lock:
+                    if idx in self.cache: continue
+                path = self.image_paths[idx]
+                try:
+                    entry = prepare_display(path, self.max_size,
+                                            self.size_of(path) if self.size_of else None)
+                except Exception as e:
+                    print(f"読み込み失敗: {path} ({e})")
+                    entry = DisplayEntry(None, 0, 0, 1.0)
+                self._put(idx, entry)
+
+    def _put(self, idx, entry):
+        with self.lock:
+            self.cache[idx] = entry
+            self.cached_bytes += entry.nbytes
+            # 上限を超えたら古いものから捨てる (今表示している画像は残す)
+            while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                old_idx = next(iter(self.cache))
+                if old_idx == self.center:
+                    self.cache.move_to_end(old_idx)
+                    continue
+                self.cached_bytes -= self.cache.pop(old_idx).nbytes
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from index_allocator import file_lock
+
+# --- 設定 ---
+MANIFEST_FILE = 'drive_manifest.json'
+RECONCILE_INTERVAL_SEC = 24 * 60 * 60 # この間隔で Drive 側の一覧と突き合わせる
+PAGE_SIZE = 1000
+SAVE_EVERY = 50         # 変更がこの件数たまったらディスクに書く
+SAVE_INTERVAL_SEC = 30  # または前回の保存からこの秒数が経ったら書く (残りは flush() で)
+
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class DriveManifest:
+    """ファイル名 → Drive のファイルID・md5 の対応表をローカルに保存する。
+    これがあれば新規ファイルは検索なしで作成し、内容が同じファイルは送信自体を省ける。"""
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.reconciled_at = 0
+        self._dirty = {}
+        self._removed = set()
+        self._saved_at = time.time()
+        data = self._load()
+        self.entries = data.get('files', {})
+        self.reconciled_at = data.get('reconciled_at', 0)
+
+    def _load(self):
+        if not os.path.exists(self.path): return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"  [Info] {self.path} を読み込めません。Drive と再照合します。")
+            return {}
+
+    def _write(self, data):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def set(self, name, file_id, md5):
+        with self.lock:
+            self.entries[name] = self._dirty[name] = {'id': file_id, 'md5': md5}
+            self._removed.discard(name)
+            self._maybe_save_locked()
+
+    def remove(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+            self._dirty.pop(name, None)
+            self._removed.add(name)
+            self._maybe_save_locked()
+
+    def flush(self):
+        """まだ書いていない変更をディスクに反映する"""
+        with self.lock:
+            if self._dirty or self._removed: self._save_locked()
+
+    def _maybe_save_locked(self):
+        # 1件ごとに全体を読み書きすると件数の2乗になるので、まとめて保存する
+        if len(self._dirty) + len(self._removed) >= SAVE_EVERY or time.time() - self._saved_at > SAVE_INTERVAL_SEC:
+            self._save_locked()
+
+    def _save_locked(self, listed=None):
+        # 他プロセスが書いた分を消さないよう、ディスク上の内容に差分だけを反映する
+        with file_lock(self.path):
+            data = self._load()
+            files = data.get('files', {})
+            if listed is not None: files.update(listed)
+            files.update(self._dirty)
+            for name in self._removed: files.pop(name, None)
+            data['files'] = files
+            data['reconciled_at'] = max(data.get('reconciled_at', 0), self.reconciled_at)
+            self._write(data)
+        self.entries = files
+        self._dirty.clear()
+        self._removed.clear()
+        self._saved_at = time.time()
+
+    def needs_reconcile(self):
+        return time.time() - self.reconciled_at > RECONCILE_INTERVAL_SEC
+
+    def reconcile(self, service, folder_id):
+        """フォルダ内の全ファイルをページ単位で一括取得し、対応表に反映する。
+        一覧にないエントリは消さない (取得中に他プロセスがアップロードした分がありうるため。
+        Drive 側で消えていたものは更新時の 404 で作り直す)"""
+        query = "trashed = false"
+        if folder_id:
+            query += f" and '{folder_id}' in parents"
+        files = {}
+        page_token = None
+        while True:
+            results = service.files().list(
+                q=query, pageSize=PAGE_SIZE, pageToken=page_token,
+                fields="nextPageToken, files(id, name, md5Checksum)"
+            ).execute()
+            for item in results.get('files', []):
+                # 同名が複数ある場合は最初に見つかったものを使う
+                files.setdefault(item['name'], {'id': item['id'], 'md5': item.get('md5Checksum')})
+            page_token = results.get('nextPageToken')
+            if not page_token: break
+
+        with self.lock:
+            self.reconciled_at = time.time()
+            self._save_locked(listed=files)
+        print(f"  -> Drive照合完了: {len(files)} 件")
+
+def reconcile_before_workers(service_factory, folder_id, path=MANIFEST_FILE):
+    """--workers で並列に動かす前に親プロセスで一度だけ照合しておく (各ワーカーが一覧を取り直さないように)"""
+    manifest = DriveManifest(path)
+    if manifest.needs_reconcile():
+        manifest.reconcile(service_factory(), folder_id)
@@ -0,0 +1,164 @@
+import os
+import json
+import queue
+import random
+import threading
+import time
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+from drive_manifest import DriveManifest, file_md5
+
+# --- 設定 ---
+MAX_QUEUE_SIZE = 32 # これ以上溜まるとキャプチャ側の submit() が待つ
+MAX_RETRIES = 5
+BACKOFF_BASE_SEC = 2.0
+BACKOFF_MAX_SEC = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'} # 403 のうち再試行してよいもの
+
+def upload_or_update(service, file_name, folder_id, mimetype='image/jpeg', manifest=None):
+    """1ファイルを Drive へ送る。同名ファイルがあれば更新、なければ新規作成"""
+    if manifest is not None:
+        return upload_with_manifest(service, file_name, folder_id, mimetype, manifest)
+    query = f"name = '{file_name}' and trashed = false"
+    if folder_id:
+        query += f" and '{folder_id}' in parents"
+    results = service.files().list(q=query, fields="files(id, name)").execute()
+    items = results.get('files', [])
+    media = MediaFileUpload(file_name, mimetype=mimetype, resumable=True)
+    if items:
+        service.files().update(fileId=items[0]['id'], media_body=media).execute()
+        return 'update'
+    file_metadata = {'name': file_name}
+    if folder_id:
+        file_metadata['parents'] = [folder_id]
+    service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    return 'create'
+
+def upload_with_manifest(service, file_name, folder_id, mimetype, manifest):
+    """ローカルの対応表で更新/新規を判断し、Drive 側の検索を省く"""
+    md5 = file_md5(file_name)
+    entry = manifest.get(file_name)
+    if entry and entry.get('md5') == md5:
+        return 'skip'
+    media = MediaFileUpload(file_name, mimetype=mimetype, resumable=True)
+    if entry:
+        try:
+            service.files().update(fileId=entry['id'], media_body=media).execute()
+            manifest.set(file_name, entry['id'], md5)
+            return 'update'
+        except HttpError as e:
+            # Drive 側で削除されていた場合は新規作成へ
+            if e.resp.status != 404: raise
+            manifest.remove(file_name)
+            media = MediaFileUpload(file_name, mimetype=mimetype, resumable=True)
+    file_metadata = {'name': file_name}
+    if folder_id:
+        file_metadata['parents'] = [folder_id]
+    created = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    manifest.set(file_name, created['id'], md5)
+    return 'create'
+
+def error_reasons(error):
+    """HttpError の本文から reason ('userRateLimitExceeded' など) を取り出す"""
+    try:
+        body = json.loads(error.content.decode('utf-8') if isinstance(error.content, bytes) else error.content)
+        return {e.get('reason') for e in body.get('error', {}).get('errors', [])}
+    except (ValueError, AttributeError, TypeError):
+        return set()
+
+def register_shared_file(service, folder_id, file_name, mimetype):
+    """全ワーカーが更新するファイル (captures_log.csv など) を、--workers で並列に動かす前に親で一度送って対応表に記録する。
+    各ワーカーは起動時の対応表で新規/更新を判断するので、未登録のままだと複数のワーカーが同じ名前で新規作成してしまう"""
+    manifest = DriveManifest()
+    upload_or_update(service, file_name, folder_id, mimetype, manifest)
+    manifest.flush()
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        # 403 は権限エラーなどもあるので、レート制限のときだけ再試行する
+        if error.resp.status == 403:
+            return bool(error_reasons(error) & RATE_LIMIT_REASONS)
+        return error.resp.status in RETRY_STATUSES
+    # 通信断・タイムアウトなどは再試行する
+    return isinstance(error, (OSError, TimeoutError)) or 'httplib2' in type(error).__module__
+
+class DriveUploader:
+    """キャプチャとは別スレッドで Drive へのアップロードを処理する。
+    認証済みクライアントはスレッドごとに一度だけ作り、使い回す。"""
+
+    def __init__(self, service_factory, folder_id, num_threads=1, max_queue=MAX_QUEUE_SIZE, manifest=None):
+        self.service_factory = service_factory
+        self.folder_id = folder_id
+        self.manifest = manifest
+        self.reconcile_lock = threading.Lock()
+        self.queue = queue.Queue(max_queue)
+        self.failed = []
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for t in self.threads: t.start()
+
+    def submit(self, file_name, mimetype='image/jpeg', delete_after=False):
+        # キューが満杯なら空くまで待つ (バックプレッシャー)
+        self.queue.put((file_name, mimetype, delete_after))
+
+    def flush(self):
+        """投入済みのアップロードがすべて終わるまで待つ"""
+        self.queue.join()
+        if self.manifest is not None: self.manifest.flush()
+
+    def close(self):
+        for _ in self.threads: self.queue.put(None)
+        for t in self.threads: t.join()
+        if self.manifest is not None: self.manifest.flush()
+        if self.failed:
+            print(f"  [Drive Error] {len(self.failed)} 件のアップロードに失敗しました: {self.failed}")
+
+    def _run(self):
+        service = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            file_name, mimetype, delete_after = item
+            try:
+                service, ok = self._upload_with_retry(service, file_name, mimetype)
+                if ok and delete_after and os.path.exists(file_name):
+                    os.remove(file_name)
+            except Exception as e:
+                # ここでスレッドが止まると flush() / close() が戻らなくなる
+                print(f"  [Drive Error]: {file_name}: {e}")
+                self.failed.append(file_name)
+            finally:
+                self.queue.task_done()
+
+    def _upload_with_retry(self, service, file_name, mimetype):
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                if service is None:
+                    service = self.service_factory()
+                self._reconcile_if_needed(service)
+                result = upload_or_update(service, file_name, self.folder_id, mimetype, self.manifest)
+                if result == 'skip':
+                    print(f"  -> Drive変更なし: {file_name}")
+                else:
+                    print(f"  -> Drive{'更新' if result == 'update' else '新規保存'}完了: {file_name}")
+                return service, True
+            except Exception as e:
+                if attempt == MAX_RETRIES or not is_retryable(e):
+                    # 失敗したファイルはローカルに残しておく
+                    print(f"  [Drive Error]: {file_name}: {e}")
+                    self.failed.append(file_name)
+                    return service, False
+                wait = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"  [Drive Retry] {file_name}: {e} ({wait:.1f}秒後に再試行)")
+                if not isinstance(e, HttpError):
+                    service = None # 接続が壊れている可能性があるので作り直す
+                time.sleep(wait)
+        return service, False
+
+    def _reconcile_if_needed(self, service):
+        if self.manifest is None: return
+        with self.reconcile_lock:
+            if self.manifest.needs_reconcile():
+                self.manifest.reconcile(service, self.folder_id)
@@ -0,0 +1,132 @@
+import cv2
+import numpy as np
+import glob
+import os
+import sys
+import time
+from detectors import get_detector
+
+# --- 設定 ---
+GATE_MAX_SIDE = 1280 # 判定に使う縮小画像の長辺 (4K なら 1/3 に縮小)
+HAAR_SCALE_FACTOR = 1.1
+HAAR_MIN_NEIGHBORS = 20
+HAAR_MIN_SIZE = 50 # 元解像度での最小顔サイズ (従来の minSize=(50, 50))
+YUNET_MODEL = 'face_detection_yunet_2023mar.onnx'
+YUNET_SCORE_THRESHOLD = 0.6
+IMAGE_EXTENSIONS = ['*.jpg', '*.jpeg', '*.png']
+
+class FaceGate:
+    """キャプチャ時の「顔あり」判定。
+    縮小画像上で検出し、いずれかの検出器が反応した時点で打ち切る。作業用バッファは使い回す。"""
+
+    def __init__(self, backend='haar', max_side=GATE_MAX_SIDE):
+        self.backend = backend
+        self.max_side = max_side
+        self._gray = None
+        self._flipped = None
+        self._small = None
+        if backend == 'yunet':
+            self.yunet = cv2.FaceDetectorYN.create(YUNET_MODEL, "", (320, 320), YUNET_SCORE_THRESHOLD)
+            self._yunet_size = None
+        elif backend != 'haar':
+            # それ以外は detectors.py の検出器 (読み込み済みのもの) を縮小画像に使う
+            self.detector = get_detector(backend)
+        else:
+            self.frontal = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            self.profile = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+
+    def _downscale(self, frame):
+        h, w = frame.shape[:2]
+        scale = min(1.0, self.max_side / max(h, w))
+        if scale >= 1.0:
+            return frame, 1.0
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        if self._small is None or self._small.shape[:2] != (size[1], size[0]):
+            self._small = np.empty((size[1], size[0], 3), np.uint8)
+        cv2.resize(frame, size, dst=self._small, interpolation=cv2.INTER_AREA)
+        return self._small, scale
+
+    def __call__(self, frame):
+        small, scale = self._downscale(frame)
+        if self.backend == 'yunet':
+            return self._detect_yunet(small)
+        if self.backend != 'haar':
+            boxes, _ = self.detector.detect(small)
+            return len(boxes) > 0
+        return self._detect_haar(small, scale)
+
+    def _detect_yunet(self, small):
+        size = (small.shape[1], small.shape[0])
+        if size != self._yunet_size:
+            self.yunet.setInputSize(size)
+            self._yunet_size = size
+        _, faces = self.yunet.detect(small)
+        return faces is not None and len(faces) > 0
+
+    def _detect_haar(self, small, scale):
+        h, w = small.shape[:2]
+        if self._gray is None or self._gray.shape != (h, w):
+            self._gray = np.empty((h, w), np.uint8)
+            self._flipped = np.empty((h, w), np.uint8)
+        cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        # minSize も縮小率に合わせる (カスケードの窓サイズ 24px / 20px より小さい顔は拾えない)
+        min_side = max(1, int(round(HAAR_MIN_SIZE * scale)))
+        min_size = (min_side, min_side)
+
+        if len(self.frontal.detectMultiScale(self._gray, HAAR_SCALE_FACTOR, HAAR_MIN_NEIGHBORS, minSize=min_size)) > 0:
+            return True
+        if len(self.profile.detectMultiScale(self._gray, HAAR_SCALE_FACTOR, HAAR_MIN_NEIGHBORS, minSize=min_size)) > 0:
+            return True
+        cv2.flip(self._gray, 1, dst=self._flipped)
+        return len(self.profile.detectMultiScale(self._flipped, HAAR_SCALE_FACTOR, HAAR_MIN_NEIGHBORS, minSize=min_size)) > 0
+
+# --- 従来の判定 (比較用) ---
+
+def legacy_contains_face(frame_data, frontal, profile):
+    gray = cv2.cvtColor(frame_data, cv2.COLOR_BGR2GRAY)
+    if len(frontal.detectMultiScale(gray, 1.1, 20, minSize=(50, 50))) > 0: return True
+    if len(profile.detectMultiScale(gray, 1.1, 20, minSize=(50, 50))) > 0: return True
+    gray_flipped = cv2.flip(gray, 1)
+    return len(profile.detectMultiScale(gray_flipped, 1.1, 20, minSize=(50, 50))) > 0
+
+def measure(gate, frames):
+    results, latencies = [], []
+    for frame in frames:
+        t0 = time.perf_counter()
+        results.append(gate(frame))
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return results, latencies
+
+def compare_gates(image_dir, backend='haar', max_side=GATE_MAX_SIDE, limit=200):
+    """固定の画像セットで従来判定と新しい判定のレイテンシ・一致率を比べる"""
+    paths = sorted(p for ext in IMAGE_EXTENSIONS for p in glob.glob(os.path.join(image_dir, ext)))[:limit]
+    frames = [img for img in (cv2.imread(p) for p in paths) if img is not None]
+    if not frames:
+        print(f"❌ エラー: 画像が {image_dir} に見つかりません。")
+        return
+
+    frontal = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    profile = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+    legacy, legacy_ms = measure(lambda f: legacy_contains_face(f, frontal, profile), frames)
+    gated, gate_ms = measure(FaceGate(backend, max_side), frames)
+
+    both = sum(a and b for a, b in zip(legacy, gated))
+    only_legacy = sum(a and not b for a, b in zip(legacy, gated))
+    only_gate = sum(b and not a for a, b in zip(legacy, gated))
+    agree = sum(a == b for a, b in zip(legacy, gated))
+
+    print(f"画像数: {len(frames)} / backend: {backend} / max_side: {max_side}")
+    for name, ms in [("従来", legacy_ms), ("新ゲート", gate_ms)]:
+        p50, p95 = np.percentile(ms, [50, 95])
+        print(f"  {name:<8} 平均 {np.mean(ms):8.1f} ms | p50 {p50:8.1f} ms | p95 {p95:8.1f} ms")
+    print(f"  一致率: {agree / len(frames) * 100:.1f}% (両方あり {both} / 従来のみ {only_legacy} / 新ゲートのみ {only_gate})")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("使い方: python face_gate.py <画像フォルダ> [haar|yunet] [max_side]")
+    else:
+        compare_gates(
+            sys.argv[1],
+            sys.argv[2] if len(sys.argv) > 2 else 'haar',
+            int(sys.argv[3]) if len(sys.argv) > 3 else GATE_MAX_SIDE
+        )
@@ -0,0 +1,101 @@
+import cv2
+import os
+import sys
+import time
+import hashlib
+from dataset_manifest import read_image_size
+
+# --- 設定 ---
+PYRAMID_DIR = ".pyramid_cache" # 縮小版の画像を保存する
+# 1/2 は JPEG の縮小デコードの方が PNG の読み込みより速く、PNG は元の JPEG より大きくなるので保存しない
+CACHE_MIN_FACTOR = 4
+REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+JPEG_EXTENSIONS = {".jpg", ".jpeg"}
+
+def pick_factor(size, max_size=None, min_size=None):
+    """必要な大きさを下回らない範囲で、最も大きい縮小率 (1, 2, 4, 8) を選ぶ。
+    max_size: この枠に収めて表示する (プレビュー用) / min_size: 検出器の入力サイズ (これ以上あればよい)"""
+    w, h = size
+    limits = [] # 許される縮小率の上限
+    if max_size:
+        # 枠に収める倍率は min(枠幅 / w, 枠高さ / h) なので、縮小率はその逆数まで
+        limits.append(max(w / max_size[0], h / max_size[1]))
+    if min_size:
+        # 幅・高さの両方が入力サイズ以上残る縮小率まで
+        limits.append(min(w / min_size[0], h / min_size[1]))
+    limit = min(limits) if limits else 1.0
+    for factor in (8, 4, 2):
+        if factor <= limit: return factor
+    return 1
+
+def decode_reduced(path, factor):
+    """JPEG は DCT 段階で縮小してデコードする。それ以外は通常デコード後に縮小"""
+    if factor == 1:
+        return cv2.imread(path)
+    if os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS:
+        return cv2.imread(path, REDUCED_FLAGS[factor])
+    img = cv2.imread(path)
+    if img is None: return None
+    h, w = img.shape[:2]
+    return cv2.resize(img, (max(1, -(-w // factor)), max(1, -(-h // factor))), interpolation=cv2.INTER_AREA)
+
+def file_key(path):
+    """パス・サイズ・mtime から作るキー (内容ハッシュのようにファイル全体を読まずに済む)"""
+    st = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8')).hexdigest()
+
+def pyramid_path(img_hash, factor, cache_dir=PYRAMID_DIR):
+    # 縮小版は可逆な PNG で保存する (検出器の入力が通常デコードと変わらないように)
+    return os.path.join(cache_dir, img_hash[:2], f"{img_hash}_{factor}.png")
+
+def load_reduced(path, max_size=None, min_size=None, size=None, img_hash=None, use_cache=True, cache_dir=PYRAMID_DIR):
+    """必要十分な解像度で画像を読み込む。(画像, 縮小率) を返す。
+    size (元の幅, 高さ) や img_hash はマニフェストから渡せばファイルを余計に読まずに済む"""
+    if size is None:
+        try:
+            size = read_image_size(path)
+        except Exception:
+            return cv2.imread(path), 1
+    factor = pick_factor(size, max_size, min_size)
+    return load_level(path, factor, img_hash, use_cache, cache_dir), factor
+
+def load_level(path, factor, img_hash=None, use_cache=True, cache_dir=PYRAMID_DIR):
+    """縮小率を指定してピラミッドの1段を読み込む (1 なら元画像)。
+    CACHE_MIN_FACTOR 以上の段だけ保存する。img_hash (マニフェストの内容ハッシュ) がなければ サイズ・mtime をキーにする"""
+    if factor == 1:
+        return cv2.imread(path)
+
+    cached_path = None
+    if use_cache and factor >= CACHE_MIN_FACTOR:
+        cached_path = pyramid_path(img_hash or file_key(path), factor, cache_dir)
+        if os.path.exists(cached_path):
+            img = cv2.imread(cached_path)
+            if img is not None: return img
+
+    img = decode_reduced(path, factor)
+    if img is not None and cached_path is not None:
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        tmp_path = f"{cached_path[:-4]}.{os.getpid()}.tmp.png"
+        if cv2.imwrite(tmp_path, img):
+            os.replace(tmp_path, cached_path)
+    return img
+
+if __name__ == "__main__":
+    # 通常デコードと縮小デコードの時間・メモリを比べる
+    if len(sys.argv) < 2:
+        print("使い方: python image_loader.py <画像> [最大幅] [最大高さ]")
+    else:
+        path = sys.argv[1]
+        max_size = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (1280, 720)
+        t0 = time.perf_counter()
+        full = cv2.imread(path)
+        full_ms = (time.perf_counter() - t0) * 1000
+        t0 = time.perf_counter()
+        small, factor = load_reduced(path, max_size=max_size, use_cache=False)
+        reduced_ms = (time.perf_counter() - t0) * 1000
+        print(f"通常デコード: {full.shape[1]}x{full.shape[0]} {full_ms:.1f} ms {full.nbytes / 1024 / 1024:.1f} MB")
+        print(f"1/{factor} デコード: {small.shape[1]}x{small.shape[0]} {reduced_ms:.1f} ms {small.nbytes / 1024 / 1024:.1f} MB")
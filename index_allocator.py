@@ -0,0 +1,66 @@
+import os
+import time
+from contextlib import contextmanager
+
+# --- 設定 ---
+LOCK_TIMEOUT_SEC = 60
+STALE_LOCK_SEC = 300 # 異常終了で残ったロックファイルはこの秒数で破棄する
+
+@contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT_SEC):
+    """path + '.lock' を排他作成してロックする (Windows / Linux 共通)"""
+    lock_path = path + '.lock'
+    start = time.time()
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SEC:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                pass
+            if time.time() - start > timeout:
+                raise TimeoutError(f"ロックを取得できませんでした: {lock_path}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+def read_counter(counter_file):
+    if not os.path.exists(counter_file): return 1
+    with open(counter_file, 'r') as f:
+        try: return int(f.read().strip())
+        except ValueError: return 1
+
+def allocate_block(counter_file, size):
+    """カウンターを size だけ進め、確保したブロックの先頭番号を返す"""
+    with file_lock(counter_file):
+        start = read_counter(counter_file)
+        tmp_path = f"{counter_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(start + size))
+        os.replace(tmp_path, counter_file)
+    return start
+
+class IndexAllocator:
+    """連番ファイル (last_index.txt) からブロック単位で番号を払い出す。
+    複数プロセスが同時に使っても同じ番号は二度と返らない (未使用分は欠番になる)。"""
+
+    def __init__(self, counter_file, block_size=1):
+        self.counter_file = counter_file
+        self.block_size = max(1, block_size)
+        self._next = 0
+        self._end = 0
+
+    def next(self):
+        if self._next >= self._end:
+            self._next = allocate_block(self.counter_file, self.block_size)
+            self._end = self._next + self.block_size
+        index = self._next
+        self._next += 1
+        return index
@@ -0,0 +1,133 @@
+import cv2
+import bisect
+import json
+import random
+import subprocess
+import sys
+import time
+
+# --- 設定 ---
+FFPROBE_BIN = 'ffprobe'
+PROBE_TIMEOUT_SEC = 180
+GRAB_WINDOW_SEC = 3.0 # 次の目標までこの秒数以内ならシークせず grab() で読み進める
+
+# --- サンプリング計画 ---
+
+def plan_sample_times(duration, start=30, step_range=(30, 75), rng=random):
+    """動画全体のサンプリング時刻(秒)を先にまとめて決める"""
+    times = []
+    t = start if duration > start else duration // 2
+    while t < duration:
+        times.append(float(t))
+        t += rng.randint(*step_range)
+    return times
+
+def probe_keyframes(source, targets):
+    """コンテナのインデックス (WebM Cues / MP4 stss) から各目標時刻付近のキーフレーム時刻を取得する"""
+    if not targets: return []
+    # 目標時刻ごとに「シークして数パケットだけ読む」区間を指定するので、全体を読む必要はない
+    intervals = ','.join(f"{t:.3f}%+#2" for t in targets)
+    cmd = [FFPROBE_BIN, '-v', 'error', '-select_streams', 'v:0',
+           '-read_intervals', intervals,
+           '-show_entries', 'packet=pts_time,flags', '-of', 'json', source]
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT_SEC, check=True).stdout
+        packets = json.loads(out).get('packets', [])
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        print(f"  [Info] キーフレーム一覧を取得できませんでした: {e}")
+        return []
+
+    keyframes = set()
+    for p in packets:
+        pts = p.get('pts_time')
+        if 'K' in p.get('flags', '') and pts not in (None, 'N/A'):
+            keyframes.add(float(pts))
+    return sorted(keyframes)
+
+def snap_to_keyframes(times, keyframes):
+    """各サンプリング時刻を最も近いキーフレームへ寄せる (同じキーフレームへの重複は除く)"""
+    if not keyframes: return list(times)
+    snapped = []
+    for t in times:
+        i = bisect.bisect_left(keyframes, t)
+        k = min(keyframes[max(0, i - 1):i + 1], key=lambda x: abs(x - t))
+        if not snapped or k > snapped[-1]:
+            snapped.append(k)
+    return snapped
+
+# --- 前方向のみの読み出し ---
+
+class KeyframeWalker:
+    """計画済みの時刻を前方向にだけ辿ってフレームを取り出す。
+    近い目標は grab() で読み進め、遠い目標はキーフレームへ直接シークする。"""
+
+    def __init__(self, cap, fps):
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.decoded = 0
+        self.reset(cap)
+
+    def reset(self, cap):
+        # 再接続した場合は位置が分からないので、次は必ずシークする
+        self.cap = cap
+        self.pos_sec = None
+
+    def read_at(self, t):
+        gap = None if self.pos_sec is None else t - self.pos_sec
+        if gap is not None and 0 <= gap <= GRAB_WINDOW_SEC:
+            for _ in range(max(0, int(round(gap * self.fps)) - 1)):
+                if not self.cap.grab(): return False, None
+                self.decoded += 1
+        else:
+            self.cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
+        success, frame = self.cap.read()
+        if success:
+            self.decoded += 1
+            self.pos_sec = t
+        return success, frame
+
+# --- ローカル動画での動作確認 ---
+
+def run_local(path, seed=0, compare=False):
+    cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+    if not cap.isOpened():
+        print(f"エラー: {path} を開けませんでした。")
+        return
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    duration = frame_count / fps if fps > 0 else 0
+
+    times = plan_sample_times(duration, rng=random.Random(seed))
+    keyframes = probe_keyframes(path, times)
+    plan = snap_to_keyframes(times, keyframes)
+    print(f"動画長: {duration:.1f}s / 計画: {len(times)} 点 / キーフレーム: {len(keyframes)} 件 / スナップ後: {len(plan)} 点")
+
+    walker = KeyframeWalker(cap, fps)
+    saved = 0
+    t0 = time.perf_counter()
+    for t in plan:
+        success, _ = walker.read_at(t)
+        if success: saved += 1
+    elapsed = time.perf_counter() - t0
+    cap.release()
+    per_capture = walker.decoded / saved if saved else 0
+    print(f"[keyframe] 取得 {saved} 枚 / デコード {walker.decoded} フレーム ({per_capture:.2f} フレーム/枚) / {elapsed:.2f}s")
+
+    if compare:
+        # 従来方式: 毎回 CAP_PROP_POS_MSEC でシーク + grab()
+        cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+        saved = 0
+        t0 = time.perf_counter()
+        for t in times:
+            cap.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
+            cap.grab()
+            success, _ = cap.read()
+            if success: saved += 1
+        elapsed = time.perf_counter() - t0
+        cap.release()
+        print(f"[seek]     取得 {saved} 枚 / {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("使い方: python keyframe_sampler.py <動画ファイル> [--compare]")
+    else:
+        run_local(sys.argv[1], compare='--compare' in sys.argv[2:])
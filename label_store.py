@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import numpy as np
+
+# --- 設定 ---
+INDEX_FILE = ".label_index.npz" # ラベルフォルダ内に置く索引 (全ボックスを1ファイルにまとめたもの)
+
+def parse_yolo_file(path):
+    """YOLO 形式の .txt を読み、クラスID (K,) と正規化 xyxy (K, 4) を返す。5列でない行は無視する"""
+    class_ids, boxes = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 5: continue
+            try:
+                cls_id = int(float(parts[0]))
+                x_c, y_c, w, h = map(float, parts[1:])
+            except ValueError:
+                continue
+            class_ids.append(cls_id)
+            boxes.append([x_c - w/2, y_c - h/2, x_c + w/2, y_c + h/2])
+    return np.asarray(class_ids, dtype=np.int32), np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+def to_pixels(boxes, img_w, img_h):
+    """正規化 xyxy を画素座標 (int) にする"""
+    return (np.asarray(boxes, dtype=np.float32).reshape(-1, 4) * np.float32([img_w, img_h, img_w, img_h])).astype(np.int32)
+
+class LabelStore:
+    """ラベルフォルダ全体のボックスを、画像番号・クラスID・xyxy の配列として持つ。
+    索引は mtime / サイズが変わったファイルだけ読み直して更新し、次回は1回の読み込みで復元する。"""
+
+    def __init__(self, label_dir, sync=True, persist=True):
+        self.label_dir = label_dir
+        self.persist = persist # False なら sync() しても索引を保存しない
+        self.index_path = os.path.join(label_dir, INDEX_FILE)
+        self.names = []
+        self.lookup = {}
+        self.mtimes = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.image_ids = np.zeros(0, dtype=np.int32)
+        self.class_ids = np.zeros(0, dtype=np.int32)
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.overrides = {} # update() で読み直した画像 (次の sync() で索引に反映)
+        self._load_index()
+        if sync: self.sync()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path): return
+        try:
+            with np.load(self.index_path) as data:
+                self._set_arrays(list(data['names']), data['mtimes'], data['sizes'], data['offsets'],
+                                 data['class_ids'], data['boxes'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ ラベル索引を読み込めませんでした。作り直します: {self.index_path} ({e})")
+
+    def _set_arrays(self, names, mtimes, sizes, offsets, class_ids, boxes):
+        self.names = [str(n) for n in names]
+        self.lookup = {name: i for i, name in enumerate(self.names)}
+        self.mtimes = np.asarray(mtimes, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.image_ids = np.repeat(np.arange(len(self.names), dtype=np.int32), np.diff(self.offsets))
+        self.overrides = {}
+
+    def sync(self):
+        """フォルダを走査し、追加・変更・削除されたラベルだけ反映する。変更があったら索引を保存する"""
+        entries = []
+        if os.path.isdir(self.label_dir):
+            with os.scandir(self.label_dir) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith('.txt'):
+                        st = entry.stat()
+                        entries.append((os.path.splitext(entry.name)[0], entry.path, st.st_mtime_ns, st.st_size))
+        entries.sort()
+
+        names, mtimes, sizes, parts_cls, parts_box = [], [], [], [], []
+        reparsed = 0
+        for name, path, mtime, size in entries:
+            i = self.lookup.get(name)
+            if i is not None and self.mtimes[i] == mtime and self.sizes[i] == size:
+                cls, boxes = self.get(name, use_overrides=False)
+            else:
+                try:
+                    cls, boxes = parse_yolo_file(path)
+                except OSError as e:
+                    print(f"⚠️ ラベルを読み込めません: {path} ({e})")
+                    continue
+                reparsed += 1
+            names.append(name)
+            mtimes.append(mtime)
+            sizes.append(size)
+            parts_cls.append(cls)
+            parts_box.append(boxes)
+
+        changed = reparsed > 0 or names != self.names
+        counts = [len(c) for c in parts_cls]
+        self._set_arrays(
+            names, mtimes, sizes, np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            np.concatenate(parts_cls) if parts_cls else np.zeros(0, dtype=np.int32),
+            np.concatenate(parts_box) if parts_box else np.zeros((0, 4), dtype=np.float32)
+        )
+        if changed and self.persist: self.save()
+        return reparsed
+
+    def save(self):
+        if not os.path.isdir(self.label_dir): return
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, names=np.asarray(self.names, dtype=str), mtimes=self.mtimes, sizes=self.sizes,
+                 offsets=self.offsets, class_ids=self.class_ids, boxes=self.boxes)
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, base_name):
+        return base_name in self.lookup or base_name in self.overrides
+
+    def get(self, base_name, use_overrides=True):
+        """1画像分の (クラスID (K,), 正規化 xyxy (K, 4))。ラベルがなければ空配列"""
+        if use_overrides and base_name in self.overrides:
+            return self.overrides[base_name]
+        i = self.lookup.get(base_name)
+        if i is None:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, 4), dtype=np.float32)
+        s, e = self.offsets[i], self.offsets[i + 1]
+        return self.class_ids[s:e], self.boxes[s:e]
+
+    def update(self, base_name):
+        """ラベルファイルを書き換えた直後に、その画像だけ読み直す"""
+        path = os.path.join(self.label_dir, f"{base_name}.txt")
+        if os.path.exists(path):
+            self.overrides[base_name] = parse_yolo_file(path)
+
+    def counts(self):
+        """画像ごとのボックス数 (len(self),)"""
+        return np.diff(self.offsets)
+
+if __name__ == "__main__":
+    label_dir = sys.argv[1] if len(sys.argv) > 1 else 'reindexed_labels'
+    t0 = time.perf_counter()
+    store = LabelStore(label_dir, sync=False)
+    load_ms = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    reparsed = store.sync()
+    sync_ms = (time.perf_counter() - t0) * 1000
+    print(f"{label_dir}: 画像 {len(store)} 件 / ボックス {len(store.boxes)} 個")
+    print(f"索引の読み込み {load_ms:.1f} ms / 同期 {sync_ms:.1f} ms (読み直したファイル {reparsed} 件)")
+    for cls_id, n in zip(*np.unique(store.class_ids, return_counts=True)):
+        print(f"  クラス {cls_id}: {n} 個")
@@ -0,0 +1,89 @@
+import csv
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# --- 設定 ---
+STORE_DIR = "mediapipe_landmarks"
+DATA_FILE = "landmarks.f16"   # (全顔数, 点数, 3) の float16 をそのまま連結したもの
+INDEX_FILE = "index.csv"      # 画像ごとの 先頭の顔番号 / 顔数
+META_FILE = "meta.json"
+NUM_LANDMARKS = 478
+INDEX_HEADER = ["base_name", "image_hash", "width", "height", "start", "count"]
+
+class LandmarkStoreWriter:
+    """ランドマークを画像ごとに追記していく。
+    データ本体は float16 の連続領域、索引は CSV に1行ずつ書くので、途中で止まっても書けた分は読める。"""
+
+    def __init__(self, store_dir=STORE_DIR, num_landmarks=NUM_LANDMARKS):
+        self.store_dir = store_dir
+        self.num_landmarks = num_landmarks
+        self.num_faces = 0
+        os.makedirs(store_dir, exist_ok=True)
+        with open(os.path.join(store_dir, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"dtype": "float16", "num_landmarks": num_landmarks, "created": time.strftime("%Y-%m-%d %H:%M:%S")}, f)
+        self.data_f = open(os.path.join(store_dir, DATA_FILE), 'wb')
+        self.index_f = open(os.path.join(store_dir, INDEX_FILE), 'w', newline='', encoding='utf-8')
+        self.index_writer = csv.writer(self.index_f)
+        self.index_writer.writerow(INDEX_HEADER)
+
+    def add(self, base_name, image_hash, width, height, landmarks):
+        faces = np.asarray(landmarks, dtype=np.float16).reshape(-1, self.num_landmarks, 3)
+        # 本体を書いてから索引を書く (索引にない末尾のデータは読み込み時に無視される)
+        self.data_f.write(faces.tobytes())
+        self.data_f.flush()
+        self.index_writer.writerow([base_name, image_hash, width, height, self.num_faces, len(faces)])
+        self.index_f.flush()
+        self.num_faces += len(faces)
+
+    def close(self):
+        self.data_f.close()
+        self.index_f.close()
+
+class LandmarkStore:
+    """LandmarkStoreWriter で書いたストアを memmap で読む。
+    store.landmarks は (全顔数, 点数, 3) の配列、store.faces(name) は画像1枚分のビュー。"""
+
+    def __init__(self, store_dir=STORE_DIR):
+        with open(os.path.join(store_dir, META_FILE), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.num_landmarks = meta["num_landmarks"]
+
+        names, hashes, sizes, starts, counts = [], [], [], [], []
+        with open(os.path.join(store_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                names.append(row["base_name"])
+                hashes.append(row["image_hash"])
+                sizes.append((int(row["width"]), int(row["height"])))
+                starts.append(int(row["start"]))
+                counts.append(int(row["count"]))
+        self.names = names
+        self.hashes = hashes
+        self.sizes = np.asarray(sizes, dtype=np.int32).reshape(-1, 2)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.lookup = {name: i for i, name in enumerate(names)}
+
+        num_faces = int((self.starts + self.counts).max()) if len(names) else 0
+        data_path = os.path.join(store_dir, DATA_FILE)
+        if num_faces:
+            self.landmarks = np.memmap(data_path, dtype=np.float16, mode='r', shape=(num_faces, self.num_landmarks, 3))
+        else:
+            self.landmarks = np.zeros((0, self.num_landmarks, 3), dtype=np.float16)
+        # 顔ごとにどの画像のものかを引けるようにしておく
+        self.image_of_face = np.repeat(np.arange(len(names)), self.counts)
+
+    def __len__(self):
+        return len(self.names)
+
+    def faces(self, base_name):
+        i = self.lookup[base_name]
+        return self.landmarks[self.starts[i]:self.starts[i] + self.counts[i]]
+
+if __name__ == "__main__":
+    t0 = time.perf_counter()
+    store = LandmarkStore(sys.argv[1] if len(sys.argv) > 1 else STORE_DIR)
+    all_faces = np.asarray(store.landmarks, dtype=np.float32)
+    print(f"画像 {len(store)} 枚 / 顔 {len(all_faces)} 個 を {(time.perf_counter() - t0) * 1000:.1f} ms で読み込みました。")
@@ -4,7 +4,16 @@ from mediapipe.tasks import python as mp_python
 from mediapipe.tasks.python import vision as mp_vision
 import os
 import glob
+import argparse
 import urllib.request
+import numpy as np
+from detectors import get_detector
+from dataset import LazyImageDataset
+from metrics import DetectionEvaluator, is_failure, iou_matrix
+from prediction_cache import PredictionCache, image_hash
+from vis_writer import VisWriter, add_vis_arguments, vis_options
+from landmark_store import LandmarkStoreWriter, NUM_LANDMARKS
+from label_store import LabelStore
 
 # --- 設定 ---
 CLASS_NAMES = {
@@ -17,11 +26,16 @@ CLASS_NAMES = {
 IMAGE_DIR = r"C:\workspace\sotsuron\reindexed_images"
 LABEL_DIR = r"C:\workspace\sotsuron\reindexed_labels"
 OUTPUT_DIR = "mediapipe_results"
-
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+IOU_THRESHOLD = 0.5
+LANDMARKER_VERSION = "1" # 設定やモデルを変えたら上げる (予測キャッシュのキーに含まれる)
+# roi: FaceDetector の検出枠を切り出した部分だけにランドマーカーをかける
+# fallback: roi と同じだが、検出枠が1つもない画像は全体にかける / full: 従来どおり常に全体
+LANDMARKER_MODE = "fallback"
+ROI_MARGIN = 0.25 # 検出枠を各辺この割合だけ広げて切り出す (輪郭が枠からはみ出すため)
+LANDMARK_STORE_DIR = "mediapipe_landmarks" # 全画像のランドマーク (float16, memmap で読める)
 
 # --- モデルファイルのダウンロード ---
-DETECTOR_MODEL = "blaze_face_short_range.tflite"
+# FaceDetector (BlazeFace) のモデルは detectors.py 側で読み込む
 LANDMARKER_MODEL = "face_landmarker.task"
 
 def download_model(url, filename):
@@ -30,26 +44,11 @@ def download_model(url, filename):
         urllib.request.urlretrieve(url, filename)
         print(f"Downloaded {filename}")
 
-download_model(
-    "https://storage.googleapis.com/mediapipe-models/face_detector/blaze_face_short_range/float16/1/blaze_face_short_range.tflite",
-    DETECTOR_MODEL
-)
 download_model(
     "https://storage.googleapis.com/mediapipe-models/face_landmarker/face_landmarker/float16/1/face_landmarker.task",
     LANDMARKER_MODEL
 )
 
-# --- IoU計算 ---
-def calculate_iou(boxA, boxB):
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-    interArea = max(0, xB - xA) * max(0, yB - yA)
-    boxAArea = (boxA[2] - boxA[0]) * (boxA[3] - boxA[1])
-    boxBArea = (boxB[2] - boxB[0]) * (boxB[3] - boxB[1])
-    return interArea / float(boxAArea + boxBArea - interArea) if (boxAArea + boxBArea - interArea) > 0 else 0
-
 # --- 描画ユーティリティ ---
 # FaceMesh の主要輪郭接続を手動定義 (mp.solutions依存を排除)
 FACE_MESH_CONNECTIONS = [
@@ -73,124 +72,197 @@ FACE_MESH_CONNECTIONS = [
     (1,2),(2,98),(98,97),(2,326),(326,327),
 ]
 
-def draw_landmarks_on_image(image, detection_result):
-    """face_landmarker の結果をimage上に描画する"""
+CONNECTIONS = np.asarray(FACE_MESH_CONNECTIONS, dtype=np.int64)
+# 半径1の塗りつぶし円 (cv2.circle(..., 1, ..., -1)) と同じ十字形の画素
+POINT_OFFSETS = np.asarray([(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)], dtype=np.int64)
+
+def stack_landmarks(faces):
+    """顔ごとの (点数, 3) 配列のリストを (顔数, 点数, 3) にまとめる"""
+    if not len(faces): return np.zeros((0, NUM_LANDMARKS, 3), dtype=np.float32)
+    return np.asarray(faces, dtype=np.float32)
+
+def landmarks_to_array(detection_result):
+    """face_landmarker の結果を (顔数, 点数, 3) の配列にする"""
+    return stack_landmarks([[(lm.x, lm.y, lm.z) for lm in face] for face in detection_result.face_landmarks])
+
+def landmark_boxes(landmarks):
+    """各顔のランドマークの外接矩形 (顔数, 4)"""
+    if not len(landmarks): return np.zeros((0, 4), dtype=np.float32)
+    return np.concatenate([landmarks[:, :, :2].min(axis=1), landmarks[:, :, :2].max(axis=1)], axis=1)
+
+def draw_landmarks_on_image(image, landmarks):
+    """face_landmarker の結果 (landmarks_to_array の配列) をimage上に描画する"""
+    if not len(landmarks): return
+    h, w = image.shape[:2]
+    pts = (landmarks[:, :, :2] * np.float32([w, h])).astype(np.int32)
+    # ランドマーク点を描画 (全顔分の点をまとめて画素に書き込む)
+    xy = (pts.reshape(-1, 1, 2) + POINT_OFFSETS[None, :, :]).reshape(-1, 2)
+    inside = (xy[:, 0] >= 0) & (xy[:, 0] < w) & (xy[:, 1] >= 0) & (xy[:, 1] < h)
+    image[xy[inside, 1], xy[inside, 0]] = (0, 255, 0)
+    # メッシュの接続線を描画 (全顔・全接続を1回の polylines で描く)
+    segments = pts[:, CONNECTIONS].reshape(-1, 2, 2)
+    cv2.polylines(image, list(segments), False, (0, 200, 0), 1)
+
+def crop_roi(image, box, margin=ROI_MARGIN):
+    """正規化座標の検出枠を正方形に広げて切り出す。(切り出し画像, (x0, y0, 幅, 高さ)) を返す"""
     h, w = image.shape[:2]
-    for face_landmarks in detection_result.face_landmarks:
-        # ランドマーク点を描画
-        for lm in face_landmarks:
-            cx, cy = int(lm.x * w), int(lm.y * h)
-            cv2.circle(image, (cx, cy), 1, (0, 255, 0), -1)
-        # メッシュの接続線を描画
-        for conn in FACE_MESH_CONNECTIONS:
-            a, b = conn
-            x0 = int(face_landmarks[a].x * w)
-            y0 = int(face_landmarks[a].y * h)
-            x1 = int(face_landmarks[b].x * w)
-            y1 = int(face_landmarks[b].y * h)
-            cv2.line(image, (x0, y0), (x1, y1), (0, 200, 0), 1)
-
-def evaluate_glitch_detection():
+    side = max((box[2] - box[0]) * w, (box[3] - box[1]) * h) * (1 + 2 * margin)
+    cx, cy = (box[0] + box[2]) / 2 * w, (box[1] + box[3]) / 2 * h
+    x0, y0 = int(max(0, cx - side / 2)), int(max(0, cy - side / 2))
+    x1, y1 = int(min(w, cx + side / 2)), int(min(h, cy + side / 2))
+    return image[y0:y1, x0:x1], (x0, y0, x1 - x0, y1 - y0)
+
+def run_landmarker(landmarker, image_bgr):
+    # MediaPipe Image に変換 (RGB)
+    mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB))
+    return landmarks_to_array(landmarker.detect(mp_image))
+
+def landmarks_in_rois(roi_landmarker, image_bgr, det_boxes):
+    """検出枠ごとの切り出し画像でランドマークを推定し、元画像の正規化座標に戻す"""
+    h, w = image_bgr.shape[:2]
+    faces = []
+    for box in det_boxes:
+        crop, (x0, y0, cw, ch) = crop_roi(image_bgr, box)
+        if cw < 2 or ch < 2: continue
+        lm = run_landmarker(roi_landmarker, crop)
+        if not len(lm): continue
+        face = lm[0]
+        face[:, 0] = (face[:, 0] * cw + x0) / w
+        face[:, 1] = (face[:, 1] * ch + y0) / h
+        face[:, 2] *= cw / w
+        # 重なった検出枠から同じ顔を二重に拾わないようにする
+        if faces and iou_matrix(landmark_boxes(face[None]), landmark_boxes(stack_landmarks(faces))).max() >= 0.5:
+            continue
+        faces.append(face)
+    return stack_landmarks(faces)
+
+def draw_results(det_boxes, landmarks):
+    def draw(vis_img):
+        h, w = vis_img.shape[:2]
+        for box in det_boxes:
+            # 検出枠を描画 (青)
+            cv2.rectangle(
+                vis_img,
+                (int(round(box[0] * w)), int(round(box[1] * h))),
+                (int(round(box[2] * w)), int(round(box[3] * h))),
+                (255, 0, 0), 2
+            )
+        draw_landmarks_on_image(vis_img, landmarks)
+    return draw
+
+def evaluate_glitch_detection(vis=None, landmarker_mode=LANDMARKER_MODE):
     stats = {i: {"total": 0, "detected": 0, "landmarked": 0} for i in CLASS_NAMES.keys()}
+    det_eval = DetectionEvaluator()  # FaceDetector の検出枠
+    mesh_eval = DetectionEvaluator() # FaceLandmarker のメッシュ外接矩形
 
     # --- Tasks API オプション設定 ---
-    detector_options = mp_vision.FaceDetectorOptions(
-        base_options=mp_python.BaseOptions(model_asset_path=DETECTOR_MODEL),
-        min_detection_confidence=0.5
-    )
+    detector_params = {"min_detection_confidence": 0.5}
+    landmarker_params = {"num_faces": 20, "min_face_detection_confidence": 0.5, "min_face_presence_confidence": 0.5}
+    detector = get_detector("BlazeFace", **detector_params)
     landmarker_options = mp_vision.FaceLandmarkerOptions(
         base_options=mp_python.BaseOptions(model_asset_path=LANDMARKER_MODEL),
-        num_faces=20,
-        min_face_detection_confidence=0.5,
-        min_face_presence_confidence=0.5
+        **landmarker_params
+    )
+    # 切り出し画像には顔が1つだけ写っている前提
+    roi_landmarker_options = mp_vision.FaceLandmarkerOptions(
+        base_options=mp_python.BaseOptions(model_asset_path=LANDMARKER_MODEL),
+        **dict(landmarker_params, num_faces=1)
     )
+    # 集計条件だけを変えて再実行する場合は、推論を丸ごと省略できる
+    det_cache = PredictionCache("BlazeFace", detector.version, detector.cache_params(**detector_params))
+    mesh_cache = PredictionCache("FaceLandmarker", LANDMARKER_VERSION,
+                                 dict(landmarker_params, mode=landmarker_mode, roi_margin=ROI_MARGIN))
+    full_frame_runs = 0
 
-    with mp_vision.FaceDetector.create_from_options(detector_options) as detector, \
-         mp_vision.FaceLandmarker.create_from_options(landmarker_options) as landmarker:
+    # 描画と JPEG 保存は別スレッドで行う
+    writer = VisWriter(OUTPUT_DIR, **(vis or {}))
+    # 外接矩形だけでなくランドマーク自体も残しておき、後から形状を解析できるようにする
+    store = LandmarkStoreWriter(LANDMARK_STORE_DIR)
 
-        image_files = glob.glob(os.path.join(IMAGE_DIR, "*"))
+    with mp_vision.FaceLandmarker.create_from_options(landmarker_options) as landmarker, \
+         mp_vision.FaceLandmarker.create_from_options(roi_landmarker_options) as roi_landmarker:
 
+        image_files = glob.glob(os.path.join(IMAGE_DIR, "*"))
+        labels = LabelStore(LABEL_DIR)
+        items = []
         for img_path in image_files:
             base_name = os.path.splitext(os.path.basename(img_path))[0]
-            label_path = os.path.join(LABEL_DIR, f"{base_name}.txt")
-            if not os.path.exists(label_path):
-                continue
-
-            image_bgr = cv2.imread(img_path)
-            if image_bgr is None:
-                continue
-            h, w = image_bgr.shape[:2]
-
-            # MediaPipe Image に変換 (RGB)
-            mp_image = mp.Image(
-                image_format=mp.ImageFormat.SRGB,
-                data=cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-            )
+            if base_name in labels:
+                items.append((base_name, img_path))
 
-            vis_img = image_bgr.copy()
-
-            # 1. FaceDetector 実行
-            det_result = detector.detect(mp_image)
-            mp_det_boxes = []
-            for det in det_result.detections:
-                bb = det.bounding_box
-                # bounding_box は pixel 座標なので正規化する
-                box = [
-                    bb.origin_x / w,
-                    bb.origin_y / h,
-                    (bb.origin_x + bb.width) / w,
-                    (bb.origin_y + bb.height) / h
-                ]
-                mp_det_boxes.append(box)
-                # 検出枠を描画 (青)
-                cv2.rectangle(
-                    vis_img,
-                    (bb.origin_x, bb.origin_y),
-                    (bb.origin_x + bb.width, bb.origin_y + bb.height),
-                    (255, 0, 0), 2
-                )
-
-            # 2. FaceLandmarker 実行
-            lm_result = landmarker.detect(mp_image)
-            mp_mesh_boxes = []
-            for face_landmarks in lm_result.face_landmarks:
-                xs = [lm.x for lm in face_landmarks]
-                ys = [lm.y for lm in face_landmarks]
-                mp_mesh_boxes.append([min(xs), min(ys), max(xs), max(ys)])
-            draw_landmarks_on_image(vis_img, lm_result)
-
-            # 3. 集計ロジック
-            with open(label_path, 'r') as f:
-                for line in f:
-                    parts = line.split()
-                    if not parts:
-                        continue
-                    cls_id = int(float(parts[0]))
-                    if cls_id not in stats:
-                        continue
-
-                    x_c, y_c, bw, bh = map(float, parts[1:])
-                    gt_box = [x_c - bw/2, y_c - bh/2, x_c + bw/2, y_c + bh/2]
-                    stats[cls_id]["total"] += 1
-
-                    if any(calculate_iou(gt_box, mb) >= 0.5 for mb in mp_det_boxes):
-                        stats[cls_id]["detected"] += 1
-
-                    if any(calculate_iou(gt_box, mb) >= 0.5 for mb in mp_mesh_boxes):
-                        stats[cls_id]["landmarked"] += 1
-
-            # 結果画像を保存
-            cv2.imwrite(os.path.join(OUTPUT_DIR, f"mp_{base_name}.jpg"), vis_img)
+        # 1回しか読まないのでキャッシュは持たず、先読みだけ行う
+        dataset = LazyImageDataset(items, cache_mb=0)
+        for base_name, image_bgr, h, w in dataset:
+            img_hash = image_hash(dataset.paths[base_name])
+
+            # 1. FaceDetector 実行 (結果は正規化座標)
+            cached = det_cache.get(img_hash)
+            if cached is not None:
+                mp_det_boxes, mp_det_scores = cached['boxes'], cached['scores']
+            else:
+                mp_det_boxes, mp_det_scores = detector.detect(image_bgr)
+                det_cache.put(img_hash, boxes=mp_det_boxes, scores=mp_det_scores)
+
+            # 2. FaceLandmarker 実行 (全体を見るのは full モードか、fallback で検出枠がないときだけ)
+            cached = mesh_cache.get(img_hash)
+            if cached is not None:
+                landmarks = cached['landmarks']
+            else:
+                if landmarker_mode == "full" or (landmarker_mode == "fallback" and not len(mp_det_boxes)):
+                    landmarks = run_landmarker(landmarker, image_bgr)
+                    full_frame_runs += 1
+                else:
+                    landmarks = landmarks_in_rois(roi_landmarker, image_bgr, mp_det_boxes)
+                mesh_cache.put(img_hash, landmarks=landmarks)
+            mp_mesh_boxes = landmark_boxes(landmarks)
+            store.add(base_name, img_hash, w, h, landmarks)
+
+            # 3. 集計用に正解ラベルと予測を溜める (マッチングは最後に一括で行う)
+            cls_ids, boxes = labels.get(base_name)
+            keep = np.isin(cls_ids, list(stats))
+            gt_classes, gt_boxes = cls_ids[keep], boxes[keep]
+
+            det_eval.add(base_name, gt_classes, gt_boxes, mp_det_boxes, mp_det_scores)
+            # ランドマーカーは顔ごとのスコアを返さないので一律 1.0
+            mesh_eval.add(base_name, gt_classes, gt_boxes, mp_mesh_boxes, [1.0] * len(mp_mesh_boxes))
+
+            # 結果画像を保存 (検出・メッシュのどちらかで見逃し・誤検出があれば失敗扱い)
+            failed = writer.mode == 'failures' and (
+                is_failure(gt_boxes, mp_det_boxes, IOU_THRESHOLD) or is_failure(gt_boxes, mp_mesh_boxes, IOU_THRESHOLD)
+            )
+            writer.submit(f"mp_{base_name}.jpg", image_bgr, draw_results(mp_det_boxes, landmarks), failed)
             print(f"Processed: {base_name}")
+    writer.close()
+    store.close()
+    print(f"ランドマーク: {store.num_faces} 顔分を {LANDMARK_STORE_DIR} に保存しました。")
+    if writer.mode != 'none':
+        print(f"結果画像: {writer.written} 枚を {OUTPUT_DIR} に保存 ({writer.mode})")
+    for name, cache in [("BlazeFace", det_cache), ("FaceLandmarker", mesh_cache)]:
+        print(f"予測キャッシュ [{name}]: ヒット {cache.hits} / ミス {cache.misses}")
+    print(f"ランドマーカー ({landmarker_mode}): 全体画像での推論 {full_frame_runs} 回 / 推論した画像 {mesh_cache.misses} 枚")
+
+    # --- IoU 行列による一括マッチング ---
+    det_metrics = det_eval.evaluate(IOU_THRESHOLD, CLASS_NAMES.keys())
+    mesh_metrics = mesh_eval.evaluate(IOU_THRESHOLD, CLASS_NAMES.keys())
+    for cid in CLASS_NAMES.keys():
+        stats[cid]["total"] = det_metrics['classes'][cid]['gt']
+        stats[cid]["detected"] = det_metrics['classes'][cid]['detected']
+        stats[cid]["landmarked"] = mesh_metrics['classes'][cid]['detected']
 
     # --- 最終集計結果の出力 ---
-    print(f"\n{'Glitch Category':<25} | {'Count':<6} | {'Detect%':<10} | {'Mesh%':<10}")
-    print("-" * 60)
+    print(f"\n{'Glitch Category':<25} | {'Count':<6} | {'Detect%':<10} | {'Mesh%':<10} | {'Det AP%':<10} | {'Det Prec%':<10}")
+    print("-" * 86)
     for cid, name in CLASS_NAMES.items():
         s = stats[cid]
         d_rate = (s['detected'] / s['total'] * 100) if s['total'] > 0 else 0
         l_rate = (s['landmarked'] / s['total'] * 100) if s['total'] > 0 else 0
-        print(f"{name:<25} | {s['total']:<6} | {d_rate:>8.1f}% | {l_rate:>8.1f}%")
+        m = det_metrics['classes'][cid]
+        print(f"{name:<25} | {s['total']:<6} | {d_rate:>8.1f}% | {l_rate:>8.1f}% | {m['ap'] * 100:>8.1f}% | {m['precision'] * 100:>8.1f}%")
 
 if __name__ == "__main__":
-    evaluate_glitch_detection()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--landmarker-mode', choices=['roi', 'fallback', 'full'], default=LANDMARKER_MODE,
+                        help='roi=検出枠の切り出しのみ / fallback=検出枠がなければ全体 / full=常に全体 (従来)')
+    add_vis_arguments(parser)
+    args = parser.parse_args()
+    evaluate_glitch_detection(vis_options(args), args.landmarker_mode)
@@ -0,0 +1,131 @@
+import numpy as np
+
+# =========================================================
+# IoU 行列とマッチング
+# =========================================================
+
+def iou_matrix(boxes_a, boxes_b):
+    """(N, 4) と (M, 4) の xyxy ボックスから (N, M) の IoU 行列を計算する"""
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+def is_failure(gt_boxes, pred_boxes, iou_threshold=0.5):
+    """見逃した正解、またはどの正解とも重ならない予測が1つでもあるか (失敗画像だけ可視化する用)"""
+    gt = np.asarray(gt_boxes, dtype=np.float32).reshape(-1, 4)
+    pred = np.asarray(pred_boxes, dtype=np.float32).reshape(-1, 4)
+    if len(gt) == 0 or len(pred) == 0: return len(gt) + len(pred) > 0
+    ious = iou_matrix(gt, pred)
+    return bool((ious.max(axis=1) < iou_threshold).any() or (ious.max(axis=0) < iou_threshold).any())
+
+def pr_curve(scores, is_tp, num_gt):
+    """スコア降順に並べた累積 precision / recall を返す"""
+    order = np.argsort(-scores, kind='stable')
+    hits = is_tp[order]
+    tp = np.cumsum(hits)
+    fp = np.cumsum(~hits)
+    recall = tp / num_gt if num_gt > 0 else np.zeros(len(tp))
+    precision = tp / np.maximum(tp + fp, 1)
+    return recall, precision
+
+def average_precision(recall, precision):
+    """全点補間 (VOC2010 以降) の AP"""
+    if len(recall) == 0: return 0.0
+    mrec = np.concatenate([[0.0], recall, [1.0]])
+    mpre = np.concatenate([[0.0], precision, [0.0]])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+    idx = np.nonzero(mrec[1:] != mrec[:-1])[0]
+    return float(np.sum((mrec[idx + 1] - mrec[idx]) * mpre[idx + 1]))
+
+# =========================================================
+# 評価エンジン
+# =========================================================
+
+class DetectionEvaluator:
+    """画像ごとの正解ボックス (クラス付き) と予測ボックス (スコア付き) を溜め、まとめて評価する。
+    予測はクラスを持たない顔検出なので、クラス別の指標は「そのクラスの正解に一致した予測」を TP、
+    どの正解にも一致しなかった予測を FP として数える (他クラスに一致した予測は除外)。"""
+
+    def __init__(self):
+        self.keys = []
+        self.gt_cls, self.gt_boxes, self.gt_counts = [], [], []
+        self.pred_boxes, self.pred_scores, self.pred_counts = [], [], []
+
+    def add(self, image_key, gt_classes, gt_boxes, pred_boxes, pred_scores):
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float32).reshape(-1, 4)
+        pred_boxes = np.asarray(pred_boxes, dtype=np.float32).reshape(-1, 4)
+        self.keys.append(image_key)
+        self.gt_cls.append(np.asarray(gt_classes, dtype=np.int32).reshape(-1))
+        self.gt_boxes.append(gt_boxes)
+        self.gt_counts.append(len(gt_boxes))
+        self.pred_boxes.append(pred_boxes)
+        self.pred_scores.append(np.asarray(pred_scores, dtype=np.float32).reshape(-1))
+        self.pred_counts.append(len(pred_boxes))
+
+    def _concat(self, arrays, shape):
+        return np.concatenate(arrays) if arrays else np.zeros(shape, dtype=np.float32)
+
+    def evaluate(self, iou_threshold=0.5, class_ids=None):
+        gt_cls = self._concat(self.gt_cls, (0,)).astype(np.int32)
+        gt_xy = self._concat(self.gt_boxes, (0, 4))
+        pr_xy = self._concat(self.pred_boxes, (0, 4))
+        pr_score = self._concat(self.pred_scores, (0,))
+        gt_off = np.concatenate([[0], np.cumsum(self.gt_counts)]).astype(np.int64)
+        pr_off = np.concatenate([[0], np.cumsum(self.pred_counts)]).astype(np.int64)
+
+        # 1. 画像ごとに IoU 行列を作り、閾値以上の (GT, 予測) の組を集める
+        gt_max_iou = np.zeros(len(gt_cls), dtype=np.float32)
+        pair_gt, pair_pred, pair_iou = [], [], []
+        for i in range(len(self.keys)):
+            g0, g1, p0, p1 = gt_off[i], gt_off[i + 1], pr_off[i], pr_off[i + 1]
+            if g1 == g0 or p1 == p0: continue
+            ious = iou_matrix(gt_xy[g0:g1], pr_xy[p0:p1])
+            gt_max_iou[g0:g1] = ious.max(axis=1)
+            gi, pi = np.nonzero(ious >= iou_threshold)
+            pair_gt.append(gi + g0)
+            pair_pred.append(pi + p0)
+            pair_iou.append(ious[gi, pi])
+
+        # 2. スコアの高い予測から順に、まだ使われていない最も IoU の高い GT と1対1で対応付ける
+        gt_matched = np.zeros(len(gt_cls), dtype=bool)
+        pred_match = np.full(len(pr_score), -1, dtype=np.int64)
+        if pair_gt:
+            pg, pp, piou = np.concatenate(pair_gt), np.concatenate(pair_pred), np.concatenate(pair_iou)
+            order = np.lexsort((-piou, -pr_score[pp]))
+            for g, p in zip(pg[order].tolist(), pp[order].tolist()):
+                if pred_match[p] >= 0 or gt_matched[g]: continue
+                pred_match[p] = g
+                gt_matched[g] = True
+
+        matched = pred_match >= 0
+        pred_cls = np.where(matched, gt_cls[np.maximum(pred_match, 0)] if len(gt_cls) else -1, -1)
+        results = {'overall': self._summarize(pr_score, matched, len(gt_cls), int(gt_matched.sum())), 'classes': {}}
+
+        if class_ids is None: class_ids = sorted(set(gt_cls.tolist()))
+        for c in class_ids:
+            mask = gt_cls == c
+            keep = (~matched) | (pred_cls == c)
+            summary = self._summarize(pr_score[keep], matched[keep], int(mask.sum()), int(gt_matched[mask].sum()))
+            # 従来の集計 (どれか1つの予測と IoU が閾値以上なら検出扱い)
+            summary['detected'] = int((gt_max_iou[mask] >= iou_threshold).sum())
+            results['classes'][c] = summary
+        return results
+
+    def _summarize(self, scores, is_tp, num_gt, tp):
+        recall, precision = pr_curve(scores, is_tp, num_gt)
+        num_pred = len(scores)
+        return {
+            'gt': num_gt,
+            'tp': tp,
+            'fp': int(num_pred - is_tp.sum()),
+            'precision': tp / num_pred if num_pred else 0.0,
+            'recall': tp / num_gt if num_gt else 0.0,
+            'ap': average_precision(recall, precision) if num_gt else 0.0,
+            'curve': (recall, precision),
+        }
@@ -1,11 +1,21 @@
 import cv2
 import os
-import glob
 import csv
 import gc
-import urllib.request
+import time
+import argparse
+import queue
+import contextlib
+import multiprocessing
+import numpy as np
 
 os.environ["TF_USE_LEGACY_KERAS"] = "1"
+from detectors import DETECTORS, get_detector, release_detector
+from dataset import LazyImageDataset
+from metrics import DetectionEvaluator, is_failure
+from prediction_cache import PredictionCache, image_hash
+from vis_writer import VisWriter, add_vis_arguments, vis_options
+from dataset_manifest import DatasetManifest
 
 # --- 設定 ---
 CLASS_NAMES = {
@@ -18,45 +28,12 @@ CLASS_NAMES = {
 IMAGE_DIR = r"C:\workspace\sotsuron\reindexed_images"
 LABEL_DIR = r"C:\workspace\sotsuron\reindexed_labels"
 OUTPUT_CSV = "model_comparison_results.csv"
+OUTPUT_METRICS_CSV = "model_metrics_results.csv" # precision / recall / AP
+OUTPUT_PR_CSV = "model_pr_curves.csv"
+IOU_THRESHOLD = 0.5
 OUTPUT_IMG_DIR = "visualized_results"
-
-os.makedirs(OUTPUT_IMG_DIR, exist_ok=True)
-
-# --- ファイル自動ダウンロード ---
-def download_model_file(url, filename):
-    if not os.path.exists(filename):
-        print(f"[{filename}] をダウンロード中...")
-        try:
-            urllib.request.urlretrieve(url, filename)
-            print(f"ダウンロード完了: {filename}")
-        except Exception as e:
-            print(f"ダウンロード失敗: {filename} ({e})")
-
-YUNET_MODEL = "face_detection_yunet_2023mar.onnx"
-YUNET_URL = "https://github.com/opencv/opencv_zoo/raw/main/models/face_detection_yunet/face_detection_yunet_2023mar.onnx"
-BLAZEFACE_MODEL = "blaze_face_short_range.tflite"
-BLAZEFACE_URL = "https://storage.googleapis.com/mediapipe-models/face_detector/blaze_face_short_range/float16/1/blaze_face_short_range.tflite"
-DNN_PROTOTXT = "deploy.prototxt"
-DNN_PROTOTXT_URL = "https://raw.githubusercontent.com/opencv/opencv/master/samples/dnn/face_detector/deploy.prototxt"
-DNN_CAFFEMODEL = "res10_300x300_ssd_iter_140000.caffemodel"
-DNN_CAFFEMODEL_URL = "https://raw.githubusercontent.com/opencv/opencv_3rdparty/dnn_samples_face_detector_20170830/res10_300x300_ssd_iter_140000.caffemodel"
-
-download_model_file(YUNET_URL, YUNET_MODEL)
-download_model_file(BLAZEFACE_URL, BLAZEFACE_MODEL)
-download_model_file(DNN_PROTOTXT_URL, DNN_PROTOTXT)
-download_model_file(DNN_CAFFEMODEL_URL, DNN_CAFFEMODEL)
-
-
-# --- IoU計算 ---
-def calculate_iou(boxA, boxB):
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-    interArea = max(0, xB - xA) * max(0, yB - yA)
-    boxAArea = (boxA[2] - boxA[0]) * (boxA[3] - boxA[1])
-    boxBArea = (boxB[2] - boxB[0]) * (boxB[3] - boxB[1])
-    return interArea / float(boxAArea + boxBArea - interArea) if (boxAArea + boxBArea - interArea) > 0 else 0
+CACHE_MAX_MB = 1024 # デコード済み画像を保持するメモリ上限
+READAHEAD = 8       # 先読みする枚数
 
 # --- メモリ解放ユーティリティ ---
 def clear_memory():
@@ -69,210 +46,283 @@ def clear_memory():
         pass
 
 # =========================================================
-# モデル別処理関数群
+# モデル別処理 (検出器は detectors.py のレジストリから取得)
 # =========================================================
 
-def evaluate_mtcnn(image_data):
-    from mtcnn import MTCNN
-    model = MTCNN()
+def evaluate_detector(model_name, image_data, batch_size=None):
+    """検出器を一度だけ読み込み、画像をまとめて推論する。{base_name: (boxes, scores)} を返す"""
+    detector = get_detector(model_name)
+    batch_size = batch_size or detector.batch_size
     results_dict = {}
-    for base_name, img_bgr, h, w in image_data:
-        img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-        try:
-            detections = model.detect_faces(img_rgb)
-            boxes = [[x/w, y/h, (x+bw)/w, (y+bh)/h] for det in detections for x, y, bw, bh in [det['box']]]
-        except:
-            boxes = []
-        results_dict[base_name] = boxes
-    del model
+    for batch in image_data.batches(batch_size):
+        outputs = detector.detect_batch([img_bgr for _, img_bgr, _, _ in batch])
+        for (base_name, _, _, _), output in zip(batch, outputs):
+            results_dict[base_name] = output
     return results_dict
 
-def evaluate_retinaface(image_data):
-    from retinaface import RetinaFace
-    results_dict = {}
-    for base_name, img_bgr, h, w in image_data:
-        detections = RetinaFace.detect_faces(img_bgr)
-        boxes = []
-        if type(detections) == dict:
-            for key in detections.keys():
-                x1, y1, x2, y2 = detections[key]["facial_area"]
-                boxes.append([x1/w, y1/h, x2/w, y2/h])
-        results_dict[base_name] = boxes
-    return results_dict
-
-def evaluate_blazeface(image_data):
-    import mediapipe as mp
-    from mediapipe.tasks import python as mp_python
-    from mediapipe.tasks.python import vision as mp_vision
-
-    if not os.path.exists(BLAZEFACE_MODEL):
-        print(f"エラー: {BLAZEFACE_MODEL} がありません。")
-        return {}
-
-    base_options = mp_python.BaseOptions(model_asset_path=BLAZEFACE_MODEL)
-    options = mp_vision.FaceDetectorOptions(base_options=base_options, min_detection_confidence=0.5)
-    
-    results_dict = {}
-    with mp_vision.FaceDetector.create_from_options(options) as detector:
-        for base_name, img_bgr, h, w in image_data:
-            mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
-            detections = detector.detect(mp_image)
-            boxes = []
-            for det in detections.detections:
-                bb = det.bounding_box
-                boxes.append([bb.origin_x / w, bb.origin_y / h, (bb.origin_x + bb.width) / w, (bb.origin_y + bb.height) / h])
-            results_dict[base_name] = boxes
-    return results_dict
+def compare_batched(model_name, image_data, batch_size=None):
+    """1枚ずつの推論とバッチ推論の結果・速度を比べる"""
+    detector = get_detector(model_name)
+    batch_size = batch_size or detector.batch_size
+
+    t0 = time.perf_counter()
+    single = {base_name: detector.detect(img_bgr) for base_name, img_bgr, _, _ in image_data}
+    single_sec = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    batched = evaluate_detector(model_name, image_data, batch_size)
+    batched_sec = time.perf_counter() - t0
+
+    mismatched, max_diff = 0, 0.0
+    for base_name, (boxes, scores) in single.items():
+        b_boxes, b_scores = batched[base_name]
+        if boxes.shape != b_boxes.shape:
+            mismatched += 1
+            continue
+        if len(boxes):
+            max_diff = max(max_diff, float(np.abs(boxes - b_boxes).max()), float(np.abs(scores - b_scores).max()))
+
+    n = len(single)
+    print(f"[{model_name}] 1枚ずつ: {n / single_sec:.1f} 枚/秒 | バッチ({batch_size}): {n / batched_sec:.1f} 枚/秒 | 高速化: {single_sec / batched_sec:.2f}倍")
+    print(f"[{model_name}] 検出数が異なる画像: {mismatched} / {n} 件, 座標・スコアの最大差: {max_diff:.2e}")
+
+def draw_predictions(model_name, pred_boxes):
+    def draw(vis_img):
+        # モデルの検出結果のみを描画 (青色)
+        h, w = vis_img.shape[:2]
+        for p_box in pred_boxes:
+            x1, y1 = int(p_box[0] * w), int(p_box[1] * h)
+            x2, y2 = int(p_box[2] * w), int(p_box[3] * h)
+            cv2.rectangle(vis_img, (x1, y1), (x2, y2), (255, 0, 0), 2)
+            cv2.putText(vis_img, model_name, (x1, max(y1-20, 10)), 
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1)
+    return draw
+
+def run_model(model_name, image_data, batch_size=None, use_cache=True, vis=None, gt_data=None, reduced_decode=True):
+    """1モデル分の推論を行い、(base_name, boxes, scores) を1枚ずつ返す。描画と保存は VisWriter のスレッドで行う"""
+    batch_size = batch_size or DETECTORS[model_name].batch_size
+    # 入力が小さいモデルは、4K 画像を全画素デコードせず入力サイズ以上の縮小デコードで済ませる
+    input_size = DETECTORS[model_name].input_size if reduced_decode else None
+    if input_size: image_data = image_data.reduced(input_size)
+    # キーには検出器の既定値も含める (既定値を変えたら別キー)。推論後の絞り込みは含めず、絞り込む前の結果を置く
+    cache_params = DETECTORS[model_name].cache_params()
+    if input_size: cache_params["decode_min_size"] = input_size
+    cache = PredictionCache(model_name, DETECTORS[model_name].version, cache_params) if use_cache else None
+    detector = None # 全件キャッシュに当たった場合はモデルを読み込まない
+    writer = VisWriter(os.path.join(OUTPUT_IMG_DIR, model_name), **(vis or {}))
+    try:
+        yield from _run_batches(model_name, image_data, batch_size, cache, detector, writer, gt_data or {})
+    finally:
+        writer.close()
+    if writer.mode != 'none':
+        print(f"[{model_name}] 結果画像: {writer.written} 枚を保存 ({writer.mode})")
+    if cache is not None:
+        print(f"[{model_name}] 予測キャッシュ: ヒット {cache.hits} 件 / 推論 {cache.misses} 件")
+
+def _run_batches(model_name, image_data, batch_size, cache, detector, writer, gt_data):
+    for batch in image_data.batches(batch_size):
+        outputs = [None] * len(batch)
+        hashes = [image_hash(image_data.paths[base_name]) for base_name, _, _, _ in batch]
+        if cache is not None:
+            for i, img_hash in enumerate(hashes):
+                cached = cache.get(img_hash)
+                if cached is not None: outputs[i] = (cached['boxes'], cached['scores'])
+
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        if misses:
+            if detector is None: detector = get_detector(model_name)
+            for i, output in zip(misses, detector.detect_batch_raw([batch[i][1] for i in misses])):
+                outputs[i] = output
+                if cache is not None: cache.put(hashes[i], boxes=output[0], scores=output[1])
+
+        for (base_name, img_bgr, h, w), raw in zip(batch, outputs):
+            pred_boxes, pred_scores = DETECTORS[model_name].filter_raw(*raw)
+            gt_boxes = [b for _, b in gt_data.get(base_name, [])]
+            failed = writer.mode == 'failures' and is_failure(gt_boxes, pred_boxes, IOU_THRESHOLD)
+            # 縮小デコードした画像は推論にだけ使い、結果画像は保存するものだけ元の解像度で読み直して描く
+            vis_source = (lambda p=image_data.paths[base_name]: cv2.imread(p)) if image_data.min_size else img_bgr
+            writer.submit(f"{base_name}.jpg", vis_source, draw_predictions(model_name, pred_boxes), failed)
+            yield base_name, pred_boxes, pred_scores
 
-def evaluate_yunet(image_data):
-    if not os.path.exists(YUNET_MODEL):
-        print(f"エラー: {YUNET_MODEL} が見つかりません。")
-        return {}
-        
-    results_dict = {}
-    detector = cv2.FaceDetectorYN.create(YUNET_MODEL, "", (320, 320))
-    
-    for base_name, img_bgr, h, w in image_data:
-        detector.setInputSize((w, h))
-        _, results = detector.detect(img_bgr)
-        boxes = []
-        if results is not None:
-            for face in results:
-                x, y, bw, bh = face[:4]
-                boxes.append([x/w, y/h, (x+bw)/w, (y+bh)/h])
-        results_dict[base_name] = boxes
-    del detector
-    return results_dict
+# =========================================================
+# プロセス分離による並列評価
+# =========================================================
 
-def evaluate_cv2_dnn(image_data):
-    if not os.path.exists(DNN_PROTOTXT) or not os.path.exists(DNN_CAFFEMODEL):
-        print(f"エラー: OpenCV DNNのモデルファイルが見つかりません。")
-        return {}
-        
-    net = cv2.dnn.readNetFromCaffe(DNN_PROTOTXT, DNN_CAFFEMODEL)
-    results_dict = {}
-    
-    for base_name, img_bgr, h, w in image_data:
-        blob = cv2.dnn.blobFromImage(cv2.resize(img_bgr, (300, 300)), 1.0, (300, 300), (104.0, 177.0, 123.0))
-        net.setInput(blob)
-        detections = net.forward()
-        boxes = []
-        for i in range(detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
-            if confidence > 0.5:
-                x1 = max(0.0, detections[0, 0, i, 3])
-                y1 = max(0.0, detections[0, 0, i, 4])
-                x2 = min(1.0, detections[0, 0, i, 5])
-                y2 = min(1.0, detections[0, 0, i, 6])
-                boxes.append([x1, y1, x2, y2])
-        results_dict[base_name] = boxes
-    del net
-    return results_dict
+def thread_env(threads):
+    # numpy (BLAS) / TensorFlow / PyTorch が import 時に参照するスレッド数
+    env = {key: str(threads) for key in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"]}
+    env["TF_NUM_INTEROP_THREADS"] = "1"
+    return env
+
+@contextlib.contextmanager
+def child_thread_env(threads):
+    """spawn の子プロセスは起動直後にメインモジュールを import し直す (= numpy / cv2 を読み込む) ので、
+    スレッド数の環境変数は子の中ではなく、Process.start() の前に親で設定して引き継がせる"""
+    env = thread_env(threads)
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None: os.environ.pop(key, None)
+            else: os.environ[key] = value
+
+def limit_threads(threads):
+    # 子プロセスの中で後から効くもの (OpenCV のスレッド数と、これから import される TensorFlow 用の環境変数)
+    os.environ.update(thread_env(threads))
+    cv2.setNumThreads(threads)
+
+def model_worker(model_name, dataset_items, batch_size, threads, use_cache, vis, gt_data, reduced_decode, dataset_opts, result_queue):
+    """子プロセスで1モデルを評価し、画像ごとの予測を親へ送る。終了時にメモリはOSへ返る"""
+    limit_threads(threads)
+    try:
+        image_data = LazyImageDataset(dataset_items, **dataset_opts)
+        for base_name, pred_boxes, pred_scores in run_model(model_name, image_data, batch_size, use_cache, vis, gt_data, reduced_decode):
+            result_queue.put(("pred", model_name, base_name, pred_boxes, pred_scores))
+        result_queue.put(("done", model_name, None))
+    except Exception as e:
+        result_queue.put(("done", model_name, str(e)))
+
+def run_models_in_processes(models_to_run, dataset_items, batch_size, jobs, threads, use_cache, vis, gt_data, reduced_decode, dataset_opts, on_prediction):
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    pending = list(models_to_run)
+    running = {}
+    print(f"{jobs} プロセス (各 {threads} スレッド) で並列評価します。")
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            model_name = pending.pop(0)
+            p = ctx.Process(target=model_worker, args=(model_name, dataset_items, batch_size, threads, use_cache, vis, gt_data, reduced_decode, dataset_opts, result_queue))
+            with child_thread_env(threads):
+                p.start()
+            running[model_name] = p
+            print(f"\n[{model_name}] の処理を開始します...")
 
-def evaluate_yolo(image_data, model_path='yolov11n-face.pt'):
-    from ultralytics import YOLO
-    if not os.path.exists(model_path):
-        print(f"エラー: {model_path} が見つかりません。")
-        return {}
-        
-    model = YOLO(model_path)
-    results_dict = {}
-    for base_name, img_bgr, h, w in image_data:
-        detections = model(img_bgr, verbose=False)
-        boxes = [box.xyxyn[0].tolist() for box in detections[0].boxes]
-        results_dict[base_name] = boxes
-    del model
-    return results_dict
+        try:
+            handle_message(result_queue.get(timeout=1.0), running, on_prediction)
+            continue
+        except queue.Empty:
+            pass
+        # 結果を送らずに落ちたプロセス (メモリ不足など) を検出する
+        exited = [model_name for model_name, p in running.items() if p.exitcode is not None]
+        if not exited: continue
+        # 正常終了でも最後の結果がタイムアウトの後に届くことがあるので、キューを読み切ってから判断する
+        while True:
+            try:
+                handle_message(result_queue.get(timeout=0.5), running, on_prediction)
+            except queue.Empty:
+                break
+        for model_name in exited:
+            if model_name in running:
+                print(f"[{model_name}] のプロセスが異常終了しました (exit code {running[model_name].exitcode})。")
+                running.pop(model_name)
+
+def handle_message(msg, running, on_prediction):
+    if msg[0] == "pred":
+        _, model_name, base_name, pred_boxes, pred_scores = msg
+        on_prediction(model_name, base_name, pred_boxes, pred_scores)
+    else:
+        _, model_name, error = msg
+        if error:
+            print(f"[{model_name}] の処理中にエラーが発生しました: {error}")
+        else:
+            print(f"[{model_name}] の処理が完了し、画像を出力しました。プロセスを終了します。")
+        p = running.pop(model_name, None)
+        if p is not None: p.join()
 
 # =========================================================
 # メイン処理
 # =========================================================
 
 def main():
-    image_files = glob.glob(os.path.join(IMAGE_DIR, "*.[pj][pn][g]"))
-    
-    print("画像の事前読み込みと正解ラベルのパースを開始します...")
-    image_data = [] # [(base_name, img_bgr, h, w), ...]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=None, help='1回の推論にまとめる枚数 (省略時は検出器ごとの既定値)')
+    parser.add_argument('--check-batch', action='store_true', help='OpenCV_DNN / YOLOv11 のバッチ推論を1枚ずつの結果と比較して終了')
+    parser.add_argument('--no-cache', action='store_true', help='予測キャッシュを使わずに全画像を推論し直す')
+    parser.add_argument('--jobs', type=int, default=1, help='同時に評価するモデル数 (モデルごとに別プロセス)')
+    parser.add_argument('--threads-per-job', type=int, default=None, help='各プロセスのスレッド数 (省略時は CPU 数 / jobs)')
+    parser.add_argument('--cache-mb', type=int, default=CACHE_MAX_MB, help='デコード済み画像を保持するメモリ上限 (MB, --jobs のときはプロセスごと)')
+    parser.add_argument('--readahead', type=int, default=READAHEAD, help='先読みする枚数')
+    parser.add_argument('--full-decode', action='store_true', help='入力が小さい検出器 (OpenCV_DNN / BlazeFace) でも縮小デコードしない')
+    add_vis_arguments(parser)
+    args = parser.parse_args()
+    vis = vis_options(args)
+
+    print("データセットのマニフェストと正解ラベルの索引を読み込みます (画像は評価時に順次読み込みます)...")
+    manifest = DatasetManifest(IMAGE_DIR, LABEL_DIR) # 変更された画像・ラベルだけ読み直す
+    labels = manifest.labels
+    dataset_items = [] # [(base_name, img_path), ...]
     gt_data = {}    # {base_name: [(cls_id, [x1, y1, x2, y2]), ...]}
     
-    for img_path in image_files:
-        base_name = os.path.splitext(os.path.basename(img_path))[0]
-        label_path = os.path.join(LABEL_DIR, f"{base_name}.txt")
-        if not os.path.exists(label_path): continue
-
-        img_bgr = cv2.imread(img_path)
-        if img_bgr is None: continue
-        h, w = img_bgr.shape[:2]
-        
-        gt_boxes = []
-        with open(label_path, 'r') as f:
-            for line in f:
-                parts = line.split()
-                if not parts: continue
-                cls_id = int(float(parts[0]))
-                if cls_id not in CLASS_NAMES: continue
-                x_c, y_c, bw, bh = map(float, parts[1:])
-                gt_boxes.append((cls_id, [x_c - bw/2, y_c - bh/2, x_c + bw/2, y_c + bh/2]))
+    for base_name, img_path in manifest.pairs(['.jpg', '.png']):
+        cls_ids, boxes = labels.get(base_name)
+        gt_boxes = [(int(c), b.tolist()) for c, b in zip(cls_ids, boxes) if c in CLASS_NAMES]
         
         if gt_boxes: 
-            image_data.append((base_name, img_bgr, h, w))
+            dataset_items.append((base_name, img_path))
             gt_data[base_name] = gt_boxes
 
+    # 全画像をメモリに載せず、必要な分だけデコードする
+    # --jobs のときは各プロセスがこの上限で持つ
+    dataset_opts = {'cache_mb': args.cache_mb, 'readahead': args.readahead}
+    image_data = LazyImageDataset(dataset_items, **dataset_opts)
     print(f"有効な画像ファイル: {len(image_data)} 件")
 
-    models_to_run = {
-        "MTCNN": evaluate_mtcnn,
-        "RetinaFace": evaluate_retinaface,
-        "BlazeFace": evaluate_blazeface,
-        "YuNet": evaluate_yunet,
-        "OpenCV_DNN": evaluate_cv2_dnn,
-        # "YOLOv11": evaluate_yolo,
-    }
+    if args.check_batch:
+        for model_name in ["OpenCV_DNN", "YOLOv11"]:
+            try:
+                compare_batched(model_name, image_data, args.batch_size)
+            except Exception as e:
+                print(f"[{model_name}] の比較中にエラーが発生しました: {e}")
+            release_detector(model_name)
+        return
+
+    models_to_run = [
+        "MTCNN",
+        "RetinaFace",
+        "BlazeFace",
+        "YuNet",
+        "OpenCV_DNN",
+        # "YOLOv11",
+    ]
 
     all_stats = {
         model_name: {i: {"total": 0, "detected": 0} for i in CLASS_NAMES.keys()}
-        for model_name in models_to_run.keys()
+        for model_name in models_to_run
     }
 
-    # --- 順番にロードして評価 ---
-    for model_name, func in models_to_run.items():
-        print(f"\n[{model_name}] の処理を開始します...")
-        
-        model_out_dir = os.path.join(OUTPUT_IMG_DIR, model_name)
-        os.makedirs(model_out_dir, exist_ok=True)
-
-        try:
-            predictions = func(image_data)
-            
-            # --- 判定と画像描画ループ ---
-            for base_name, img_bgr, h, w in image_data:
-                pred_boxes = predictions.get(base_name, [])
-                gt_boxes_for_img = gt_data.get(base_name, [])
+    evaluators = {model_name: DetectionEvaluator() for model_name in models_to_run}
+
+    # --- 評価 (--jobs 2 以上ならモデルごとに別プロセス) ---
+    def on_prediction(model_name, base_name, pred_boxes, pred_scores):
+        gt_boxes = gt_data.get(base_name, [])
+        evaluators[model_name].add(base_name, [c for c, _ in gt_boxes], [b for _, b in gt_boxes], pred_boxes, pred_scores)
+
+    if args.jobs > 1:
+        threads = args.threads_per_job or max(1, (os.cpu_count() or 1) // args.jobs)
+        run_models_in_processes(models_to_run, dataset_items, args.batch_size, args.jobs, threads, not args.no_cache, vis, gt_data, not args.full_decode, dataset_opts, on_prediction)
+    else:
+        for model_name in models_to_run:
+            print(f"\n[{model_name}] の処理を開始します...")
+            try:
+                for base_name, pred_boxes, pred_scores in run_model(model_name, image_data, args.batch_size, not args.no_cache, vis, gt_data, not args.full_decode):
+                    on_prediction(model_name, base_name, pred_boxes, pred_scores)
+                print(f"[{model_name}] の処理が完了し、画像を出力しました。メモリを解放します。")
+            except Exception as e:
+                print(f"[{model_name}] の処理中にエラーが発生しました: {e}")
                 
-                vis_img = img_bgr.copy()
-
-                # 1. 正解ラベル (GT) のIoU判定と集計 (描画はしない)
-                for cls_id, gt_box in gt_boxes_for_img:
-                    all_stats[model_name][cls_id]["total"] += 1
-                    if any(calculate_iou(gt_box, p_box) >= 0.5 for p_box in pred_boxes):
-                        all_stats[model_name][cls_id]["detected"] += 1
-
-                # 2. モデルの検出結果のみを描画 (青色)
-                for p_box in pred_boxes:
-                    x1, y1 = int(p_box[0] * w), int(p_box[1] * h)
-                    x2, y2 = int(p_box[2] * w), int(p_box[3] * h)
-                    cv2.rectangle(vis_img, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                    cv2.putText(vis_img, model_name, (x1, max(y1-20, 10)), 
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1)
-
-                out_path = os.path.join(model_out_dir, f"{base_name}.jpg")
-                cv2.imwrite(out_path, vis_img)
-
-            print(f"[{model_name}] の処理が完了し、画像を出力しました。メモリを解放します。")
-        except Exception as e:
-            print(f"[{model_name}] の処理中にエラーが発生しました: {e}")
-            
-        clear_memory()
+            release_detector(model_name)
+            clear_memory()
+
+    # --- IoU 行列による一括マッチングと集計 ---
+    metrics = {}
+    for model_name, evaluator in evaluators.items():
+        metrics[model_name] = evaluator.evaluate(IOU_THRESHOLD, CLASS_NAMES.keys())
+        for cls_id, m in metrics[model_name]['classes'].items():
+            all_stats[model_name][cls_id]["total"] = m['gt']
+            all_stats[model_name][cls_id]["detected"] = m['detected']
 
     # --- CSVファイルへ書き出し ---
     print(f"\n評価完了。結果を {OUTPUT_CSV} に書き出します。")
@@ -288,8 +338,31 @@ def main():
                 if total > 0:
                     rate = (detected / total * 100)
                     writer.writerow([model_name, name, total, detected, f"{rate:.1f}"])
-                
+
+    write_metrics_csv(metrics)
     print("完了しました！")
 
+def write_metrics_csv(metrics):
+    """1対1マッチングによる precision / recall / AP と、クラス別の PR 曲線を書き出す"""
+    print(f"詳細な指標を {OUTPUT_METRICS_CSV} / {OUTPUT_PR_CSV} に書き出します。")
+    with open(OUTPUT_METRICS_CSV, mode='w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Model", "Glitch Category", "Total Instances", "TP", "FP", "Precision (%)", "Recall (%)", "AP (%)"])
+        for model_name, result in metrics.items():
+            rows = [(CLASS_NAMES[c], m) for c, m in result['classes'].items() if m['gt'] > 0]
+            rows.append(("All", result['overall']))
+            for name, m in rows:
+                writer.writerow([model_name, name, m['gt'], m['tp'], m['fp'],
+                                 f"{m['precision'] * 100:.1f}", f"{m['recall'] * 100:.1f}", f"{m['ap'] * 100:.1f}"])
+
+    with open(OUTPUT_PR_CSV, mode='w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Model", "Glitch Category", "Recall", "Precision"])
+        for model_name, result in metrics.items():
+            for cls_id, m in result['classes'].items():
+                recall, precision = m['curve']
+                for r, p in zip(recall, precision):
+                    writer.writerow([model_name, CLASS_NAMES[cls_id], f"{r:.4f}", f"{p:.4f}"])
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,13 +4,18 @@ import random
 import csv
 import pickle
 import time
+import argparse
+import multiprocessing
 from datetime import timedelta
 from pytubefix import YouTube
 from pytubefix.cli import on_progress
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from index_allocator import IndexAllocator, file_lock
+from drive_uploader import DriveUploader, register_shared_file
+from drive_manifest import DriveManifest, reconcile_before_workers
+from face_gate import FaceGate
 
 # --- 設定エリア ---
 CLIENT_SECRET_FILE = 'credentials.json' 
@@ -20,10 +25,11 @@ CSV_FILE = 'captures_log.csv'
 URL_LIST_FILE = 'urls.txt'
 FOLDER_ID = '1qKmIlYTqYuXxwyu4_XzbF0b2exdlcutc'
 TEMP_VIDEO_NAME = 'temp_video.mp4'
+INDEX_BLOCK_SIZE = 20 # --workers 使用時に各プロセスがまとめて確保する連番の数
+FACE_GATE_BACKEND = 'haar' # 'yunet' にすると同梱の face_detection_yunet_2023mar.onnx で判定 (detectors.py の検出器名も可)
 
 # 顔認識分類器の定義
-frontal_face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-profile_face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+face_gate = FaceGate(FACE_GATE_BACKEND)
 
 RESOLUTIONS = [
     (256, 144), (426, 240), (640, 360), (854, 480), (1280, 720), (1920, 1080), (3840, 2160)
@@ -46,58 +52,49 @@ def get_drive_service():
             pickle.dump(creds, token)
     return build('drive', 'v3', credentials=creds)
 
-def upload_or_update_to_drive(file_name, mimetype='image/jpeg'):
-    try:
-        service = get_drive_service()
-        query = f"name = '{file_name}' and trashed = false"
-        if FOLDER_ID: query += f" and '{FOLDER_ID}' in parents"
-        results = service.files().list(q=query, fields="files(id, name)").execute()
-        items = results.get('files', [])
-        media = MediaFileUpload(file_name, mimetype=mimetype, resumable=True)
-        if items:
-            service.files().update(fileId=items[0]['id'], media_body=media).execute()
-        else:
-            meta = {'name': file_name}
-            if FOLDER_ID: meta['parents'] = [FOLDER_ID]
-            service.files().create(body=meta, media_body=media).execute()
-        print(f"  -> Drive同期: {file_name}")
-    except Exception as e:
-        print(f"  [Drive Error]: {e}")
+_uploader = None
+
+def get_uploader():
+    global _uploader
+    if _uploader is None: _uploader = DriveUploader(get_drive_service, FOLDER_ID, manifest=DriveManifest())
+    return _uploader
+
+def upload_or_update_to_drive(file_name, mimetype='image/jpeg', delete_after=False):
+    # 送信はバックグラウンドで行う (キューが満杯のときだけ待つ)
+    get_uploader().submit(file_name, mimetype, delete_after)
 
 def format_time(seconds): return str(timedelta(seconds=int(seconds)))
-def get_next_index():
-    if not os.path.exists(COUNTER_FILE): return 1
-    with open(COUNTER_FILE, 'r') as f:
-        try: return int(f.read().strip())
-        except: return 1
-def save_next_index(index):
-    with open(COUNTER_FILE, 'w') as f: f.write(str(index))
+
+def ensure_csv():
+    """見出し行だけの CSV を作っておく (既にあれば何もしない)"""
+    with file_lock(CSV_FILE):
+        if os.path.isfile(CSV_FILE): return
+        with open(CSV_FILE, mode='w', newline='', encoding='utf-8-sig') as f:
+            csv.writer(f).writerow(['題名', 'URL', '時間', '解像度'])
 
 def log_to_csv(title, url, timestamp, res_text):
-    exists = os.path.isfile(CSV_FILE)
-    with open(CSV_FILE, mode='a', newline='', encoding='utf-8-sig') as f:
-        writer = csv.writer(f)
-        if not exists: writer.writerow(['題名', 'URL', '時間', '解像度'])
-        writer.writerow([title, url, timestamp, res_text])
+    ensure_csv()
+    with file_lock(CSV_FILE):
+        with open(CSV_FILE, mode='a', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow([title, url, timestamp, res_text])
 
 # --- 顔認識 (ガバガバ設定) ---
 def contains_face(frame_data):
-    gray = cv2.cvtColor(frame_data, cv2.COLOR_BGR2GRAY)
-    f_faces = frontal_face_cascade.detectMultiScale(gray, 1.1, 20, minSize=(50, 50))
-    if len(f_faces) > 0: return True
-    p_faces = profile_face_cascade.detectMultiScale(gray, 1.1, 20, minSize=(50, 50))
-    if len(p_faces) > 0: return True
-    gray_flipped = cv2.flip(gray, 1)
-    p_flipped = profile_face_cascade.detectMultiScale(gray_flipped, 1.1, 20, minSize=(50, 50))
-    return len(p_flipped) > 0
+    # 縮小画像で判定し、どれか1つが反応した時点で打ち切る (詳細は face_gate.py)
+    return face_gate(frame_data)
 
 # --- メインロジック ---
 
-def process_single_video(youtube_url):
-    current_index = get_next_index()
+def process_single_video(youtube_url, allocator=None):
+    if allocator is None:
+        allocator = IndexAllocator(COUNTER_FILE)
+    saved_count = 0
+    # 並列実行時に一時ファイルが衝突しないようプロセスごとに名前を分ける
+    temp_video = f"{os.path.splitext(TEMP_VIDEO_NAME)[0]}_{os.getpid()}.mp4"
     
     # 以前の残骸があれば削除
-    if os.path.exists(TEMP_VIDEO_NAME): os.remove(TEMP_VIDEO_NAME)
+    if os.path.exists(temp_video): os.remove(temp_video)
 
     try:
         # OAuth認証を有効にしてYouTubeオブジェクトを作成
@@ -115,14 +112,14 @@ def process_single_video(youtube_url):
             video_stream = yt.streams.get_highest_resolution()
 
         print(f"\n📥 ダウンロード開始 ({video_stream.resolution}): {yt.title}")
-        video_stream.download(filename=TEMP_VIDEO_NAME)
+        video_stream.download(filename=temp_video)
         
     except Exception as e:
         print(f"❌ Pytubefixエラー: {e}")
-        return current_index
+        return saved_count
 
     # OpenCVで解析
-    cap = cv2.VideoCapture(TEMP_VIDEO_NAME)
+    cap = cv2.VideoCapture(temp_video)
     duration = int(yt.length)
     current_time_sec = 30
     
@@ -138,26 +135,44 @@ def process_single_video(youtube_url):
                 t_res = (w, h) if (h >= 2160 and random.random() < 0.5) else random.choice(valid_res)
                 
                 final_frame = cv2.resize(frame, (t_res[0], t_res[1]), interpolation=cv2.INTER_AREA)
-                file_name = f"not_glitch_image_{current_index:05d}.jpg"
+                file_name = f"not_glitch_image_{allocator.next():05d}.jpg"
                 cv2.imwrite(file_name, final_frame)
                 
                 log_to_csv(yt.title, youtube_url, timestamp, f"{t_res[1]}p")
-                upload_or_update_to_drive(file_name)
-                if os.path.exists(file_name): os.remove(file_name)
+                upload_or_update_to_drive(file_name, delete_after=True)
                 
                 print(f"  [{timestamp}] ✅ 顔あり保存: {t_res[1]}p")
-                current_index += 1
-                save_next_index(current_index)
+                saved_count += 1
             else:
                 print(f"  [{timestamp}] ⏩ 顔なし")
         
         current_time_sec += random.randint(30, 90)
 
     cap.release()
-    if os.path.exists(TEMP_VIDEO_NAME): os.remove(TEMP_VIDEO_NAME)
-    return current_index
+    if os.path.exists(temp_video): os.remove(temp_video)
+    return saved_count
+
+# --- 並列処理 (--workers) ---
+_worker_allocator = None
+
+def init_worker():
+    global _worker_allocator
+    _worker_allocator = IndexAllocator(COUNTER_FILE, INDEX_BLOCK_SIZE)
+
+def process_url_in_worker(url):
+    try:
+        saved = process_single_video(url, _worker_allocator)
+        upload_or_update_to_drive(CSV_FILE, mimetype='text/csv')
+        get_uploader().flush()
+        return url, saved, None
+    except Exception as e:
+        return url, 0, str(e)
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='同時に処理する動画の数 (プロセス数)')
+    args = parser.parse_args()
+
     if not os.path.exists(URL_LIST_FILE):
         print(f"エラー: {URL_LIST_FILE} が必要です。")
         return
@@ -165,6 +180,19 @@ def main():
         urls = [line.strip() for line in f if line.strip()]
 
     print(f"🚀 Pytubefixによる解析を開始します（計 {len(urls)} 本）")
+    if args.workers > 1:
+        # 認証 (token.pickle の更新やブラウザでのログイン) は親で一度だけ行い、ワーカーは有効なトークンを読むだけにする
+        service = get_drive_service()
+        reconcile_before_workers(lambda: service, FOLDER_ID)
+        ensure_csv()
+        register_shared_file(service, FOLDER_ID, CSV_FILE, 'text/csv')
+        with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+            for i, (url, saved, error) in enumerate(pool.imap_unordered(process_url_in_worker, urls), 1):
+                print(f"\n--- Progress: {i}/{len(urls)} ({saved} 枚保存) ---")
+                if error: print(f"⚠️ スキップ ({url}): {error}")
+        print("\n✨ 完了しました。")
+        return
+
     for i, url in enumerate(urls, 1):
         print(f"\n--- Progress: {i}/{len(urls)} ---")
         try:
@@ -173,6 +201,7 @@ def main():
         except Exception as e:
             print(f"⚠️ スキップ: {e}")
             continue
+    get_uploader().close()
     print("\n✨ 完了しました。")
 
 if __name__ == "__main__":
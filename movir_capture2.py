@@ -12,16 +12,28 @@ import pickle
 
 import time
 
+import argparse
+
+import multiprocessing
+
 from datetime import timedelta
 
 from googleapiclient.discovery import build
 
-from googleapiclient.http import MediaFileUpload
-
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 from google.auth.transport.requests import Request
 
+from keyframe_sampler import plan_sample_times, probe_keyframes, snap_to_keyframes, KeyframeWalker
+
+from index_allocator import IndexAllocator, file_lock
+
+from drive_uploader import DriveUploader, register_shared_file
+
+from drive_manifest import DriveManifest, reconcile_before_workers
+
+from face_gate import FaceGate
+
 
 
 # --- 設定エリア ---
@@ -40,13 +52,17 @@ COOKIE_FILE = 'youtube_cookies.txt' # Macから転送したクッキーファイ
 
 FOLDER_ID = '1qKmIlYTqYuXxwyu4_XzbF0b2exdlcutc'
 
+SAMPLING_MODE = 'keyframe' # 'keyframe': キーフレームへ寄せて前方向に読む / 'seek': 毎回シーク (従来方式)
 
+INDEX_BLOCK_SIZE = 20 # --workers 使用時に各プロセスがまとめて確保する連番の数
 
-# 顔認識分類器の定義
+FACE_GATE_BACKEND = 'haar' # 'yunet' にすると同梱の face_detection_yunet_2023mar.onnx で判定 (detectors.py の検出器名も可)
 
-frontal_face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
 
-profile_face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_profileface.xml')
+
+# 顔認識 (縮小画像で判定し、どれか1つが反応した時点で打ち切る)
+
+face_gate = FaceGate(FACE_GATE_BACKEND)
 
 
 
@@ -94,47 +110,29 @@ def get_drive_service():
 
 
 
-def upload_or_update_to_drive(file_name, mimetype='image/jpeg'):
+_uploader = None
 
-    try:
 
-        service = get_drive_service()
 
-        query = f"name = '{file_name}' and trashed = false"
+def get_uploader():
 
-        if FOLDER_ID:
+    # 認証済みクライアントを持つアップローダーをプロセスごとに1つだけ作る
 
-            query += f" and '{FOLDER_ID}' in parents"
+    global _uploader
 
-        results = service.files().list(q=query, fields="files(id, name)").execute()
+    if _uploader is None:
 
-        items = results.get('files', [])
+        _uploader = DriveUploader(get_drive_service, FOLDER_ID, manifest=DriveManifest())
 
-        media = MediaFileUpload(file_name, mimetype=mimetype, resumable=True)
+    return _uploader
 
-        if items:
 
-            file_id = items[0]['id']
 
-            service.files().update(fileId=file_id, media_body=media).execute()
-
-            print(f"  -> Drive更新完了: {file_name}")
-
-        else:
+def upload_or_update_to_drive(file_name, mimetype='image/jpeg', delete_after=False):
 
-            file_metadata = {'name': file_name}
+    # 送信はバックグラウンドで行う (キューが満杯のときだけ待つ)
 
-            if FOLDER_ID:
-
-                file_metadata['parents'] = [FOLDER_ID]
-
-            service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-
-            print(f"  -> Drive新規保存: {file_name}")
-
-    except Exception as e:
-
-        print(f"  [Drive Error]: {e}")
+    get_uploader().submit(file_name, mimetype, delete_after)
 
 
 
@@ -148,41 +146,33 @@ def format_time(seconds):
 
 
 
-def get_next_index():
-
-    if os.path.exists(COUNTER_FILE):
+def ensure_csv():
 
-        with open(COUNTER_FILE, 'r') as f:
+    """見出し行だけの CSV を作っておく (既にあれば何もしない)"""
 
-            try: return int(f.read().strip())
+    with file_lock(CSV_FILE):
 
-            except: return 1
+        if os.path.isfile(CSV_FILE): return
 
-    return 1
+        with open(CSV_FILE, mode='w', newline='', encoding='utf-8-sig') as f:
 
-
-
-def save_next_index(index):
-
-    with open(COUNTER_FILE, 'w') as f:
-
-        f.write(str(index))
+            csv.writer(f).writerow(['題名', 'URL', '時間', '解像度'])
 
 
 
 def log_to_csv(title, url, timestamp, res_text):
 
-    file_exists = os.path.isfile(CSV_FILE)
+    ensure_csv()
 
-    with open(CSV_FILE, mode='a', newline='', encoding='utf-8-sig') as f:
+    # 複数プロセスから同時に追記されても行が混ざらないようにロックする
 
-        writer = csv.writer(f)
+    with file_lock(CSV_FILE):
 
-        if not file_exists:
+        with open(CSV_FILE, mode='a', newline='', encoding='utf-8-sig') as f:
 
-            writer.writerow(['題名', 'URL', '時間', '解像度'])
+            writer = csv.writer(f)
 
-        writer.writerow([title, url, timestamp, res_text])
+            writer.writerow([title, url, timestamp, res_text])
 
 
 
@@ -190,9 +180,13 @@ def log_to_csv(title, url, timestamp, res_text):
 
 
 
-def process_single_video(youtube_url):
+def process_single_video(youtube_url, allocator=None):
 
-    current_index = get_next_index()
+    if allocator is None:
+
+        allocator = IndexAllocator(COUNTER_FILE)
+
+    saved_count = 0
 
    
 
@@ -258,7 +252,7 @@ def process_single_video(youtube_url):
 
             print(f"URL解析エラー ({youtube_url}): {e}")
 
-            return current_index
+            return saved_count
 
 
 
@@ -280,7 +274,7 @@ def process_single_video(youtube_url):
 
         print("エラー: 動画ストリームを開けませんでした。")
 
-        return current_index
+        return saved_count
 
 
 
@@ -288,35 +282,13 @@ def process_single_video(youtube_url):
 
    
 
-    def contains_face(frame_data):
-
-        gray = cv2.cvtColor(frame_data, cv2.COLOR_BGR2GRAY)
+    def save_and_cleanup(frame_data, time_str):
 
-        # 4Kの場合、顔が相対的に小さくなるため、minNeighborsとminSizeを微調整
-
-        frontal_faces = frontal_face_cascade.detectMultiScale(gray, 1.1, 20, minSize=(50, 50))
-
-        if len(frontal_faces) > 0: return True
-
-        profile_faces = profile_face_cascade.detectMultiScale(gray, 1.1, 20, minSize=(50, 50))
-
-        if len(profile_faces) > 0: return True
-
-        gray_flipped = cv2.flip(gray, 1)
-
-        profile_flipped = profile_face_cascade.detectMultiScale(gray_flipped, 1.1, 20, minSize=(50, 50))
-
-        return len(profile_flipped) > 0
-
-
-
-    def save_and_cleanup(frame_data, time_str, index):
-
-        if not contains_face(frame_data):
+        if not face_gate(frame_data):
 
             print(f"  [Skip] 顔なし ({time_str})")
 
-            return index
+            return False
 
 
 
@@ -338,7 +310,7 @@ def process_single_video(youtube_url):
 
         final_frame = cv2.resize(frame_data, target_res, interpolation=cv2.INTER_AREA)
 
-        file_name = f"not_glitch_image_{index:05d}.jpg"
+        file_name = f"not_glitch_image_{allocator.next():05d}.jpg"
 
         cv2.imwrite(file_name, final_frame)
 
@@ -346,62 +318,150 @@ def process_single_video(youtube_url):
 
         log_to_csv(title, youtube_url, time_str, f"{target_res[1]}p")
 
-        upload_or_update_to_drive(file_name)
+        upload_or_update_to_drive(file_name, delete_after=True)
 
        
 
         print(f"  -> 保存完了: {target_res[1]}p (入力: {actual_h}p)")
 
-        if os.path.exists(file_name): os.remove(file_name)
+        return True
 
-        return index + 1
 
 
+    if SAMPLING_MODE == 'keyframe':
 
-    while current_time_sec < duration:
+        # 全サンプリング時刻を先に決め、キーフレームに寄せてから前方向にだけ読む
 
-        cap.set(cv2.CAP_PROP_POS_MSEC, current_time_sec * 1000)
+        sample_times = plan_sample_times(duration)
 
-        cap.grab() # シーク安定化
+        sample_times = snap_to_keyframes(sample_times, probe_keyframes(stream_url, sample_times))
 
-        success, frame = cap.read()
+        walker = KeyframeWalker(cap, cap.get(cv2.CAP_PROP_FPS))
 
-       
 
-        if success:
 
-            timestamp = format_time(current_time_sec)
+        for sample_sec in sample_times:
 
-            print(f"[{timestamp}] スキャン中...")
+            success, frame = walker.read_at(sample_sec)
 
-            current_index = save_and_cleanup(frame, timestamp, current_index)
+            if success:
 
-            save_next_index(current_index)
+                timestamp = format_time(sample_sec)
 
-        else:
+                print(f"[{timestamp}] スキャン中...")
+
+                if save_and_cleanup(frame, timestamp): saved_count += 1
+
+            else:
 
-            print(f"[{format_time(current_time_sec)}] フレーム取得失敗。再接続します。")
+                print(f"[{format_time(sample_sec)}] フレーム取得失敗。再接続します。")
 
-            cap.release()
+                cap.release()
 
-            time.sleep(5)
+                time.sleep(5)
 
-            cap = cv2.VideoCapture(stream_url, cv2.CAP_FFMPEG)
+                cap = cv2.VideoCapture(stream_url, cv2.CAP_FFMPEG)
+
+                walker.reset(cap)
+
+
+
+        if saved_count:
+
+            print(f"  デコード {walker.decoded} フレーム / 保存 {saved_count} 枚 ({walker.decoded / saved_count:.1f} フレーム/枚)")
+
+
+
+    else:
+
+        while current_time_sec < duration:
+
+            cap.set(cv2.CAP_PROP_POS_MSEC, current_time_sec * 1000)
+
+            cap.grab() # シーク安定化
+
+            success, frame = cap.read()
+
+       
 
+            if success:
 
+                timestamp = format_time(current_time_sec)
 
-        current_time_sec += random.randint(30, 75)
+                print(f"[{timestamp}] スキャン中...")
+
+                if save_and_cleanup(frame, timestamp): saved_count += 1
+
+            else:
+
+                print(f"[{format_time(current_time_sec)}] フレーム取得失敗。再接続します。")
+
+                cap.release()
+
+                time.sleep(5)
+
+                cap = cv2.VideoCapture(stream_url, cv2.CAP_FFMPEG)
+
+
+
+            current_time_sec += random.randint(30, 75)
 
 
 
     cap.release()
 
-    return current_index
+    return saved_count
+
+
+
+# --- 並列処理 (--workers) ---
+
+
+
+_worker_allocator = None
+
+
+
+def init_worker():
+
+    # 各プロセスは連番をブロック単位で確保し、ファイル名の重複を防ぐ
+
+    global _worker_allocator
+
+    _worker_allocator = IndexAllocator(COUNTER_FILE, INDEX_BLOCK_SIZE)
+
+
+
+def process_url_in_worker(url):
+
+    try:
+
+        saved = process_single_video(url, _worker_allocator)
+
+        upload_or_update_to_drive(CSV_FILE, mimetype='text/csv')
+
+        # プールのプロセスは終了処理が呼ばれないため、動画ごとに送信完了を待つ
+
+        get_uploader().flush()
+
+        return url, saved, None
+
+    except Exception as e:
+
+        return url, 0, str(e)
 
 
 
 def main():
 
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--workers', type=int, default=1, help='同時に処理する動画の数 (プロセス数)')
+
+    args = parser.parse_args()
+
+
+
     if not os.path.exists(URL_LIST_FILE):
 
         print(f"エラー: {URL_LIST_FILE} が見つかりません。")
@@ -416,6 +476,34 @@ def main():
 
     print(f"合計 {len(urls)} 本（計約450時間）を4K解析します。")
 
+    if args.workers > 1:
+
+        print(f"{args.workers} プロセスで並列処理します。")
+
+        # 認証 (token.pickle の更新やブラウザでのログイン) は親で一度だけ行い、ワーカーは有効なトークンを読むだけにする
+
+        service = get_drive_service()
+
+        reconcile_before_workers(lambda: service, FOLDER_ID)
+
+        ensure_csv()
+
+        register_shared_file(service, FOLDER_ID, CSV_FILE, 'text/csv')
+
+        with multiprocessing.Pool(args.workers, initializer=init_worker) as pool:
+
+            for i, (url, saved, error) in enumerate(pool.imap_unordered(process_url_in_worker, urls), 1):
+
+                print(f"\n--- Progress: {i}/{len(urls)} ({saved} 枚保存) ---")
+
+                if error: print(f"致命的エラー ({url}): {error}")
+
+        print("\n✨ すべての処理が完了しました。")
+
+        return
+
+
+
     for i, url in enumerate(urls, 1):
 
         print(f"\n--- Progress: {i}/{len(urls)} ---")
@@ -432,6 +520,8 @@ def main():
 
             continue
 
+    get_uploader().close()
+
     print("\n✨ すべての処理が完了しました。")
 
 
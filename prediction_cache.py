@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# --- 設定 ---
+CACHE_DIR = ".prediction_cache"
+
+_hash_memo = {}
+
+def image_hash(path):
+    """画像ファイルの内容ハッシュ (同じプロセス内では mtime / サイズが同じなら再計算しない)"""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if memo_key not in _hash_memo:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _hash_memo[memo_key] = h.hexdigest()
+    return _hash_memo[memo_key]
+
+class PredictionCache:
+    """検出結果 (スコア付きの生の予測) を内容アドレスで保存するキャッシュ。
+    キーは 検出器名・バージョン・パラメータ・画像の内容ハッシュ。画像が変われば自動的に再計算される。"""
+
+    def __init__(self, model_name, version, params=None, cache_dir=CACHE_DIR):
+        self.dir = os.path.join(cache_dir, model_name)
+        # パラメータが変わったら別キーになるよう、署名に含めておく
+        self.signature = json.dumps([model_name, version, sorted((params or {}).items())], default=str)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _path(self, img_hash):
+        key = hashlib.sha1(f"{self.signature}|{img_hash}".encode('utf-8')).hexdigest()
+        return os.path.join(self.dir, key[:2], f"{key}.npz")
+
+    def get(self, img_hash):
+        """保存済みなら {名前: 配列} を返す。なければ None"""
+        path = self._path(img_hash)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as data:
+                arrays = {k: data[k] for k in data.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, img_hash, **arrays):
+        path = self._path(img_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
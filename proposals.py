@@ -0,0 +1,85 @@
+import cv2
+import threading
+import numpy as np
+from detectors import DETECTORS, get_detector
+from image_loader import load_reduced
+from prediction_cache import PredictionCache, image_hash
+
+# --- 設定 ---
+DEFAULT_MODEL = "RetinaFace" # Test_result.csv で Texture discoloration / Mesh collapse の検出率が高い
+DEFAULT_LOOKAHEAD = 5        # 現在の画像から何枚先まで推論しておくか
+
+class ProposalWorker:
+    """アノテーション中の画像の先を別スレッドで推論し、候補ボックスを用意しておく。
+    結果は PredictionCache (model_test.py と共通) に保存するので、2回目以降は推論しない。
+    params は検出器のパラメータ (しきい値など)。既定値と違えば予測キャッシュのキーも変わる。
+    get() はブロックしない。まだなら None。"""
+
+    def __init__(self, image_paths, model_name=DEFAULT_MODEL, lookahead=DEFAULT_LOOKAHEAD,
+                 params=None):
+        self.image_paths = image_paths
+        self.model_name = model_name
+        self.lookahead = lookahead
+        self.params = params or {}
+        # model_test.py と同じキー (既定のパラメータと、縮小デコードする検出器はその入力サイズも含める)
+        self.input_size = DETECTORS[model_name].input_size
+        cache_params = DETECTORS[model_name].cache_params(**self.params)
+        if self.input_size: cache_params["decode_min_size"] = self.input_size
+        self.cache = PredictionCache(model_name, DETECTORS[model_name].version, cache_params)
+        self.detector = None
+        self.error = None
+        self.results = {} # {idx: (正規化 xyxy (N, 4), スコア (N,))}
+        self.center = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def request(self, idx):
+        with self.lock:
+            if idx == self.center: return
+            self.center = idx
+        self.wake.set()
+
+    def get(self, idx):
+        with self.lock:
+            return self.results.get(idx)
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+
+    def _run(self):
+        while not self.stopped and self.error is None:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock: center = self.center
+            for idx in range(center, min(len(self.image_paths), center + self.lookahead + 1)):
+                if self.stopped or self.wake.is_set(): break # 移動したら新しい位置から推論し直す
+                with self.lock:
+                    if idx in self.results: continue
+                try:
+                    boxes, scores = self._predict(self.image_paths[idx])
+                except Exception as e:
+                    # 検出器が使えない環境では候補なしで続ける (手作業のアノテーションは止めない)
+                    print(f"[{self.model_name}] 候補の推論に失敗しました。以降は候補を表示しません: {e}")
+                    self.error = e
+                    break
+                with self.lock:
+                    self.results[idx] = (boxes, scores)
+
+    def _predict(self, path):
+        img_hash = image_hash(path)
+        cached = self.cache.get(img_hash)
+        if cached is not None:
+            return DETECTORS[self.model_name].filter_raw(cached['boxes'], cached['scores'], **self.params)
+        img_bgr = load_reduced(path, min_size=self.input_size, img_hash=img_hash)[0] if self.input_size else cv2.imread(path)
+        if img_bgr is None:
+            return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        if self.detector is None:
+            self.detector = get_detector(self.model_name, **self.params)
+        # キャッシュには絞り込む前の結果を置く (model_test.py と共有するため)
+        boxes, scores = self.detector.detect_batch_raw([img_bgr])[0]
+        self.cache.put(img_hash, boxes=boxes, scores=scores)
+        return DETECTORS[self.model_name].filter_raw(boxes, scores, **self.params)
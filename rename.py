@@ -2,6 +2,12 @@ import os
 import shutil
 from PIL import Image
 import re
+import csv
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataset_manifest import DatasetManifest
+from prediction_cache import image_hash
 
 # --- 設定（モード2用） ---
 # 画像が入っているフォルダと、ラベル(txt)が入っているフォルダを指定してください
@@ -9,79 +15,249 @@ IMG_SRC = "output"
 LBL_SRC = "merged_output"
 IMG_DST = "reindexed_images"
 LBL_DST = "reindexed_labels"
+MAP_FILE = ".reindex_map.csv" # 元のファイル名 → 新しい番号 の対応表 (IMG_DST 内)
+MAP_FIELDS = ["new_base", "src_image", "src_label", "img_size", "img_mtime_ns", "label_size", "label_mtime_ns", "transfer"]
+TRANSFER_MODES = ["link", "move", "copy"]
+REINDEX_WORKERS = 8 # ファイル操作のスレッド数
 
-def reindex_pairs(img_src, lbl_src, img_dst, lbl_dst):
-    """画像とテキストのペアを維持したまま欠番を詰める"""
+# --- 設定（モード0用） ---
+CONVERT_EXTS = {".webp", ".avif", ".gif"}
+CONVERT_WORKERS = os.cpu_count() or 1 # 変換のプロセス数
+JPEG_QUALITY = 95
+JPEG_OPTIMIZE = False    # True にすると少し小さくなるが保存が遅くなる
+JPEG_PROGRESSIVE = False
+CONVERT_LOG_FILE = ".convert_log.csv" # 変換済みファイルの記録 (出力フォルダ内)
+CONVERT_LOG_FIELDS = ["dst_name", "src_name", "src_size", "src_mtime_ns", "src_hash", "settings"]
+
+def natural_key(name):
+    # 数字が含まれる場合は数値順になるようにソート
+    return [int(s) if s.isdigit() else s.lower() for s in re.split(r'(\d+)', name)]
+
+def load_reindex_map(map_path):
+    """{元の画像名: {...}} (前回までに割り当てた番号)"""
+    mapping = {}
+    if not os.path.exists(map_path): return mapping
+    with open(map_path, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            mapping[row["src_image"]] = row
+    return mapping
+
+def save_reindex_map(map_path, mapping):
+    tmp_path = f"{map_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=MAP_FIELDS)
+        writer.writeheader()
+        for row in sorted(mapping.values(), key=lambda r: r["new_base"]):
+            writer.writerow({k: row.get(k, "") for k in MAP_FIELDS}) # 古い対応表には画像のサイズ・mtime がない
+    os.replace(tmp_path, map_path)
+
+def place_file(src, dst, transfer):
+    """link: ハードリンク (別ドライブなどで失敗したらコピー) / move: 移動 / copy: コピー"""
+    if os.path.exists(dst): os.remove(dst)
+    if transfer == "move":
+        shutil.move(src, dst)
+        return "move"
+    if transfer == "link":
+        try:
+            os.link(src, dst)
+            return "link"
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+def reindex_pairs(img_src, lbl_src, img_dst, lbl_dst, transfer="link", dry_run=False, workers=REINDEX_WORKERS):
+    """画像とテキストのペアを維持したまま欠番を詰める。
+    割り当てた番号は対応表 (img_dst/.reindex_map.csv) に残し、2回目以降は新しいペアと、
+    同じ名前で差し替えられた画像・書き換えられたラベルだけを処理する (一度付けた番号は変わらない)"""
+    if transfer not in TRANSFER_MODES:
+        raise ValueError(f"不明な転送方法: {transfer}")
     for d in [img_dst, lbl_dst]:
-        if not os.path.exists(d): os.makedirs(d)
+        if not os.path.exists(d) and not dry_run: os.makedirs(d)
 
     # 対応する画像拡張子
     img_exts = {".jpg", ".jpeg", ".png", ".webp"}
     
-    # 画像フォルダ内のファイルを取得
-    all_files = os.listdir(img_src)
-    
-    # ペアが存在するものだけを抽出
-    pairs = []
-    for f in all_files:
-        base, ext = os.path.splitext(f)
-        if ext.lower() in img_exts:
-            lbl_path = os.path.join(lbl_src, f"{base}.txt")
-            if os.path.exists(lbl_path):
-                pairs.append((f, f"{base}.txt")) # (画像名, テキスト名)
-
-    # 元のファイル名でソート（順番を維持するため）
-    # 数字が含まれる場合は数値順になるようにソート
-    pairs.sort(key=lambda x: [int(s) if s.isdigit() else s.lower() for s in re.split(r'(\d+)', x[0])])
+    # ペアが存在するものだけをマニフェストから抽出 (ファイルごとの exists は呼ばない)
+    # ドライランでは元フォルダにマニフェストやラベル索引を書かない
+    manifest = DatasetManifest(img_src, lbl_src, persist=not dry_run)
+    pairs = [(os.path.basename(path), f"{base}.txt") for base, path in manifest.pairs(img_exts)] # (画像名, テキスト名)
 
     if not pairs:
         print("整合するペアが見つかりませんでした。フォルダ設定を確認してください。")
         return
 
-    print(f"欠番詰めを開始します: {len(pairs)} ペア見つかりました。")
+    map_path = os.path.join(img_dst, MAP_FILE)
+    mapping = load_reindex_map(map_path)
+    next_id = max((int(r["new_base"].rsplit("_", 1)[1]) for r in mapping.values()), default=0) + 1
 
-    for i, (img_name, lbl_name) in enumerate(pairs, 1):
-        new_base = f"glitch_image_{str(i).zfill(6)}"
-        
-        # 画像のコピー
-        old_img_path = os.path.join(img_src, img_name)
-        new_img_ext = os.path.splitext(img_name)[1]
-        new_img_path = os.path.join(img_dst, f"{new_base}{new_img_ext}")
-        shutil.copy2(old_img_path, new_img_path)
+    # 新しいペアは元のファイル名順 (数値順) で、前回の続きの番号を付ける
+    jobs = [] # (画像を置くか, 行)
+    for img_name, lbl_name in sorted(pairs, key=lambda x: natural_key(x[0])):
+        st = os.stat(os.path.join(lbl_src, lbl_name))
+        img = manifest.entries[img_name] # 画像のサイズ・mtime はマニフェストの走査で取得済み
+        img_stat = (str(img["size"]), str(img["mtime_ns"]))
+        label_stat = (str(st.st_size), str(st.st_mtime_ns))
+        row = mapping.get(img_name)
+        if row is None:
+            row = {"new_base": f"glitch_image_{str(next_id).zfill(6)}", "src_image": img_name, "src_label": lbl_name}
+            next_id += 1
+            place_image = True
+        else:
+            # 同じ名前で画像が差し替えられていたら置き直す (古い対応表の行は一度だけ置き直す)
+            place_image = (row.get("img_size"), row.get("img_mtime_ns")) != img_stat
+            if not place_image and (row["label_size"], row["label_mtime_ns"]) == label_stat:
+                continue
+            row = dict(row)
+        row["img_size"], row["img_mtime_ns"] = img_stat
+        row["label_size"], row["label_mtime_ns"] = label_stat
+        jobs.append((place_image, row))
 
-        # ラベルのコピー
-        old_lbl_path = os.path.join(lbl_src, lbl_name)
-        new_lbl_path = os.path.join(lbl_dst, f"{new_base}.txt")
-        shutil.copy2(old_lbl_path, new_lbl_path)
+    def action_of(place_image, row):
+        if row["src_image"] not in mapping: return "[連番]"
+        return "[画像差し替え]" if place_image else "[ラベル更新]"
 
-        print(f"[連番] {new_base} <- {img_name} & {lbl_name}")
+    actions = [action_of(place_image, row) for place_image, row in jobs]
+    print(f"ペア {len(pairs)} 件 / 対応表 {len(mapping)} 件 → 新規 {actions.count('[連番]')} 件 / "
+          f"画像差し替え {actions.count('[画像差し替え]')} 件 / ラベル更新 {actions.count('[ラベル更新]')} 件 ({transfer})")
+    if dry_run:
+        for action, (place_image, row) in zip(actions, jobs):
+            print(f"{action} {row['new_base']} <- {row['src_image']} & {row['src_label']}")
+        print("\nドライランのため、ファイルは変更していません。")
+        return
 
-    print(f"\n完了しました。出力先: '{img_dst}', '{lbl_dst}'")
+    def run_job(job):
+        place_image, row = job
+        ext = os.path.splitext(row["src_image"])[1]
+        if place_image:
+            img_path = os.path.join(img_dst, f"{row['new_base']}{ext}")
+            # 前回ハードリンクで置いた画像は差し替え前の実体を指したままなので、先にリンクを外してから置き直す
+            if row.get("transfer") == "link" and os.path.lexists(img_path): os.remove(img_path)
+            row["transfer"] = place_file(os.path.join(img_src, row["src_image"]), img_path, transfer)
+        # ラベルはアノテーション時にその場で書き換えるので、move 以外はコピーして元と切り離す
+        place_file(os.path.join(lbl_src, row["src_label"]), os.path.join(lbl_dst, f"{row['new_base']}.txt"),
+                   "move" if transfer == "move" else "copy")
+        return row
 
-# --- 既存の関数（0, 1）はそのまま保持 ---
-def rename_and_convert_avif_webp_to_jpg(src_dir, dst_dir):
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            row = futures[future][1]
+            try:
+                mapping[row["src_image"]] = future.result()
+                done += 1
+                print(f"[連番] {row['new_base']} <- {row['src_image']} & {row['src_label']}")
+            except OSError as e:
+                print(f"⚠️ 失敗: {row['src_image']} ({e})")
+    # 途中で失敗しても、終わった分は次回やり直さない
+    save_reindex_map(map_path, mapping)
+
+    print(f"\n完了しました ({done}/{len(jobs)} 件)。出力先: '{img_dst}', '{lbl_dst}' / 対応表: '{map_path}'")
+
+# --- 既存の関数（0, 1） ---
+def load_convert_log(log_path):
+    """{出力ファイル名: {...}} (前回変換したときの元ファイルと設定)"""
+    if not os.path.exists(log_path): return {}
+    with open(log_path, 'r', newline='', encoding='utf-8') as f:
+        return {row["dst_name"]: row for row in csv.DictReader(f)}
+
+def save_convert_log(log_path, log):
+    tmp_path = f"{log_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CONVERT_LOG_FIELDS)
+        writer.writeheader()
+        for name in sorted(log):
+            writer.writerow({k: log[name][k] for k in CONVERT_LOG_FIELDS})
+    os.replace(tmp_path, log_path)
+
+def convert_one(task):
+    """1ファイルを変換 (またはコピー) する。プロセスプールから呼ばれる。
+    前回と同じ内容・同じ設定で出力済みならスキップする"""
+    file_path, save_path, settings, prev = task
+    ext = os.path.splitext(file_path)[1].lower()
+    tmp_path = f"{save_path}.{os.getpid()}.tmp"
+    t0 = time.perf_counter()
+    # 読めないファイルが1つあってもバッチ全体 (と変換記録の保存) を止めないよう、stat とハッシュも try の中で行う
+    try:
+        st = os.stat(file_path)
+        row = {"dst_name": os.path.basename(save_path), "src_name": os.path.basename(file_path),
+               "src_size": str(st.st_size), "src_mtime_ns": str(st.st_mtime_ns), "settings": settings}
+        if prev and prev["settings"] == settings and os.path.exists(save_path):
+            # mtime / サイズが同じならハッシュも計算しない。違っても内容が同じならスキップ
+            if prev["src_size"] == row["src_size"] and prev["src_mtime_ns"] == row["src_mtime_ns"]:
+                return ext, "skip", prev, 0.0
+            row["src_hash"] = image_hash(file_path)
+            if row["src_hash"] == prev["src_hash"]:
+                return ext, "skip", row, 0.0
+        t0 = time.perf_counter()
+        row["src_hash"] = row.get("src_hash") or image_hash(file_path)
+        if ext in CONVERT_EXTS:
+            quality, optimize, progressive = settings.split("/")
+            with Image.open(file_path) as img:
+                if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+                img.save(tmp_path, "JPEG", quality=int(quality), optimize=optimize == "1", progressive=progressive == "1")
+            os.replace(tmp_path, save_path)
+        else:
+            shutil.copy2(file_path, save_path)
+    except Exception as e:
+        print(f"Error: {file_path} ({e})")
+        # 書きかけの一時ファイルを残さない
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        return ext, "error", None, time.perf_counter() - t0
+    return ext, "done", row, time.perf_counter() - t0
+
+def rename_and_convert_avif_webp_to_jpg(src_dir, dst_dir, workers=CONVERT_WORKERS, quality=JPEG_QUALITY,
+                                        optimize=JPEG_OPTIMIZE, progressive=JPEG_PROGRESSIVE):
+    """src_dir のファイルを連番にして dst_dir に置く。WebP / AVIF / GIF は JPEG に変換する (プロセスプールで並列)。
+    前回の変換記録 (dst_dir/.convert_log.csv) と内容ハッシュ・設定が同じファイルは処理しない"""
     if not os.path.exists(src_dir):
         os.makedirs(src_dir)
         print(f"'{src_dir}' フォルダを作成しました。")
         return
     if not os.path.exists(dst_dir): os.makedirs(dst_dir)
-    convert_exts = {".webp", ".avif", ".gif"}
     files = sorted([f for f in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, f))])
     if not files: return
+
+    log_path = os.path.join(dst_dir, CONVERT_LOG_FILE)
+    log = load_convert_log(log_path)
+    tasks = []
     for i, filename in enumerate(files, 1):
-        file_path = os.path.join(src_dir, filename)
         ext = os.path.splitext(filename)[1].lower()
         new_name_base = f"glitch_image_{str(i).zfill(6)}"
-        try:
-            if ext in convert_exts:
-                save_path = os.path.join(dst_dir, f"{new_name_base}.jpg")
-                with Image.open(file_path) as img:
-                    if img.mode in ("RGBA", "P"): img = img.convert("RGB")
-                    img.save(save_path, "JPEG", quality=95)
-            else:
-                new_filename = f"{new_name_base}{ext}"
-                shutil.copy2(file_path, os.path.join(dst_dir, new_filename))
-        except Exception as e: print(f"Error: {e}")
+        if ext in CONVERT_EXTS:
+            save_path = os.path.join(dst_dir, f"{new_name_base}.jpg")
+            settings = f"{quality}/{int(optimize)}/{int(progressive)}"
+        else:
+            save_path = os.path.join(dst_dir, f"{new_name_base}{ext}")
+            settings = "copy"
+        prev = log.get(os.path.basename(save_path))
+        if prev and prev["src_name"] != filename: prev = None # 番号がずれた場合は作り直す
+        tasks.append((os.path.join(src_dir, filename), save_path, settings, prev))
+
+    # 拡張子ごとの 件数・スキップ数・入力バイト数・処理時間 (ワーカーの合計)
+    stats = {}
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        for n, (ext, status, row, seconds) in enumerate(pool.imap_unordered(convert_one, tasks, chunksize=4), 1):
+            s = stats.setdefault(ext, {"done": 0, "skip": 0, "error": 0, "bytes": 0, "seconds": 0.0})
+            s[status] += 1
+            if row is not None:
+                log[row["dst_name"]] = row
+                if status == "done":
+                    s["bytes"] += int(row["src_size"])
+                    s["seconds"] += seconds
+            print(f"\r{n}/{len(tasks)}", end="")
+    elapsed = time.perf_counter() - t0
+    print()
+    save_convert_log(log_path, log)
+
+    print(f"{'形式':<6} {'変換':>6} {'スキップ':>8} {'失敗':>4} {'MB':>8} {'枚/秒(1コア)':>12}")
+    for ext, s in sorted(stats.items()):
+        per_core = s["done"] / s["seconds"] if s["seconds"] > 0 else 0.0
+        print(f"{ext:<6} {s['done']:>6} {s['skip']:>8} {s['error']:>4} {s['bytes'] / 1024 / 1024:>8.1f} {per_core:>12.1f}")
+    done = sum(s["done"] for s in stats.values())
+    print(f"合計 {done} 件を {elapsed:.1f} 秒で処理 ({done / elapsed if elapsed > 0 else 0:.1f} 枚/秒, {workers} プロセス)")
 
 def rename_zfill(src_dir, dst_dir):
     if not os.path.exists(src_dir): return
@@ -105,7 +281,9 @@ def main():
         rename_zfill("input", "output")
     elif mode == "2":
         # モード2は画像とラベルの両方を処理
-        reindex_pairs(IMG_SRC, LBL_SRC, IMG_DST, LBL_DST)
+        transfer = input("画像の置き方 (link: ハードリンク / move: 移動 / copy: コピー) [link]: ").strip() or "link"
+        dry_run = input("ドライラン (処理内容の表示のみ) にしますか？ (y/n) [n]: ").strip().lower() == "y"
+        reindex_pairs(IMG_SRC, LBL_SRC, IMG_DST, LBL_DST, transfer, dry_run)
     else:
         print("0, 1, 2 のいずれかを入力してください")
 
@@ -1,5 +1,11 @@
 import cv2
 import os
+import csv
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from dataset_manifest import DatasetManifest
 
 # ==========================================
 # 設定：ここに回転させたいファイルのパスを入力
@@ -13,6 +19,191 @@ OUT_IMAGE = 'glitch_image_00001_rot90.jpg'
 OUT_LABEL = 'glitch_image_00001_rot90.txt'
 # ==========================================
 
+# --- 設定（データセット全体の拡張） ---
+IMAGE_DIR = 'reindexed_images'
+LABEL_DIR = 'reindexed_labels'
+OUT_IMAGE_DIR = 'augmented_images' # 拡張した画像は元のデータと混ぜず、別の split として保存する
+OUT_LABEL_DIR = 'augmented_labels'
+PROVENANCE_FILE = 'provenance.csv'  # 出力 → 元画像・変換 の対応 (OUT_IMAGE_DIR 内)
+PROVENANCE_FIELDS = ["out_name", "src_name", "src_hash", "label_size", "label_mtime_ns", "transform", "boxes_in", "boxes_out"]
+IMAGE_EXTS = ['.jpg', '.jpeg', '.png']
+GEOMETRIC_TRANSFORMS = ['rot90', 'rot180', 'rot270', 'hflip', 'vflip']
+DEFAULT_TRANSFORMS = ['rot90', 'rot180', 'rot270', 'hflip']
+DEFAULT_SCALES = [0.5, 0.75] # 縮小の段 (小さく写ったグリッチ用)
+DEFAULT_CROPS = [0.8]        # 切り抜きの大きさ (元の幅・高さに対する比率)。中央と四隅の5通り
+CROP_POSITIONS = {'c': (0.5, 0.5), 'tl': (0.0, 0.0), 'tr': (1.0, 0.0), 'bl': (0.0, 1.0), 'br': (1.0, 1.0)}
+MIN_VISIBLE = 0.4  # 切り抜きでボックスがこの割合以上残らなければ捨てる
+JPEG_QUALITY = 95
+
+# --- ボックスの変換 (正規化 xyxy (K, 4) をまとめて変換する) ---
+def rot90_boxes(b):
+    # 時計回り90度: (x, y) → (1 - y, x)
+    return np.stack([1 - b[:, 3], b[:, 0], 1 - b[:, 1], b[:, 2]], axis=1)
+
+def rot180_boxes(b):
+    return 1 - b[:, [2, 3, 0, 1]]
+
+def rot270_boxes(b):
+    # 反時計回り90度: (x, y) → (y, 1 - x)
+    return np.stack([b[:, 1], 1 - b[:, 2], b[:, 3], 1 - b[:, 0]], axis=1)
+
+def hflip_boxes(b):
+    return np.stack([1 - b[:, 2], b[:, 1], 1 - b[:, 0], b[:, 3]], axis=1)
+
+def vflip_boxes(b):
+    return np.stack([b[:, 0], 1 - b[:, 3], b[:, 2], 1 - b[:, 1]], axis=1)
+
+GEOMETRIC = {
+    'rot90': (lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE), rot90_boxes),
+    'rot180': (lambda img: cv2.rotate(img, cv2.ROTATE_180), rot180_boxes),
+    'rot270': (lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE), rot270_boxes),
+    'hflip': (lambda img: cv2.flip(img, 1), hflip_boxes),
+    'vflip': (lambda img: cv2.flip(img, 0), vflip_boxes),
+}
+
+def crop_window(size, pos):
+    """切り抜き範囲 (正規化 x0, y0, x1, y1)"""
+    ax, ay = CROP_POSITIONS[pos]
+    x0, y0 = (1 - size) * ax, (1 - size) * ay
+    return x0, y0, x0 + size, y0 + size
+
+def crop_boxes(b, window, min_visible=MIN_VISIBLE):
+    """切り抜き範囲の座標に直す。はみ出した部分は切り詰め、残りが min_visible 未満のボックスは捨てる。
+    (変換後のボックス, 残したボックスの bool 配列) を返す"""
+    x0, y0, x1, y1 = window
+    origin = np.float32([x0, y0, x0, y0])
+    extent = np.float32([x1 - x0, y1 - y0, x1 - x0, y1 - y0])
+    clipped = np.clip(b, origin, origin + extent)
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    visible = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+    keep = visible >= min_visible * np.maximum(area, 1e-12)
+    return (clipped[keep] - origin) / extent, keep
+
+def build_transforms(names, scales, crops):
+    """変換名 → (画像の変換, ボックスの変換) の dict。ボックスの変換は (boxes) → (boxes, keep)"""
+    transforms = {}
+    for name in names:
+        img_fn, box_fn = GEOMETRIC[name]
+        transforms[name] = (img_fn, lambda b, f=box_fn: (f(b), np.ones(len(b), dtype=bool)))
+    for s in scales:
+        # 正規化座標なのでボックスはそのまま
+        transforms[f"scale{s:g}"] = (
+            lambda img, s=s: cv2.resize(img, (max(1, round(img.shape[1] * s)), max(1, round(img.shape[0] * s))), interpolation=cv2.INTER_AREA),
+            lambda b: (b, np.ones(len(b), dtype=bool))
+        )
+    for size in crops:
+        for pos in CROP_POSITIONS:
+            window = crop_window(size, pos)
+            transforms[f"crop{size:g}{pos}"] = (
+                lambda img, w=window: img[round(w[1] * img.shape[0]):round(w[3] * img.shape[0]), round(w[0] * img.shape[1]):round(w[2] * img.shape[1])],
+                lambda b, w=window: crop_boxes(b, w)
+            )
+    return transforms
+
+def to_yolo_lines(class_ids, boxes):
+    cxcy = (boxes[:, :2] + boxes[:, 2:]) / 2
+    wh = boxes[:, 2:] - boxes[:, :2]
+    return [f"{c} {x:.6f} {y:.6f} {w:.6f} {h:.6f}" for c, (x, y), (w, h) in zip(class_ids.tolist(), cxcy.tolist(), wh.tolist())]
+
+_worker_transforms = None
+_worker_options = None
+
+def init_worker(names, scales, crops, options):
+    # lambda は子プロセスに送れないので、ワーカーごとに作り直す
+    global _worker_transforms, _worker_options
+    _worker_transforms = build_transforms(names, scales, crops)
+    _worker_options = options
+
+def augment_one(task):
+    """1枚を読み込んで、指定された変換をすべて書き出す。出所の行のリストを返す"""
+    img_path, src_hash, label_stat, class_ids, boxes, todo = task
+    img = cv2.imread(img_path)
+    if img is None:
+        print(f"❌ 画像が読み込めません: {img_path}")
+        return []
+    src_name = os.path.basename(img_path)
+    base = os.path.splitext(src_name)[0]
+    rows = []
+    for name in todo:
+        img_fn, box_fn = _worker_transforms[name]
+        new_boxes, keep = box_fn(boxes)
+        out_base = f"{base}_{name}"
+        out_path = os.path.join(_worker_options['out_image_dir'], f"{out_base}.jpg")
+        if not cv2.imwrite(out_path, img_fn(img), [cv2.IMWRITE_JPEG_QUALITY, _worker_options['quality']]):
+            # 画像がないのにラベルと出所だけ残すと、次回も作り直されずに欠けたままになる
+            print(f"❌ 画像を保存できません: {out_path}")
+            continue
+        with open(os.path.join(_worker_options['out_label_dir'], f"{out_base}.txt"), 'w') as f:
+            f.write('\n'.join(to_yolo_lines(class_ids[keep], new_boxes)))
+        rows.append({"out_name": f"{out_base}.jpg", "src_name": src_name, "src_hash": src_hash,
+                     "label_size": label_stat[0], "label_mtime_ns": label_stat[1],
+                     "transform": name, "boxes_in": len(boxes), "boxes_out": len(new_boxes)})
+    return rows
+
+def load_provenance(path):
+    if not os.path.exists(path): return {}
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return {row["out_name"]: row for row in csv.DictReader(f)}
+
+def save_provenance(path, provenance):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=PROVENANCE_FIELDS)
+        writer.writeheader()
+        for name in sorted(provenance):
+            writer.writerow(provenance[name])
+    os.replace(tmp_path, path)
+
+def augment_dataset(image_dir=IMAGE_DIR, label_dir=LABEL_DIR, out_image_dir=OUT_IMAGE_DIR, out_label_dir=OUT_LABEL_DIR,
+                    names=DEFAULT_TRANSFORMS, scales=DEFAULT_SCALES, crops=DEFAULT_CROPS, workers=None, quality=JPEG_QUALITY):
+    """ラベル付きの画像すべてに変換をかけて別フォルダに保存する (プロセスプールで並列)。
+    元画像の内容ハッシュとラベルのサイズ・mtime が出所の記録と同じ出力は作り直さないので、
+    画像を追加したときやラベルを直したときはその分だけ処理する"""
+    os.makedirs(out_image_dir, exist_ok=True)
+    os.makedirs(out_label_dir, exist_ok=True)
+    transform_names = list(build_transforms(names, scales, crops))
+    manifest = DatasetManifest(image_dir, label_dir)
+    provenance_path = os.path.join(out_image_dir, PROVENANCE_FILE)
+    provenance = load_provenance(provenance_path)
+
+    labels = manifest.labels
+    tasks = []
+    for base, img_path in manifest.pairs(IMAGE_EXTS):
+        src_hash = manifest.entries[os.path.basename(img_path)]["hash"]
+        # ラベルの変更は索引に記録済みの サイズ・mtime で判断する (reindex_pairs と同じ)
+        i = labels.lookup[base]
+        label_stat = (str(labels.sizes[i]), str(labels.mtimes[i]))
+        todo = []
+        for name in transform_names:
+            row = provenance.get(f"{base}_{name}.jpg", {})
+            if (row.get("src_hash") != src_hash or (row.get("label_size"), row.get("label_mtime_ns")) != label_stat
+                    or not os.path.exists(os.path.join(out_image_dir, f"{base}_{name}.jpg"))):
+                todo.append(name)
+        if not todo: continue
+        class_ids, boxes = labels.get(base)
+        tasks.append((img_path, src_hash, label_stat, np.array(class_ids), np.array(boxes), todo))
+
+    total = sum(len(t[5]) for t in tasks)
+    print(f"🔄 {len(tasks)} 枚 × 変換 → {total} 枚を作成します ({', '.join(transform_names)})")
+    if not tasks: return
+
+    workers = workers or os.cpu_count() or 1
+    options = {'out_image_dir': out_image_dir, 'out_label_dir': out_label_dir, 'quality': quality}
+    t0 = time.perf_counter()
+    done = boxes_out = 0
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(names, scales, crops, options)) as pool:
+        for rows in pool.imap_unordered(augment_one, tasks, chunksize=max(1, min(8, len(tasks) // (workers * 4)))):
+            for row in rows:
+                provenance[row["out_name"]] = row
+                boxes_out += int(row["boxes_out"])
+            done += len(rows)
+            print(f"\r{done}/{total}", end="")
+    print()
+    save_provenance(provenance_path, provenance)
+    elapsed = time.perf_counter() - t0
+    print(f"✅ {done} 枚 (ボックス {boxes_out} 個) を {elapsed:.1f} 秒で保存しました ({done / elapsed if elapsed > 0 else 0:.1f} 枚/秒, {workers} プロセス)")
+    print(f"   出力先: '{out_image_dir}', '{out_label_dir}' / 出所: '{provenance_path}'")
+
 def rotate_single_file(img_p, lbl_p, out_img_p, out_lbl_p):
     # --- 1. 画像の回転 ---
     img = cv2.imread(img_p)
@@ -52,4 +243,16 @@ def rotate_single_file(img_p, lbl_p, out_img_p, out_lbl_p):
     print(f"✅ ラベルを保存しました: {out_lbl_p}")
 
 if __name__ == "__main__":
-    rotate_single_file(target_image_path, target_txt_path, OUT_IMAGE, OUT_LABEL)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--single', action='store_true', help='設定欄の1ファイルだけを90度回転する (従来の動作)')
+    parser.add_argument('--transforms', nargs='*', choices=GEOMETRIC_TRANSFORMS, default=DEFAULT_TRANSFORMS, help='回転・反転')
+    parser.add_argument('--scales', nargs='*', type=float, default=DEFAULT_SCALES, help='縮小率の段')
+    parser.add_argument('--crops', nargs='*', type=float, default=DEFAULT_CROPS, help='切り抜きの大きさ (中央と四隅)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='プロセス数')
+    parser.add_argument('--quality', type=int, default=JPEG_QUALITY, help='JPEG 品質')
+    args = parser.parse_args()
+
+    if args.single:
+        rotate_single_file(target_image_path, target_txt_path, OUT_IMAGE, OUT_LABEL)
+    else:
+        augment_dataset(names=args.transforms, scales=args.scales, crops=args.crops, workers=args.workers, quality=args.quality)
\ No newline at end of file
@@ -0,0 +1,183 @@
+import cv2
+import math
+import threading
+import numpy as np
+import tkinter as tk
+from PIL import Image, ImageTk
+from image_loader import load_level
+
+# --- 設定 ---
+TILE_SIZE = 256      # 画面上のタイル1枚の大きさ (px)
+MAX_ZOOM = 4.0       # 元画像の 1px を最大何 px に拡大するか
+ZOOM_STEP = 1.25     # ホイール1段あたりの拡大率
+MAX_TILES = 300      # 保持するタイル (PhotoImage) の上限
+LEVEL_POLL_MS = 30   # 高解像度の段の読み込み完了を確認する間隔
+
+class TiledViewport:
+    """Canvas に画像をタイル単位で表示する。見えている範囲のタイルだけを作り、
+    拡大率に応じてピラミッドの段 (1/8 〜 1/1) を別スレッドで読み込んで切り替える。
+    キャンバス座標は「元画像の座標 × zoom」。"box" タグの項目はズーム時に座標だけ拡大縮小する。"""
+
+    def __init__(self, canvas, root):
+        self.canvas = canvas
+        self.root = root
+        self.zoom = 1.0
+        self.fit_zoom = 1.0
+        self.orig_w = self.orig_h = 1
+        self.path = None
+        self.img_hash = None
+        self.sources = {} # {縮小率: (x方向の倍率, y方向の倍率, RGB 配列)}
+        self.tiles = {}   # {(i, j): (canvas 項目, PhotoImage)}
+        self.loading = set()
+        self.failed = set() # 読み込めなかった段 (同じ画像では再要求しない)
+        self.ready = []
+        self.generation = 0 # 画像を切り替えるたびに増やす (前の画像の読み込み結果を捨てるため)
+        self.lock = threading.Lock()
+        self.poll = None
+        self.canvas.bind("<Configure>", lambda e: self.update_tiles())
+
+    def set_image(self, display_img, orig_w, orig_h, fit_zoom, path, img_hash=None):
+        """先読み済みの表示用画像 (全体表示の倍率) で表示を始める"""
+        self.generation += 1
+        self.path, self.img_hash = path, img_hash
+        self.orig_w, self.orig_h = orig_w, orig_h
+        self.fit_zoom = fit_zoom
+        arr = np.asarray(display_img)
+        self.sources = {0: (arr.shape[1] / orig_w, arr.shape[0] / orig_h, arr)}
+        self.loading = set()
+        self.failed = set()
+        self.canvas.config(width=arr.shape[1], height=arr.shape[0])
+        self._set_zoom(fit_zoom)
+        self.canvas.xview_moveto(0)
+        self.canvas.yview_moveto(0)
+        self.update_tiles()
+
+    def to_image(self, wx, wy):
+        """ウィンドウ座標 → 元画像の座標"""
+        return self.canvas.canvasx(wx) / self.zoom, self.canvas.canvasy(wy) / self.zoom
+
+    def _set_zoom(self, zoom):
+        self.zoom = zoom
+        self.canvas.delete("tile")
+        self.tiles = {}
+        self.canvas.config(scrollregion=(0, 0, self.orig_w * zoom, self.orig_h * zoom))
+
+    def zoom_at(self, wx, wy, steps):
+        """カーソル位置を中心に拡大・縮小する"""
+        new_zoom = min(MAX_ZOOM, max(self.fit_zoom, self.zoom * ZOOM_STEP ** steps))
+        if abs(new_zoom - self.zoom) < 1e-9: return
+        px, py = self.to_image(wx, wy)
+        # ボックスは作り直さず、座標だけまとめて拡大縮小する
+        ratio = new_zoom / self.zoom
+        self.canvas.scale("box", 0, 0, ratio, ratio)
+        self._set_zoom(new_zoom)
+        self.canvas.xview_moveto((px * new_zoom - wx) / (self.orig_w * new_zoom))
+        self.canvas.yview_moveto((py * new_zoom - wy) / (self.orig_h * new_zoom))
+        self.update_tiles()
+
+    def fit(self):
+        if abs(self.zoom - self.fit_zoom) > 1e-9:
+            ratio = self.fit_zoom / self.zoom
+            self.canvas.scale("box", 0, 0, ratio, ratio)
+            self._set_zoom(self.fit_zoom)
+        self.canvas.xview_moveto(0)
+        self.canvas.yview_moveto(0)
+        self.update_tiles()
+
+    def pan_start(self, event):
+        self.canvas.scan_mark(event.x, event.y)
+
+    def pan_drag(self, event):
+        # スクロールはキャンバス側で行われるので、新しく見えた部分のタイルだけ作る
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.update_tiles()
+
+    def _pick_source(self):
+        """今の拡大率に足りる最も小さい段。なければ最も細かい段を使い、足りない段を読み込む"""
+        enough = [(sx, key) for key, (sx, _, _) in self.sources.items() if sx >= self.zoom * 0.999]
+        if not enough:
+            factor = next((f for f in (8, 4, 2) if 1 / f >= self.zoom), 1)
+            self._request_level(factor)
+            return max(self.sources.values(), key=lambda s: s[0])
+        return self.sources[min(enough)[1]]
+
+    def update_tiles(self):
+        if self.path is None: return
+        full_w, full_h = self.orig_w * self.zoom, self.orig_h * self.zoom
+        x0, y0 = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        x1 = min(full_w, x0 + max(1, self.canvas.winfo_width()))
+        y1 = min(full_h, y0 + max(1, self.canvas.winfo_height()))
+        visible = {(i, j)
+                   for i in range(max(0, int(x0 // TILE_SIZE)), int(math.ceil(x1 / TILE_SIZE)))
+                   for j in range(max(0, int(y0 // TILE_SIZE)), int(math.ceil(y1 / TILE_SIZE)))}
+        missing = visible - self.tiles.keys()
+        if missing:
+            sx, sy, src = self._pick_source()
+            for i, j in sorted(missing):
+                self._create_tile(i, j, sx, sy, src, full_w, full_h)
+        # 画面外のタイルは上限を超えた分だけ捨てる
+        if len(self.tiles) > MAX_TILES:
+            for key in [k for k in self.tiles if k not in visible][:len(self.tiles) - MAX_TILES]:
+                self.canvas.delete(self.tiles.pop(key)[0])
+
+    def _create_tile(self, i, j, sx, sy, src, full_w, full_h):
+        dx0, dy0 = i * TILE_SIZE, j * TILE_SIZE
+        dx1, dy1 = min(full_w, dx0 + TILE_SIZE), min(full_h, dy0 + TILE_SIZE)
+        dw, dh = int(math.ceil(dx1 - dx0)), int(math.ceil(dy1 - dy0))
+        if dw <= 0 or dh <= 0: return
+        # 表示座標 → 元画像座標 → 段の画素座標
+        rx, ry = sx / self.zoom, sy / self.zoom
+        h, w = src.shape[:2]
+        cx0, cy0 = int(dx0 * rx), int(dy0 * ry)
+        cx1, cy1 = min(w, max(cx0 + 1, int(math.ceil(dx1 * rx)))), min(h, max(cy0 + 1, int(math.ceil(dy1 * ry))))
+        crop = src[cy0:cy1, cx0:cx1]
+        if crop.size == 0: return
+        # 拡大時は画素の境界が分かるように最近傍、縮小時は平均
+        interp = cv2.INTER_NEAREST if rx < 1 else cv2.INTER_AREA
+        tile = cv2.resize(crop, (dw, dh), interpolation=interp)
+        photo = ImageTk.PhotoImage(Image.fromarray(tile))
+        item = self.canvas.create_image(dx0, dy0, anchor=tk.NW, image=photo, tags=("tile",))
+        self.canvas.tag_lower(item)
+        self.tiles[(i, j)] = (item, photo)
+
+    def _request_level(self, factor):
+        if factor in self.sources or factor in self.loading or factor in self.failed: return
+        self.loading.add(factor)
+        generation, path, img_hash = self.generation, self.path, self.img_hash
+
+        def work():
+            try:
+                img = load_level(path, factor, img_hash)
+                rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) if img is not None else None
+            except Exception as e:
+                print(f"⚠️ 1/{factor} の読み込みに失敗しました: {path} ({e})")
+                rgb = None
+            with self.lock:
+                self.ready.append((generation, factor, rgb))
+
+        threading.Thread(target=work, daemon=True).start()
+        if self.poll is None:
+            self.poll = self.root.after(LEVEL_POLL_MS, self._check_levels)
+
+    def _check_levels(self):
+        # Tk の操作はメインスレッドで行う
+        self.poll = None
+        with self.lock:
+            ready, self.ready = self.ready, []
+        updated = False
+        for generation, factor, rgb in ready:
+            if generation != self.generation: continue
+            self.loading.discard(factor)
+            if rgb is None:
+                # 壊れた画像などでデコードに失敗した段は、パン・ズームのたびに読み直さない
+                self.failed.add(factor)
+                continue
+            self.sources[factor] = (rgb.shape[1] / self.orig_w, rgb.shape[0] / self.orig_h, rgb)
+            updated = True
+        if updated:
+            # 細かい段が届いたのでタイルを作り直す
+            self.canvas.delete("tile")
+            self.tiles = {}
+            self.update_tiles()
+        if self.loading:
+            self.poll = self.root.after(LEVEL_POLL_MS, self._check_levels)
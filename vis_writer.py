@@ -0,0 +1,98 @@
+import cv2
+import os
+import queue
+import threading
+
+# --- 設定 ---
+VIS_MODES = ['all', 'none', 'sample', 'failures']
+DEFAULT_VIS_EVERY = 10 # sample モードで何枚に1枚保存するか
+DEFAULT_VIS_THREADS = 2
+MAX_QUEUE_SIZE = 16 # 描画待ちの画像をメモリに溜めすぎないための上限
+JPEG_QUALITY = 95 # cv2.imwrite の既定値と同じ
+
+def add_vis_arguments(parser):
+    """評価スクリプト共通の可視化オプション"""
+    parser.add_argument('--vis', choices=VIS_MODES, default='all',
+                        help='結果画像の保存: all=全件 / none=保存しない / sample=N枚に1枚 / failures=見逃し・誤検出がある画像のみ')
+    parser.add_argument('--vis-every', type=int, default=DEFAULT_VIS_EVERY, help='sample モードの間隔')
+    parser.add_argument('--vis-max-side', type=int, default=None,
+                        help='縮小プレビューの長辺 (省略時は元の解像度。推論を縮小デコードで行う検出器も、保存する画像は元の解像度から作る)')
+    parser.add_argument('--vis-threads', type=int, default=DEFAULT_VIS_THREADS, help='描画・JPEG 保存に使うスレッド数')
+
+def vis_options(args):
+    """VisWriter に渡す設定 (子プロセスにもそのまま渡せる dict)"""
+    return {'mode': args.vis, 'every': args.vis_every, 'max_side': args.vis_max_side, 'num_threads': args.vis_threads}
+
+class VisWriter:
+    """評価結果の描画と JPEG 保存を別スレッドで行う。
+    submit() には元画像と描画関数を渡す。元画像は書き換えず、ワーカー側で (縮小) コピーしてから描画する。"""
+
+    def __init__(self, out_dir, mode='all', every=DEFAULT_VIS_EVERY, max_side=None,
+                 num_threads=DEFAULT_VIS_THREADS, max_queue=MAX_QUEUE_SIZE):
+        if mode not in VIS_MODES:
+            raise ValueError(f"不明な可視化モード: {mode}")
+        self.out_dir = out_dir
+        self.mode = mode
+        self.every = max(1, every)
+        self.max_side = max_side
+        self.seen = 0
+        self.written = 0
+        self.failed = []
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(max_queue)
+        self.threads = []
+        if mode == 'none': return
+        os.makedirs(out_dir, exist_ok=True)
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(1, num_threads))]
+        for t in self.threads: t.start()
+
+    def wants(self, failed=False):
+        """この画像を保存するか (呼ぶたびに枚数を数える)"""
+        index = self.seen
+        self.seen += 1
+        if self.mode == 'none': return False
+        if self.mode == 'sample': return index % self.every == 0
+        if self.mode == 'failures': return failed
+        return True
+
+    def submit(self, file_name, image, draw, failed=False):
+        """draw(vis_img) は vis_img の解像度に合わせて描画する関数 (正規化座標を使う)。
+        image は画像か、画像を返す関数 (推論用に縮小デコードした場合に、保存する画像だけ元の解像度で読み直す)"""
+        if not self.wants(failed): return
+        # キューが満杯なら空くまで待つ (バックプレッシャー)
+        self.queue.put((file_name, image, draw))
+
+    def close(self):
+        for _ in self.threads: self.queue.put(None)
+        for t in self.threads: t.join()
+        self.threads = []
+        if self.failed:
+            print(f"  [Vis Error] {len(self.failed)} 件の画像を保存できませんでした: {self.failed[:10]}")
+
+    def _prepare(self, image):
+        h, w = image.shape[:2]
+        if self.max_side and max(h, w) > self.max_side:
+            scale = self.max_side / max(h, w)
+            return cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        return image.copy()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            file_name, image, draw = item
+            path = os.path.join(self.out_dir, file_name)
+            try:
+                if callable(image):
+                    image = image()
+                    if image is None: raise OSError("画像を読み込めません")
+                vis_img = self._prepare(image)
+                draw(vis_img)
+                if not cv2.imwrite(path, vis_img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+                    raise OSError("cv2.imwrite が失敗しました")
+                with self.lock: self.written += 1
+            except Exception as e:
+                with self.lock: self.failed.append(f"{file_name} ({e})")
+            self.queue.task_done()